@@ -4,6 +4,7 @@
 
 """说明"""
 import os
+import re
 import threading
 import time
 import queue
@@ -11,6 +12,9 @@ import copy
 import subprocess
 import chardet
 
+from log_tailer import LogTailer
+from progress import ProgressBus, ProgressEvent, ProgressReporter, hidden_startupinfo, iter_output_lines
+
 
 class VideoDownloadThread(threading.Thread):
     """ 视频下载线程类
@@ -23,9 +27,13 @@ class VideoDownloadThread(threading.Thread):
             video_url (str): 下载视频的链接
             dir_path (str): 下载目录
             wav_name (str): 下载视频的名称
+            progress_bus (ProgressBus): 进度事件总线，为 None 时不发布；下载进度以步骤名 'download:线程id' 发布
+            use_log_file (bool): 为 True 时将 you-get 的输出写入日志文件，由 VideoDownloadMonitorThread 监听（旧方式）；
+                默认通过管道逐行读取输出，每行只解析一次，直接更新 run_state 和 final_state
     """
 
-    def __init__(self, thread_id: str, video_url: str, dir_path: str, wav_name: str):
+    def __init__(self, thread_id: str, video_url: str, dir_path: str, wav_name: str, progress_bus: ProgressBus = None,
+                 use_log_file: bool = False):
         super(VideoDownloadThread, self).__init__()
         self.thread_id = thread_id
         self.video_url = video_url
@@ -34,25 +42,78 @@ class VideoDownloadThread(threading.Thread):
         self.log_path = os.path.join(self.dir_path, self.wav_name + "下载信息.txt")
         self.run_state = ""
         self.final_state = ""
+        self.progress_bus = progress_bus
+        self.use_log_file = use_log_file
 
     def run(self):
         # 视频下载信息文件的绝对路径，用于显示视频信息、视频下载进度
         print(self.wav_name + "开始下载")
+        if not self.use_log_file:
+            self.download_with_pipe()
+            print(self.wav_name + self.final_state)
+            return
         with open(self.log_path, 'w', encoding="utf-8") as log_file:
             export_exe = True
             # 如果代码用于导出exe文件，则需要加上'./'，并在导出的exe同目录下加入you-get.exe
             if export_exe:
-                startup = subprocess.STARTUPINFO()
-                startup.dwFlags = subprocess.STARTF_USESHOWWINDOW
-                startup.wShowWindow = subprocess.SW_HIDE
                 subprocess.run(os.path.join(os.path.abspath('./'), 'you-get.exe ') + self.video_url + " -o " +
                                self.dir_path + " -O " + self.wav_name + " --no-caption",
-                               stdin=None, stdout=log_file, stderr=log_file, shell=False, startupinfo=startup)
+                               stdin=None, stdout=log_file, stderr=log_file, shell=False,
+                               startupinfo=hidden_startupinfo())
             else:
                 subprocess.run("you-get " + self.video_url + " -o " + self.dir_path + " -O " + self.wav_name +
                                 " --no-caption", stdin=None, stdout=log_file, stderr=log_file, shell=False)
         print(self.wav_name + "下载完成")
 
+    def download_with_pipe(self):
+        """ 调用 you-get，通过管道逐行读取输出并更新下载状态，不写日志文件 """
+        self.run_state = "准备下载"
+        you_get = 'you-get'
+        # 导出exe时使用同目录下的 you-get.exe
+        if os.name == 'nt' and os.path.isfile(os.path.join(os.path.abspath('./'), 'you-get.exe')):
+            you_get = os.path.join(os.path.abspath('./'), 'you-get.exe')
+        command = [you_get, self.video_url, '-o', self.dir_path, '-O', self.wav_name, '--no-caption']
+        reporter = ProgressReporter('download:' + self.thread_id, self.progress_bus)
+        first_line = True
+        last_line = ''
+        try:
+            process = subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                       stderr=subprocess.STDOUT, startupinfo=hidden_startupinfo())
+        except OSError:
+            self.run_state = "下载失败"
+            self.final_state = "下载失败"
+            reporter.report(None, self.run_state, 'failed')
+            return
+        with process:
+            for line in iter_output_lines(process.stdout):
+                last_line = line
+                # 第一行有错误信息，下载失败
+                if first_line and "[error]" in line:
+                    self.run_state = "下载失败"
+                    self.final_state = "下载失败"
+                first_line = False
+                if self.final_state == "下载失败":
+                    continue
+                # 含有%，且没有'100%'，说明正在下载
+                if '%' in line and '100%' not in line:
+                    line_list = [s for s in line.split(' ') if '├' not in s]
+                    self.run_state = ' '.join(line_list)
+                    match = re.search(r'([\d.]+)%', line)
+                    reporter.report(float(match.group(1)) if match is not None else None, self.run_state)
+            returncode = process.wait()
+        if self.final_state == "下载失败":
+            reporter.report(None, self.final_state, 'failed')
+            return
+        # 正常退出，或最后一行有'Skipping'（文件已存在），下载完成
+        if returncode == 0 or 'Skipping' in last_line:
+            self.run_state = "下载完成"
+            self.final_state = "下载完成"
+            reporter.report(100, self.final_state, 'done')
+        else:
+            self.run_state = "未知错误"
+            self.final_state = "未知错误"
+            reporter.report(None, self.final_state, 'failed')
+
 
 class VideoDownloadMonitorThread(threading.Thread):
     """ 视频下载子线程监听
@@ -65,80 +126,66 @@ class VideoDownloadMonitorThread(threading.Thread):
             download_thread (VideoDownloadThread): 视频下载子线程
     """
 
-    def __init__(self, thread_id: str, download_thread: VideoDownloadThread):
+    def __init__(self, thread_id: str, download_thread: VideoDownloadThread, encoding: str = None):
         super(VideoDownloadMonitorThread, self).__init__()
         self.thread_id = thread_id
         self.download_thread = download_thread
+        # 增量读取日志，每次只解析新增的行，编码只检测一次
+        self.tailer = LogTailer(download_thread.log_path, encoding)
 
     def run(self):
         while True:
             # 线程正在运行的情况
             if self.download_thread.is_alive():
                 # 如果文件不存在，状态为准备下载
-                if not os.path.isfile(self.download_thread.log_path):
+                if not self.tailer.exists():
                     self.download_thread.run_state = "准备下载"
                 # 如果文件存在
                 else:
-                    # 获取文件编码格式
-                    with open(self.download_thread.log_path, 'rb') as f:
-                        text = f.read()
-                        code = chardet.detect(text)['encoding']
-                    # 打开文件
-                    with open(self.download_thread.log_path, 'r', encoding=code) as f:
-                        # 将每一行存入列表，去除每一行首尾的回车和空格，空行不放入列表
-                        line_list = [line.strip() for line in f.readlines() if line.strip() != '']
-                        # 如果文件为空，状态为准备下载
-                        if len(line_list) == 0:
-                            self.download_thread.run_state = "准备下载"
-                        # 如果文件不为空
+                    self.tailer.poll()
+                    # 如果文件为空，状态为准备下载
+                    if self.tailer.line_count == 0:
+                        self.download_thread.run_state = "准备下载"
+                    # 如果文件不为空
+                    else:
+                        # 日志信息有错误信息，状态为下载失败
+                        if "[error]" in self.tailer.first_line:
+                            self.download_thread.run_state = "下载失败"
+                            self.download_thread.final_state = "下载失败"
+                        # 日志信息没有错误信息
                         else:
-                            # 日志信息有错误信息，状态为下载失败
-                            if "[error]" in line_list[0]:
-                                self.download_thread.run_state = "下载失败"
-                                self.download_thread.final_state = "下载失败"
-                            # 日志信息没有错误信息
+                            # 取文件最后一行
+                            last_line = self.tailer.last_line
+                            # 如果最后一行含有%，且没有'100%'，说明正在下载
+                            if '%' in last_line and '100%' not in last_line:
+                                last_line_list = last_line.split(' ')
+                                last_line_list = [s for s in last_line_list if '├' not in s]
+                                self.download_thread.run_state = ' '.join(last_line_list)
+                            # 如果最后一行含'Skipping'或'100%'，说明下载成功
+                            elif any(k in last_line for k in ('Skipping', 'Merging', '100%')):
+                                self.download_thread.run_state = "下载完成"
+                                self.download_thread.final_state = "下载完成"
+                            # 其它情况为未知错误
                             else:
-                                # 取文件最后一行
-                                last_line = line_list[-1]
-                                # 如果最后一行含有%，且没有'100%'，说明正在下载
-                                if '%' in last_line and '100%' not in last_line:
-                                    last_line_list = last_line.split(' ')
-                                    last_line_list = [s for s in last_line_list if '├' not in s]
-                                    self.download_thread.run_state = ' '.join(last_line_list)
-                                # 如果最后一行含'Skipping'或'100%'，说明下载成功
-                                elif 'Skipping' or "Merging" or '100%' in last_line:
-                                    self.download_thread.run_state = "下载完成"
-                                    self.download_thread.final_state = "下载完成"
-                                # 其它情况为未知错误
-                                else:
-                                    self.download_thread.run_state = "未知错误"
-                                    self.download_thread.final_state = "未知错误"
+                                self.download_thread.run_state = "未知错误"
+                                self.download_thread.final_state = "未知错误"
             # 线程停止运行的情况
             else:
                 # 如果文件不存在
-                if not os.path.isfile(self.download_thread.log_path):
+                if not self.tailer.exists():
                     self.download_thread.final_state = "未知错误"
                 # 如果文件存在
                 else:
-                    # 获取文件编码格式
-                    with open(self.download_thread.log_path, 'rb') as f:
-                        text = f.read()
-                        code = chardet.detect(text)['encoding']
-                    # 打开文件
-                    with open(self.download_thread.log_path, 'r', encoding=code) as f:
-                        # 将每一行存入列表，去除每一行首尾的回车和空格，空行不放入列表
-                        line_list = [line.strip() for line in f.readlines() if line.strip() != '']
-                        # 如果文件为空，最终状态为未知错误
-                        if len(line_list) == 0:
-                            self.download_thread.final_state = "未知错误"
-                        # 如果文件不为空
-                        else:
-                            # 日志信息有错误信息，最终状态为下载失败
-                            if "[error]" in line_list[0]:
-                                self.download_thread.final_state = "下载失败"
-                            # 日志信息没有错误信息，最后一行有'Skipping'，最终状态为下载完成
-                            elif 'Skipping' in line_list[-1]:
-                                self.download_thread.final_state = "下载完成"
+                    self.tailer.poll(final=True)
+                    # 如果文件为空，最终状态为未知错误
+                    if self.tailer.line_count == 0:
+                        self.download_thread.final_state = "未知错误"
+                    # 日志信息有错误信息，最终状态为下载失败
+                    elif "[error]" in self.tailer.first_line:
+                        self.download_thread.final_state = "下载失败"
+                    # 日志信息没有错误信息，最后一行有'Skipping'，最终状态为下载完成
+                    elif 'Skipping' in self.tailer.last_line:
+                        self.download_thread.final_state = "下载完成"
                 # 退出前删除文件
                 if os.path.isfile(self.download_thread.log_path):
                     os.remove(self.download_thread.log_path)
@@ -171,6 +218,10 @@ class VideoDownloadMainThread(threading.Thread):
         self.whether_with_name = whether_with_name
         self.list_download_info = []
         self.index = -1
+        # 下载线程通过管道读取输出时以 ProgressEvent 发布进度，主线程订阅
+        self.progress_bus = ProgressBus()
+        # 每个下载线程最新的进度事件，键为线程id
+        self.download_events = {}
 
     def run(self):
         self.VideoDownload(self.url_list_file, self.dir_path, self.max_count, self.whether_with_name)
@@ -217,10 +268,15 @@ class VideoDownloadMainThread(threading.Thread):
         # 根据视频链接、下载目录、视频名称创建所有线程并存入队列
         for i, url in enumerate(url_list):
             id = str(i + 1)
-            thread_temp = VideoDownloadThread(id, url, dir_path, wave_name_list[i])
+            thread_temp = VideoDownloadThread(id, url, dir_path, wave_name_list[i], progress_bus=self.progress_bus)
             thread_queue.put(thread_temp)
             thread_list_all.append(thread_temp)
 
+        def on_progress(event: ProgressEvent):
+            if event.stage.startswith('download:'):
+                self.download_events[event.stage[len('download:'):]] = event
+
+        self.progress_bus.subscribe(on_progress)
         # 线程总数
         count_threads = len(thread_list_all)
         # 初始化旧状态
@@ -241,8 +297,9 @@ class VideoDownloadMainThread(threading.Thread):
                     thread_list.append(thread_queue.get())
                     self.index += 1
                     thread_list[-1].start()
-                    # 运行对应的监听线程
-                    VideoDownloadMonitorThread(thread_list[-1].thread_id, thread_list[-1]).start()
+                    # 写日志文件时运行对应的监听线程，否则下载线程自己更新状态
+                    if thread_list[-1].use_log_file:
+                        VideoDownloadMonitorThread(thread_list[-1].thread_id, thread_list[-1]).start()
             # 如果列表仍为空，说明所有线程运行完毕
             if len(thread_list) == 0:
                 # 结束之前等待下载状态更新
@@ -250,6 +307,7 @@ class VideoDownloadMainThread(threading.Thread):
                 self.list_download_info = [thread_list_all[i].wav_name + "：等待下载" if i > self.index
                                            else self.get_state(thread_list_all[i], list_download_info_old[i])
                                            for i in range(count_threads)]
+                self.progress_bus.unsubscribe(on_progress)
                 break
             # 主线程每次循环睡眠 0.1秒，大大降低 cpu利用率
             time.sleep(0.1)
@@ -264,8 +322,12 @@ class VideoDownloadMainThread(threading.Thread):
                 th (VideoDownloadThread): 下载线程
                 old_state (str): 旧状态
         """
-        # 下载线程正在运行，取 run_state
+        # 下载线程正在运行，有进度事件时取事件的进度信息和预计剩余时间，否则取 run_state
         if th.is_alive():
+            event = self.download_events.get(th.thread_id)
+            if event is not None and event.state == 'running':
+                eta = "" if event.eta is None else " 剩余约" + format(event.eta, ".0f") + "秒"
+                return th.wav_name + "：" + event.message + eta
             # 线程状态为空，取旧状态
             if th.run_state == "":
                 return old_state
@@ -3,19 +3,44 @@
 # Author: Wang Zifan
 
 """说明"""
+import collections
 import os
+import queue
 import subprocess
 import threading
 import time
-import chardet
+import traceback
+
+from log_tailer import LogTailer
+from progress import ProgressBus, ProgressReporter, run_with_output
+from separation_engine import SeparationEngine
 
 
 class SplitAudioThread(threading.Thread):
-    def __init__(self, thread_id: str, audio_path: str, output_dir: str):
+    def __init__(self, thread_id: str, audio_path: str, output_dir: str, engine: SeparationEngine = None,
+                 window_seconds: float = 0.0, overlap_seconds: float = 1.0, progress_bus: ProgressBus = None,
+                 use_log_file: bool = False):
         super(SplitAudioThread, self).__init__()
         self.thread_id = thread_id
         self.audio_path = audio_path
         self.output_dir = output_dir
+        # 进程内的分离引擎，为 None 时调用 spleeter 命令行
+        self.engine = engine
+        # 使用分离引擎时，内存中的人声（(采样点数, 2) 的 float32 音频）及其采样率
+        self.vocals = None
+        self.sample_rate = engine.sample_rate if engine is not None else None
+        # 使用分离引擎且 window_seconds 大于0时分窗流式分离，每分离完一块人声就放入 vocal_queue，结束时放入 None
+        self.window_seconds = window_seconds
+        self.overlap_seconds = overlap_seconds
+        self.vocal_queue = queue.Queue(4)
+        # 调用命令行时默认通过管道逐行解析 spleeter 的输出并发布 'separate' 进度事件，
+        # use_log_file 为 True 时改为写入日志文件，由 SplitAudioMonitorThread 监听（旧方式）
+        self.progress_bus = progress_bus
+        self.use_log_file = use_log_file
+        # spleeter 输出中包含'INFO:'的行
+        self.info_lines = []
+        # 失败原因，成功时为 None
+        self.error = None
         self.log_path = os.path.join(self.output_dir, '.'.join(os.path.basename(audio_path).split('.')[0:-1]) + '.log')
         # 创建日志所需文件夹
         if not os.path.exists(os.path.dirname(self.log_path)):
@@ -23,6 +48,15 @@ class SplitAudioThread(threading.Thread):
         self.split_process = ""
 
     def run(self):
+        if self.streaming:
+            self.separate_chunked()
+            return
+        if self.engine is not None:
+            self.separate_in_process()
+            return
+        if not self.use_log_file:
+            self.separate_with_pipe()
+            return
         with open(self.log_path, 'w', encoding="utf-8") as log_file:
             export_exe = True
             # 如果代码用于导出exe文件，则需要加上'./'，并在导出的exe同目录下加入ffmpeg.exe及其相关文件(如ffplay.exe、ffprobe.exe)
@@ -37,60 +71,148 @@ class SplitAudioThread(threading.Thread):
                 subprocess.run("spleeter separate -p spleeter:2stems -o " + self.output_dir + " " + self.audio_path,
                                stdout=log_file, stderr=log_file, shell=False)
 
+    def separate_with_pipe(self):
+        """ 调用 spleeter 命令行，通过管道逐行读取输出，每行只解析一次，不写日志文件 """
+        reporter = ProgressReporter('separate', self.progress_bus)
+        # 导出exe时使用同目录下的 spleeter
+        spleeter = 'spleeter'
+        if os.name == 'nt' and os.path.isfile(os.path.join(os.path.abspath('./'), 'spleeter.exe')):
+            spleeter = os.path.join(os.path.abspath('./'), 'spleeter')
+        command = [spleeter, 'separate', '-p', 'spleeter:2stems', '-o', self.output_dir, self.audio_path]
+        # 最后几行输出，失败时作为失败原因
+        last_lines = collections.deque(maxlen=20)
+
+        def on_line(line: str):
+            last_lines.append(line)
+            if 'INFO:' not in line:
+                return
+            self.info_lines.append(line)
+            self.split_process = self.parse_info(line, len(self.info_lines), self.split_process)
+            reporter.report(None, self.split_process.split('\n')[-1])
+
+        try:
+            returncode = run_with_output(command, on_line)
+        except OSError:
+            traceback.print_exc()
+            last_lines.append(traceback.format_exc())
+            returncode = -1
+        succeeded = returncode == 0 and any('succesfully' in line for line in self.info_lines)
+        self.split_process = self.parse_info('', len(self.info_lines), finished=True, succeeded=succeeded)
+        if self.split_process.endswith("语音分离完成"):
+            reporter.report(100, self.split_process.split('\n')[-1], 'done')
+        else:
+            self.error = '\n'.join(last_lines) or 'spleeter返回' + str(returncode)
+            reporter.report(None, "语音分离失败", 'failed')
+
+    @staticmethod
+    def parse_info(last_line: str, info_count: int, current: str = "", finished: bool = False,
+                   succeeded: bool = False) -> str:
+        """ 根据 spleeter 输出中包含'INFO:'的行得到分离进度，管道和日志文件（SplitAudioMonitorThread）两种方式共用
+
+            Args:
+                last_line (str): 最后一个包含'INFO:'的行
+                info_count (int): 包含'INFO:'的行数，下载模型时有6行以上
+                current (str): 当前的分离进度，最后一行不改变进度时沿用
+                finished (bool): spleeter 是否已经结束
+                succeeded (bool): 是否出现过分离成功的信息，只在结束时使用
+
+            Returns:
+                split_process (str): 分离进度
+        """
+        all_finished = "模型下载完成\n校验完成\n模型解压完成\n语音分离完成"
+        if finished:
+            if not succeeded:
+                return "语音分离失败"
+            return all_finished if info_count >= 6 else "语音分离完成"
+        if 'Downloading model' in last_line:
+            return "正在下载模型"
+        elif 'Validating' in last_line:
+            return "模型下载完成\n正在校验"
+        elif 'Extracting' in last_line:
+            return "模型下载完成\n校验完成\n正在解压模型"
+        elif 'extracted' in last_line:
+            return "模型下载完成\n校验完成\n模型解压完成\n正在进行语音分离"
+        elif 'succesfully' in last_line:
+            return all_finished if info_count >= 6 else "语音分离完成"
+        return current if current != "" else "正在进行语音分离"
+
+    def separate_in_process(self):
+        """ 用进程内的分离引擎分离，输出文件与命令行相同，人声同时保留在内存中 """
+        self.split_process = "正在进行语音分离"
+        try:
+            stems = self.engine.separate_file(self.audio_path, self.output_dir)
+        except Exception:
+            traceback.print_exc()
+            self.error = traceback.format_exc()
+            self.split_process = "语音分离失败"
+            return
+        self.vocals = stems['vocals']
+        self.split_process = "语音分离完成"
+
+    @property
+    def streaming(self) -> bool:
+        return self.engine is not None and self.window_seconds > 0
+
+    def separate_chunked(self):
+        """ 分窗流式分离，人声逐块放入 vocal_queue，同时逐块写入与命令行相同的输出文件 """
+        self.split_process = "正在进行语音分离"
+        num_samples = 0
+        try:
+            for stems in self.engine.separate_file_chunked(self.audio_path, self.output_dir, self.window_seconds,
+                                                           self.overlap_seconds):
+                self.vocal_queue.put(stems['vocals'])
+                num_samples += len(stems['vocals'])
+                self.split_process = "正在进行语音分离：已分离" + format(num_samples / self.sample_rate, ".0f") + "秒"
+            self.split_process = "语音分离完成"
+        except Exception:
+            traceback.print_exc()
+            self.error = traceback.format_exc()
+            self.split_process = "语音分离失败"
+        finally:
+            self.vocal_queue.put(None)
+
+    def vocal_chunks(self):
+        """ 流式分离时依次取出分离完成的人声块，直到分离结束 """
+        while True:
+            vocals = self.vocal_queue.get()
+            if vocals is None:
+                break
+            yield vocals
+
 
 class SplitAudioMonitorThread(threading.Thread):
-    def __init__(self, thread_id: str, split_audio_thread: SplitAudioThread):
+    def __init__(self, thread_id: str, split_audio_thread: SplitAudioThread, encoding: str = None):
         super(SplitAudioMonitorThread, self).__init__()
         self.thread_id = thread_id
         self.split_audio_thread = split_audio_thread
+        # 增量读取日志，只关心包含'INFO:'的行
+        self.tailer = LogTailer(split_audio_thread.log_path, encoding, keyword='INFO:')
+        # 是否出现过分离成功的信息
+        self.succeeded = False
+
+    def poll(self, final: bool = False):
+        for line in self.tailer.poll(final):
+            if 'INFO:' in line and 'succesfully' in line:
+                self.succeeded = True
 
     def run(self):
         while True:
             # 线程正在运行
             if self.split_audio_thread.is_alive():
-                if os.path.isfile(self.split_audio_thread.log_path):
-                    # 获取文件编码格式
-                    with open(self.split_audio_thread.log_path, 'rb') as f:
-                        text = f.read()
-                        code = chardet.detect(text)['encoding']
-                    with open(self.split_audio_thread.log_path, 'r', encoding=code) as f:
-                        # 将每一包含'INFO:'的行存入列表，去除每一行首尾的回车和空格，空行不放入列表
-                        line_list = [line.strip() for line in f.readlines() if line.strip() != '' and 'INFO:' in line]
-                        # 如果文件不为空
-                        if len(line_list) > 0:
-                            if 'Downloading model' in line_list[-1]:
-                                self.split_audio_thread.split_process = "正在下载模型"
-                            elif 'Validating' in line_list[-1]:
-                                self.split_audio_thread.split_process = "模型下载完成\n正在校验"
-                            elif 'Extracting' in line_list[-1]:
-                                self.split_audio_thread.split_process = "模型下载完成\n校验完成\n正在解压模型"
-                            elif 'extracted' in line_list[-1]:
-                                self.split_audio_thread.split_process = "模型下载完成\n校验完成\n模型解压完成\n正在进行语音分离"
-                            elif 'succesfully' in line_list[-1] and len(line_list) >= 6:
-                                self.split_audio_thread.split_process = "模型下载完成\n校验完成\n模型解压完成\n语音分离完成"
-                            elif 'succesfully' in line_list[-1] and len(line_list) <= 5:
-                                self.split_audio_thread.split_process = "语音分离完成"
+                if self.tailer.exists():
+                    self.poll()
+                    # 如果文件不为空
+                    if self.tailer.match_count > 0:
+                        self.split_audio_thread.split_process = SplitAudioThread.parse_info(
+                            self.tailer.last_match, self.tailer.match_count, self.split_audio_thread.split_process)
             # 线程停止运行
             else:
-                if not os.path.isfile(self.split_audio_thread.log_path):
+                if not self.tailer.exists():
                     self.split_audio_thread.split_process = "语音分离失败"
                 else:
-                    # 获取文件编码格式
-                    with open(self.split_audio_thread.log_path, 'rb') as f:
-                        text = f.read()
-                        code = chardet.detect(text)['encoding']
-                    with open(self.split_audio_thread.log_path, 'r', encoding=code) as f:
-                        # 将每一包含'INFO:'的行存入列表，去除每一行首尾的回车和空格，空行不放入列表
-                        line_list = [line.strip() for line in f.readlines() if line.strip() != '' and 'INFO:' in line]
-                        # 文件为空
-                        if len(line_list) == 0:
-                            self.split_audio_thread.split_process = "语音分离失败"
-                        elif 'succesfully' in "".join(line_list) and len(line_list) >= 6:
-                            self.split_audio_thread.split_process = "模型下载完成\n校验完成\n模型解压完成\n语音分离完成"
-                        elif 'succesfully' in "".join(line_list) and len(line_list) <= 5:
-                            self.split_audio_thread.split_process = "语音分离完成"
-                        else:
-                            self.split_audio_thread.split_process = "语音分离失败"
+                    self.poll(final=True)
+                    self.split_audio_thread.split_process = SplitAudioThread.parse_info(
+                        self.tailer.last_match, self.tailer.match_count, finished=True, succeeded=self.succeeded)
                 # 退出前删除文件
                 if os.path.isfile(self.split_audio_thread.log_path):
                     os.remove(self.split_audio_thread.log_path)
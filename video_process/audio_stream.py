@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Author: Wang Zifan
+
+"""用 ffmpeg 管道流式解码音频"""
+import subprocess
+import tempfile
+from typing import Iterator
+
+from progress import hidden_startupinfo
+
+
+def ffmpeg_pcm_chunks(audio_path: str, rate: int = 16000, channels: int = 1,
+                      chunk_bytes: int = 32000, sample_format: str = 's16le') -> Iterator[bytes]:
+    """ 用 ffmpeg 将音频解码、重采样为 PCM，通过管道逐块读取，不生成临时文件
+
+        Args:
+            audio_path (str): 音频或视频路径
+            rate (int): 输出采样率
+            channels (int): 输出通道数
+            chunk_bytes (int): 每次读取的字节数
+            sample_format (str): 采样格式，'s16le'（int16）或 'f32le'（float32）
+
+        Yields:
+            data (bytes): PCM 数据块
+    """
+    command = ['ffmpeg', '-nostdin', '-v', 'error', '-i', audio_path,
+               '-f', sample_format, '-acodec', 'pcm_' + sample_format, '-ac', str(channels), '-ar', str(rate), '-']
+    startupinfo = hidden_startupinfo()
+    # 错误信息写入临时文件，避免 stderr 管道写满后 ffmpeg 阻塞
+    with tempfile.TemporaryFile() as error_file:
+        process = subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=error_file,
+                                   startupinfo=startupinfo)
+        try:
+            while True:
+                data = process.stdout.read(chunk_bytes)
+                if not data:
+                    break
+                yield data
+            if process.wait() != 0:
+                error_file.seek(0)
+                raise RuntimeError('ffmpeg解码失败：' + error_file.read().decode('utf-8', errors='replace'))
+        finally:
+            # 提前停止读取时结束 ffmpeg 进程
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+            process.stdout.close()
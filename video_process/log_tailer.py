@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Author: Wang Zifan
+
+"""增量读取日志文件"""
+# get_video/log_tailer.py 是本文件的副本：视频下载程序与本程序各自从自己的目录按模块名导入、
+# 各自打包，导入不到本目录的模块。修改时同步修改副本。
+import codecs
+import os
+from typing import List, Optional
+
+import chardet
+
+
+class LogTailer:
+    """ 日志文件的增量读取器
+
+        记住已读到的字节位置，每次只读取新追加的内容，编码只在第一次读到内容时检测一次（或使用指定的编码），
+        每次读取的开销只与新增内容有关，与日志总长度无关。回车（进度条刷新）和换行都作为行尾，
+        去除首尾空白后的空行忽略。
+
+        Author: Wang Zifan
+        Date: 2022/05/15
+
+        Attributes:
+            path (str): 日志文件路径
+            encoding (str): 日志编码，为 None 时用 chardet 检测第一次读到的内容
+            keyword (str): 关键字，记录包含该关键字的最后一行和行数
+    """
+
+    def __init__(self, path: str, encoding: Optional[str] = None, keyword: Optional[str] = None):
+        self.path = path
+        self.encoding = encoding
+        self.keyword = keyword
+        self.offset = 0
+        self.decoder = None
+        # 未遇到行尾的内容
+        self.pending = ''
+        # 第一行、最后一行和行数
+        self.first_line = ''
+        self.last_line = ''
+        self.line_count = 0
+        # 包含关键字的最后一行和行数
+        self.last_match = ''
+        self.match_count = 0
+
+    def exists(self) -> bool:
+        return os.path.isfile(self.path)
+
+    def reset(self):
+        """ 从头重新读取（文件被截断或重建时） """
+        self.__init__(self.path, self.encoding, self.keyword)
+
+    def poll(self, final: bool = False) -> List[str]:
+        """ 读取新追加的内容，返回其中新的完整行
+
+            Args:
+                final (bool): 写入日志的进程是否已经结束，为 True 时最后一行没有行尾也作为完整的一行
+        """
+        try:
+            size = os.path.getsize(self.path)
+        except OSError:
+            return []
+        if size < self.offset:
+            self.reset()
+        data = b''
+        if size > self.offset:
+            with open(self.path, 'rb') as f:
+                f.seek(self.offset)
+                data = f.read(size - self.offset)
+            self.offset += len(data)
+        if self.decoder is None:
+            if len(data) == 0:
+                return []
+            if self.encoding is None:
+                self.encoding = chardet.detect(data)['encoding'] or 'utf-8'
+            try:
+                self.decoder = codecs.getincrementaldecoder(self.encoding)(errors='replace')
+            except LookupError:
+                self.encoding = 'utf-8'
+                self.decoder = codecs.getincrementaldecoder(self.encoding)(errors='replace')
+        text = self.pending + self.decoder.decode(data, final=final)
+        lines = text.replace('\r\n', '\n').replace('\r', '\n').split('\n')
+        # 最后一段还没有行尾，留到下次
+        self.pending = '' if final else lines.pop()
+        new_lines = [line.strip() for line in lines if line.strip() != '']
+        for line in new_lines:
+            if self.line_count == 0:
+                self.first_line = line
+            self.last_line = line
+            self.line_count += 1
+            if self.keyword is not None and self.keyword in line:
+                self.last_match = line
+                self.match_count += 1
+        return new_lines
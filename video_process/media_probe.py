@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Author: Wang Zifan
+
+"""用 ffprobe 获取音视频信息"""
+import functools
+import json
+import os
+import subprocess
+
+from progress import hidden_startupinfo
+
+
+class MediaInfo:
+    """ 音视频文件信息
+
+        Attributes:
+            path (str): 文件路径
+            format_name (str): 容器格式，如 'mov,mp4,m4a,3gp,3g2,mj2'
+            duration (float): 总时长（秒）
+            streams (list): ffprobe 输出的所有流信息
+            video_codec (str): 第一个视频流的编码，没有视频流时为 None
+            audio_codec (str): 第一个音频流的编码，没有音频流时为 None
+            sample_rate (int): 第一个音频流的采样率，没有音频流时为 None
+            channels (int): 第一个音频流的通道数，没有音频流时为 None
+    """
+
+    def __init__(self, path: str, probe_result: dict):
+        self.path = path
+        media_format = probe_result.get('format', {})
+        self.format_name = media_format.get('format_name', '')
+        self.streams = probe_result.get('streams', [])
+        video_streams = [stream for stream in self.streams if stream.get('codec_type') == 'video']
+        audio_streams = [stream for stream in self.streams if stream.get('codec_type') == 'audio']
+        self.video_codec = video_streams[0].get('codec_name') if video_streams else None
+        self.audio_codec = audio_streams[0].get('codec_name') if audio_streams else None
+        self.sample_rate = int(audio_streams[0]['sample_rate']) if audio_streams else None
+        self.channels = int(audio_streams[0]['channels']) if audio_streams else None
+        # 容器没有时长时取各个流中最长的时长
+        durations = [float(media_format['duration'])] if 'duration' in media_format else \
+            [float(stream['duration']) for stream in self.streams if 'duration' in stream]
+        self.duration = max(durations) if durations else 0.0
+
+    @property
+    def has_video(self) -> bool:
+        return self.video_codec is not None
+
+    @property
+    def has_audio(self) -> bool:
+        return self.audio_codec is not None
+
+
+@functools.lru_cache(maxsize=128)
+def _probe_media(path: str, mtime_ns: int, size: int) -> MediaInfo:
+    # mtime_ns 和 size 只作为缓存的键，文件改变后重新获取
+    command = ['ffprobe', '-v', 'error', '-print_format', 'json', '-show_format', '-show_streams', path]
+    result = subprocess.run(command, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            startupinfo=hidden_startupinfo())
+    if result.returncode != 0:
+        raise RuntimeError('ffprobe获取信息失败：' + result.stderr.decode('utf-8', errors='replace'))
+    return MediaInfo(path, json.loads(result.stdout.decode('utf-8')))
+
+
+def probe_media(path: str) -> MediaInfo:
+    """ 获取音视频信息，同一文件（路径、修改时间和大小都不变）只调用一次 ffprobe
+
+        Args:
+            path (str): 音视频文件路径
+
+        Returns:
+            media_info (MediaInfo): 音视频信息
+    """
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    return _probe_media(path, stat.st_mtime_ns, stat.st_size)
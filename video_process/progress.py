@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Author: Wang Zifan
+
+"""子进程输出的逐行解析和进度事件发布"""
+# get_video/progress.py 是本文件的精简副本：视频下载程序与本程序各自从自己的目录按模块名导入、
+# 各自打包，导入不到本目录的模块。修改进度事件或子进程输出的逐行读取时同步修改副本。
+import locale
+import os
+import subprocess
+import threading
+import time
+from typing import Callable, Dict, IO, Iterator, List, Optional
+
+
+class ProgressEvent:
+    """ 进度事件
+
+        Attributes:
+            stage (str): 步骤名，如 'demux'、'separate'、'asr'、'download:1'
+            percent (float): 完成百分比，未知时为 None
+            eta (float): 预计剩余秒数，未知时为 None
+            message (str): 显示用的进度信息
+            state (str): 'running'、'done' 或 'failed'
+    """
+
+    def __init__(self, stage: str, percent: Optional[float] = None, eta: Optional[float] = None,
+                 message: str = '', state: str = 'running'):
+        self.stage = stage
+        self.percent = percent
+        self.eta = eta
+        self.message = message
+        self.state = state
+        self.time = time.time()
+
+    def __repr__(self):
+        return 'ProgressEvent({!r}, percent={}, eta={}, message={!r}, state={!r})'.format(
+            self.stage, self.percent, self.eta, self.message, self.state)
+
+
+class ProgressBus:
+    """ 进度事件总线，发布者发布事件，订阅者在发布线程中被同步回调
+
+        Author: Wang Zifan
+        Date: 2022/05/14
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscribers = []
+        # 每个步骤最新的事件
+        self.latest = {}
+
+    def subscribe(self, callback: Callable[[ProgressEvent], None]):
+        with self.lock:
+            self.subscribers.append(callback)
+
+    def unsubscribe(self, callback: Callable[[ProgressEvent], None]):
+        with self.lock:
+            if callback in self.subscribers:
+                self.subscribers.remove(callback)
+
+    def publish(self, event: ProgressEvent):
+        with self.lock:
+            self.latest[event.stage] = event
+            subscribers = list(self.subscribers)
+        for callback in subscribers:
+            callback(event)
+
+    def latest_events(self) -> Dict[str, ProgressEvent]:
+        with self.lock:
+            return dict(self.latest)
+
+
+class ProgressReporter:
+    """ 一个步骤的进度发布者，根据已用时间和完成百分比估计剩余时间
+
+        Attributes:
+            stage (str): 步骤名
+            bus (ProgressBus): 事件总线，为 None 时不发布
+    """
+
+    def __init__(self, stage: str, bus: Optional[ProgressBus] = None):
+        self.stage = stage
+        self.bus = bus
+        self.start_time = time.time()
+
+    def report(self, percent: Optional[float] = None, message: str = '', state: str = 'running') -> ProgressEvent:
+        eta = None
+        if percent is not None:
+            percent = min(max(percent, 0.0), 100.0)
+            elapsed = time.time() - self.start_time
+            if 0 < percent < 100:
+                eta = elapsed * (100 - percent) / percent
+            elif percent >= 100:
+                eta = 0.0
+        event = ProgressEvent(self.stage, percent, eta, message, state)
+        if self.bus is not None:
+            self.bus.publish(event)
+        return event
+
+
+def hidden_startupinfo():
+    """ windows下启动子进程时不弹出命令行窗口，其它系统返回 None """
+    if os.name != 'nt':
+        return None
+    startupinfo = subprocess.STARTUPINFO()
+    startupinfo.dwFlags = subprocess.STARTF_USESHOWWINDOW
+    startupinfo.wShowWindow = subprocess.SW_HIDE
+    return startupinfo
+
+
+def decode_line(data: bytes) -> str:
+    """ 解码一行输出：先按 utf-8，失败时按系统编码（如 windows 下的 gbk） """
+    try:
+        return data.decode('utf-8')
+    except UnicodeDecodeError:
+        return data.decode(locale.getpreferredencoding(False), errors='replace')
+
+
+def iter_output_lines(stream: IO[bytes]) -> Iterator[str]:
+    """ 逐行读取子进程输出，回车（进度条刷新）和换行都作为行尾，空行不产出
+
+        Args:
+            stream: 子进程的 stdout 或 stderr 管道
+
+        Yields:
+            line (str): 去除首尾空白的一行
+    """
+    pending = b''
+    while True:
+        data = stream.read1(65536) if hasattr(stream, 'read1') else stream.read(65536)
+        if not data:
+            break
+        pending += data.replace(b'\r\n', b'\n').replace(b'\r', b'\n')
+        lines = pending.split(b'\n')
+        pending = lines.pop()
+        for line in lines:
+            line = decode_line(line).strip()
+            if line != '':
+                yield line
+    line = decode_line(pending).strip()
+    if line != '':
+        yield line
+
+
+def run_with_output(command: List[str], on_line: Callable[[str], None], cwd: str = None) -> int:
+    """ 运行子进程，stdout 和 stderr 合并后通过管道逐行交给 on_line，不写日志文件
+
+        Args:
+            command (list): 命令
+            on_line (Callable): 每读到一行时调用
+            cwd (str): 工作目录
+
+        Returns:
+            returncode (int): 子进程返回值
+    """
+    process = subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                               cwd=cwd, startupinfo=hidden_startupinfo())
+    try:
+        for line in iter_output_lines(process.stdout):
+            on_line(line)
+        return process.wait()
+    finally:
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+        process.stdout.close()
+
+
+def ffmpeg_progress_seconds(line: str) -> Optional[float]:
+    """ 从 ffmpeg -progress 输出的一行（如 out_time_us=1234567）中取出已处理的秒数，不是进度行时返回 None """
+    key, _, value = line.partition('=')
+    # ffmpeg 的 out_time_ms 实际单位也是微秒
+    if key in ['out_time_us', 'out_time_ms'] and value.strip().lstrip('-').isdigit():
+        return max(int(value), 0) / 1000000
+    return None
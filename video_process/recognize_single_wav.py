@@ -1,11 +1,293 @@
+import functools
 import pickle
+from typing import List
 
 import chardet
-import yaml
+import numpy as np
 import torch
 import torchaudio
+from torch.nn.utils.rnn import pad_sequence
 from torchaudio.compliance import kaldi
-from wenet.transformer.asr_model import init_asr_model
+from wenet.utils.model_cache import global_model_cache
+
+
+@functools.lru_cache(maxsize=None)
+def load_char_dict(dict_path: str, dict_pickle_path: str, init_dict: bool = False) -> dict:
+    """ 加载词典（每个进程只加载一次）
+
+        Args:
+            dict_path (str): path of dict (txt file)
+            dict_pickle_path (str): path of dict pickle object
+            init_dict (bool): whether generate dict pickle object
+
+        Returns:
+            char_dict (dict): token id -> char
+    """
+    if init_dict:
+        # 初始化词典
+        char_dict = {}
+        # 获取文件编码格式
+        with open(dict_path, 'rb') as f:
+            text = f.read()
+            code = chardet.detect(text)['encoding']
+        with open(dict_path, 'r', encoding=code) as fin:
+            for line in fin:
+                arr = line.strip().split()
+                assert len(arr) == 2
+                char_dict[int(arr[1])] = arr[0]
+        with open(dict_pickle_path, "wb") as f:
+            pickle.dump(char_dict, f)
+    else:
+        # 加载词典
+        with open(dict_pickle_path, "rb") as f:
+            char_dict = pickle.load(f)
+    return char_dict
+
+
+def pcm_to_waveform(pcm: bytes, channels: int = 1) -> torch.Tensor:
+    """ 将 int16 PCM 数据转为 (channel, samples) 的 int16 幅度浮点张量
+
+        np.frombuffer 直接引用原缓冲区，只在转为浮点时复制一次
+    """
+    samples = np.frombuffer(pcm, dtype=np.int16).astype(np.float32)
+    return torch.from_numpy(samples).view(-1, channels).t()
+
+
+class SpeechRecognizer:
+    """ 语音识别器，模型和词典在进程内只加载一次，之后重复使用
+
+        Author: Wang Zifan
+        Date: 2022/05/09
+
+        Attributes:
+            参数与 recognize_single_wav 相同（不含 wav_path）
+    """
+
+    def __init__(
+            self,
+            model_path: str,
+            model_config_path: str,
+            cmvn_file: str,
+            dict_path: str,
+            dict_pickle_path: str,
+            init_dict: bool = False,
+            mode: str = "attention_rescoring",
+            ctc_weight: float = 0.5,
+            beam_size: int = 10,
+            decoding_chunk_size: int = -1,
+            num_decoding_left_chunks: int = -1,
+            simulate_streaming: bool = False,
+            reverse_weight: float = 0.0,
+            resample_rate: int = 16000
+    ):
+        self.mode = mode
+        self.ctc_weight = ctc_weight
+        self.beam_size = beam_size
+        self.decoding_chunk_size = decoding_chunk_size
+        self.num_decoding_left_chunks = num_decoding_left_chunks
+        self.simulate_streaming = simulate_streaming
+        self.reverse_weight = reverse_weight
+        self.resample_rate = resample_rate
+        self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        # 从缓存中获取模型（首次使用时加载）
+        self.model, configs = global_model_cache.get(model_path, model_config_path, cmvn_file, self.device)
+        self.feature_extraction_conf = configs['collate_conf']['feature_extraction_conf']
+        self.char_dict = load_char_dict(dict_path, dict_pickle_path, init_dict)
+        self.eos = len(self.char_dict) - 1
+
+    def compute_feats(self, waveform: torch.Tensor, sample_rate: int) -> torch.Tensor:
+        """ 提取fbank特征
+
+            Args:
+                waveform (torch.Tensor): (channel, samples), int16 scale
+                sample_rate (int): sample rate of waveform
+
+            Returns:
+                feats (torch.Tensor): (frames, mel_bins)
+        """
+        if self.resample_rate != sample_rate:
+            waveform = torchaudio.transforms.Resample(orig_freq=sample_rate, new_freq=self.resample_rate)(waveform)
+        return kaldi.fbank(
+            waveform,
+            num_mel_bins=self.feature_extraction_conf['mel_bins'],
+            frame_length=self.feature_extraction_conf['frame_length'],
+            frame_shift=self.feature_extraction_conf['frame_shift'],
+            dither=0.0,
+            energy_floor=0.0,
+            sample_frequency=self.resample_rate
+        )
+
+    def decode(self, feats: torch.Tensor) -> list:
+        """ 对单句特征解码
+
+            Args:
+                feats (torch.Tensor): (frames, mel_bins)
+
+            Returns:
+                predict (list): token id 序列
+        """
+        feats_lengths = torch.tensor(feats.size(0)).unsqueeze(0).to(self.device)
+        feats = feats.unsqueeze(0).to(self.device)
+        model = self.model
+        predict = []
+        with torch.no_grad():
+            if self.mode == 'attention_rescoring':
+                predict = model.attention_rescoring(
+                    feats,
+                    feats_lengths,
+                    self.beam_size,
+                    decoding_chunk_size=self.decoding_chunk_size,
+                    num_decoding_left_chunks=self.num_decoding_left_chunks,
+                    ctc_weight=self.ctc_weight,
+                    simulate_streaming=self.simulate_streaming,
+                    reverse_weight=self.reverse_weight
+                )
+            elif self.mode == 'attention':
+                predict = model.recognize(
+                    feats,
+                    feats_lengths,
+                    beam_size=self.beam_size,
+                    decoding_chunk_size=self.decoding_chunk_size,
+                    num_decoding_left_chunks=self.num_decoding_left_chunks,
+                    simulate_streaming=self.simulate_streaming
+                )
+                predict = predict[0].tolist()
+            elif self.mode == 'ctc_greedy_search':
+                predict = model.ctc_greedy_search(
+                    feats,
+                    feats_lengths,
+                    decoding_chunk_size=self.decoding_chunk_size,
+                    num_decoding_left_chunks=self.num_decoding_left_chunks,
+                    simulate_streaming=self.simulate_streaming
+                )
+                predict = predict[0]
+            elif self.mode == 'ctc_prefix_beam_search':
+                predict = model.ctc_prefix_beam_search(
+                    feats,
+                    feats_lengths,
+                    beam_size=self.beam_size,
+                    decoding_chunk_size=self.decoding_chunk_size,
+                    num_decoding_left_chunks=self.num_decoding_left_chunks,
+                    simulate_streaming=self.simulate_streaming
+                )
+        return predict
+
+    def decode_batch(self, feats_list: List[torch.Tensor]) -> List[list]:
+        """ 对多句特征补齐后一起解码，编码器对整批只前向一次
+
+            Args:
+                feats_list (List[torch.Tensor]): [(frames, mel_bins), ...]
+
+            Returns:
+                predicts (List[list]): 每句的 token id 序列，顺序与输入相同
+        """
+        # 流式模拟的编码器只支持 batch_size=1，逐句解码
+        if self.simulate_streaming and self.decoding_chunk_size > 0:
+            return [self.decode(feats) for feats in feats_list]
+        feats_lengths = torch.tensor([feats.size(0) for feats in feats_list], dtype=torch.long).to(self.device)
+        feats = pad_sequence(feats_list, batch_first=True, padding_value=0.0).to(self.device)
+        model = self.model
+        with torch.no_grad():
+            if self.mode == 'attention':
+                predicts = model.recognize(
+                    feats,
+                    feats_lengths,
+                    beam_size=self.beam_size,
+                    decoding_chunk_size=self.decoding_chunk_size,
+                    num_decoding_left_chunks=self.num_decoding_left_chunks
+                )
+                return [predict.tolist() for predict in predicts]
+            if self.mode == 'ctc_greedy_search':
+                return model.ctc_greedy_search(
+                    feats,
+                    feats_lengths,
+                    decoding_chunk_size=self.decoding_chunk_size,
+                    num_decoding_left_chunks=self.num_decoding_left_chunks
+                )
+            # ctc_prefix_beam_search 和 attention_rescoring：编码器整批前向，搜索逐句进行，
+            # 整批的 nbest 在一次解码器前向中重打分
+            if self.mode == 'ctc_prefix_beam_search':
+                return model.ctc_prefix_beam_search_batch(
+                    feats,
+                    feats_lengths,
+                    self.beam_size,
+                    decoding_chunk_size=self.decoding_chunk_size,
+                    num_decoding_left_chunks=self.num_decoding_left_chunks
+                )
+            return model.attention_rescoring_batch(
+                feats,
+                feats_lengths,
+                self.beam_size,
+                decoding_chunk_size=self.decoding_chunk_size,
+                num_decoding_left_chunks=self.num_decoding_left_chunks,
+                ctc_weight=self.ctc_weight,
+                reverse_weight=self.reverse_weight
+            )
+
+    def tokens_to_text(self, predict: list) -> str:
+        # 将token序列转为字序列
+        sentence_text = ''
+        for w in predict:
+            if w == self.eos:
+                break
+            sentence_text += self.char_dict[w]
+        return sentence_text
+
+    def recognize_waveform(self, waveform: torch.Tensor, sample_rate: int) -> str:
+        """ 识别一段音频数据
+
+            Args:
+                waveform (torch.Tensor): (channel, samples), int16 scale
+                sample_rate (int): sample rate of waveform
+
+            Returns:
+                sentence_text (str): result of audio recognition
+        """
+        feats = self.compute_feats(waveform, sample_rate)
+        return self.tokens_to_text(self.decode(feats))
+
+    def recognize_pcm(self, pcm: bytes, sample_rate: int, channels: int = 1) -> str:
+        """ 识别内存中的 int16 PCM 数据，不经过临时文件
+
+            Args:
+                pcm (bytes): int16 PCM data (bytes, bytearray or memoryview)
+                sample_rate (int): sample rate of pcm
+                channels (int): number of interleaved channels
+
+            Returns:
+                sentence_text (str): result of audio recognition
+        """
+        return self.recognize_waveform(pcm_to_waveform(pcm, channels), sample_rate)
+
+    def recognize_batch(self, segments: List[torch.Tensor], sample_rate: int = 16000, batch_size: int = 8) -> List[str]:
+        """ 批量识别多段音频
+
+            各段先按特征长度排序再分桶，每桶补齐后一起解码，减少补齐的无效计算
+
+            Args:
+                segments (List[torch.Tensor]): [(channel, samples), ...], int16 scale
+                sample_rate (int): sample rate of segments
+                batch_size (int): max number of segments decoded together
+
+            Returns:
+                texts (List[str]): 每段的识别结果，顺序与输入相同
+        """
+        feats_list = [self.compute_feats(waveform, sample_rate) for waveform in segments]
+        # 按长度排序，使同一批内长度相近
+        order = sorted(range(len(feats_list)), key=lambda i: feats_list[i].size(0))
+        texts = [''] * len(feats_list)
+        for start in range(0, len(order), batch_size):
+            bucket = order[start:start + batch_size]
+            predicts = self.decode_batch([feats_list[i] for i in bucket])
+            for i, predict in zip(bucket, predicts):
+                texts[i] = self.tokens_to_text(predict)
+        return texts
+
+    def recognize_wav(self, wav_path: str) -> str:
+        # 读取和转换音频
+        waveform, sample_rate = torchaudio.load(wav_path)
+        waveform = waveform * (1 << 15)
+        return self.recognize_waveform(waveform, sample_rate)
 
 
 def recognize_single_wav(
@@ -52,111 +334,19 @@ def recognize_single_wav(
         Returns:
             sentence_text (str): result of audio recognition
     """
-    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-
-    # 加载配置文件
-    with open(model_config_path, 'r') as fin:
-        configs = yaml.load(fin, Loader=yaml.FullLoader)
-    configs['cmvn_file'] = cmvn_file
-    feature_extraction_conf = configs['collate_conf']['feature_extraction_conf']
-
-    # 读取和转换音频
-    waveform, sample_rate = torchaudio.load(wav_path)
-    waveform = waveform * (1 << 15)
-    if resample_rate != sample_rate:
-        waveform = torchaudio.transforms.Resample(orig_freq=sample_rate, new_freq=resample_rate)(waveform)
-
-    # 提取特征
-    feats = kaldi.fbank(
-        waveform,
-        num_mel_bins=feature_extraction_conf['mel_bins'],
-        frame_length=feature_extraction_conf['frame_length'],
-        frame_shift=feature_extraction_conf['frame_shift'],
-        dither=0.0,
-        energy_floor=0.0,
-        sample_frequency=resample_rate
+    # 模型和词典由缓存提供，多次调用不会重复加载
+    recognizer = SpeechRecognizer(
+        model_path, model_config_path, cmvn_file, dict_path, dict_pickle_path, init_dict,
+        mode=mode,
+        ctc_weight=ctc_weight,
+        beam_size=beam_size,
+        decoding_chunk_size=decoding_chunk_size,
+        num_decoding_left_chunks=num_decoding_left_chunks,
+        simulate_streaming=simulate_streaming,
+        reverse_weight=reverse_weight,
+        resample_rate=resample_rate
     )
-    feats_lengths = torch.tensor(feats.size(0)).unsqueeze(0)
-    feats = feats.unsqueeze(0)
-    feats_lengths = feats_lengths.to(device)
-    feats = feats.to(device)
-
-    # 初始化模型
-    model = init_asr_model(configs)
-    model.load_state_dict(torch.load(model_path))
-    model.to(device)
-    model.eval()
-
-    if init_dict:
-        # 初始化词典
-        char_dict = {}
-        # 获取文件编码格式
-        with open(dict_path, 'rb') as f:
-            text = f.read()
-            code = chardet.detect(text)['encoding']
-        with open(dict_path, 'r', encoding=code) as fin:
-            for line in fin:
-                arr = line.strip().split()
-                assert len(arr) == 2
-                char_dict[int(arr[1])] = arr[0]
-        with open(dict_pickle_path, "wb") as f:
-            pickle.dump(char_dict, f)
-    else:
-        # 加载词典
-        with open(dict_pickle_path, "rb") as f:
-            char_dict = pickle.load(f)
-    eos = len(char_dict) - 1
-
-    # 语音识别
-    predict = []
-    with torch.no_grad():
-        if mode == 'attention_rescoring':
-            predict = model.attention_rescoring(
-                feats,
-                feats_lengths,
-                beam_size,
-                decoding_chunk_size=decoding_chunk_size,
-                num_decoding_left_chunks=num_decoding_left_chunks,
-                ctc_weight=ctc_weight,
-                simulate_streaming=simulate_streaming,
-                reverse_weight=reverse_weight
-            )
-        elif mode == 'attention':
-            predict = model.recognize(
-                feats,
-                feats_lengths,
-                beam_size=beam_size,
-                decoding_chunk_size=decoding_chunk_size,
-                num_decoding_left_chunks=num_decoding_left_chunks,
-                simulate_streaming=simulate_streaming
-            )
-            predict = predict[0].tolist()
-        elif mode == 'ctc_greedy_search':
-            predict = model.ctc_greedy_search(
-                feats,
-                feats_lengths,
-                decoding_chunk_size=decoding_chunk_size,
-                num_decoding_left_chunks=num_decoding_left_chunks,
-                simulate_streaming=simulate_streaming
-            )
-            predict = predict[0]
-        elif mode == 'ctc_prefix_beam_search':
-            predict = model.ctc_prefix_beam_search(
-                feats,
-                feats_lengths,
-                beam_size=beam_size,
-                decoding_chunk_size=decoding_chunk_size,
-                num_decoding_left_chunks=num_decoding_left_chunks,
-                simulate_streaming=simulate_streaming
-            )
-    # 将token序列转为字序列
-    sentence_text = ''
-    for w in predict:
-        if w == eos:
-            break
-        sentence_text += char_dict[w]
-    # 返回识别结果
-    return sentence_text
+    return recognizer.recognize_wav(wav_path)
 
 # kwargs = {
 #     'model_path': '../exp/final.pt',
@@ -0,0 +1,434 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Author: Wang Zifan
+
+"""进程内的语音分离引擎，模型只加载一次"""
+import collections
+import math
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import wave
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterable, Iterator
+
+import numpy as np
+
+from audio_stream import ffmpeg_pcm_chunks
+
+
+class SeparationEngine:
+    """ 语音分离引擎
+
+        在进程内用 spleeter 的 python 接口分离人声和伴奏。tensorflow 的导入和模型加载只在第一次分离时进行一次，
+        之后可以连续分离多个文件（或音频块），省去每次调用 spleeter 命令行的启动开销。
+        分离结果可以直接在内存中交给语音识别，也可以写成与命令行相同的 <output_dir>/<音频名>/<声部>.wav。
+
+        Author: Wang Zifan
+        Date: 2022/05/12
+
+        Attributes:
+            params_descriptor (str): spleeter 模型，如 'spleeter:2stems'
+            sample_rate (int): 分离时使用的采样率，spleeter 模型为 44100
+    """
+
+    def __init__(self, params_descriptor: str = 'spleeter:2stems', sample_rate: int = 44100):
+        self.params_descriptor = params_descriptor
+        self.sample_rate = sample_rate
+        self.separator = None
+        self.audio_adapter = None
+        # tensorflow 的预测不能在多个线程中同时进行
+        self.lock = threading.Lock()
+        # 模型加载耗时（秒）
+        self.load_time = 0.0
+
+    def load(self):
+        """ 导入 spleeter 并加载模型（已加载时直接返回） """
+        if self.separator is not None:
+            return
+        start = time.time()
+        from spleeter.audio.adapter import AudioAdapter
+        from spleeter.separator import Separator
+
+        # 在本进程内分离，不再另开进程
+        self.separator = Separator(self.params_descriptor, multiprocess=False)
+        self.audio_adapter = AudioAdapter.default()
+        # 分离一小段静音，提前构建预测图和加载模型参数
+        self.separator.separate(np.zeros((self.sample_rate, 2), dtype=np.float32))
+        self.load_time = time.time() - start
+
+    def separate(self, waveform: np.ndarray) -> Dict[str, np.ndarray]:
+        """ 分离内存中的音频
+
+            Args:
+                waveform (np.ndarray): (采样点数, 通道数) 的 float32 音频，采样率为 sample_rate
+
+            Returns:
+                stems (dict): 声部名（如 'vocals'、'accompaniment'） -> (采样点数, 2) 的 float32 音频
+        """
+        with self.lock:
+            self.load()
+            return self.separator.separate(waveform)
+
+    def load_audio(self, audio_path: str) -> np.ndarray:
+        """ 读取音频并重采样为 sample_rate，返回 (采样点数, 通道数) 的 float32 音频 """
+        with self.lock:
+            self.load()
+            waveform, _ = self.audio_adapter.load(audio_path, sample_rate=self.sample_rate)
+        return waveform
+
+    def save_stems(self, stems: Dict[str, np.ndarray], audio_path: str, output_dir: str) -> Dict[str, str]:
+        """ 将分离结果写入 <output_dir>/<音频名>/<声部>.wav，返回 声部名 -> 文件路径 """
+        base_name = '.'.join(os.path.basename(audio_path).split('.')[0:-1])
+        stem_dir = os.path.join(output_dir, base_name)
+        if not os.path.exists(stem_dir):
+            os.makedirs(stem_dir)
+        stem_paths = {}
+        for name, data in stems.items():
+            stem_paths[name] = os.path.join(stem_dir, name + '.wav')
+            self.audio_adapter.save(stem_paths[name], data, self.sample_rate, 'wav')
+        return stem_paths
+
+    def separate_file(self, audio_path: str, output_dir: str = None) -> Dict[str, np.ndarray]:
+        """ 分离音频文件
+
+            Args:
+                audio_path (str): 音频路径
+                output_dir (str): 不为 None 时同时写入 <output_dir>/<音频名>/<声部>.wav
+
+            Returns:
+                stems (dict): 声部名 -> (采样点数, 2) 的 float32 音频
+        """
+        stems = self.separate(self.load_audio(audio_path))
+        if output_dir is not None:
+            self.save_stems(stems, audio_path, output_dir)
+        return stems
+
+    def separate_stream(self, blocks: Iterable[np.ndarray], window_samples: int,
+                        overlap_samples: int) -> Iterator[Dict[str, np.ndarray]]:
+        """ 分窗分离音频流，相邻窗口重叠 overlap_samples 个采样点，重叠部分线性交叉淡化后拼接
+
+            内存中最多保存一个窗口的输入和输出，与音频总长度无关。产出的各块首尾相接，总长度与输入相同。
+
+            Args:
+                blocks (Iterable[np.ndarray]): (采样点数, 2) 的 float32 音频块，长度任意
+                window_samples (int): 每个窗口的采样点数
+                overlap_samples (int): 相邻窗口重叠的采样点数，需小于 window_samples
+
+            Yields:
+                stems (dict): 声部名 -> 这一块分离结果
+        """
+        assert 0 <= overlap_samples < window_samples
+        # 淡入权重，淡出权重为 1 - fade_in
+        fade_in = np.linspace(0.0, 1.0, overlap_samples, dtype=np.float32)[:, np.newaxis]
+        buffer = np.zeros((0, 2), dtype=np.float32)
+        # 上一个窗口末尾与下一个窗口重叠、还没有产出的部分
+        tails = None
+
+        def windows() -> Iterator[np.ndarray]:
+            nonlocal buffer
+            num_windows = 0
+            for block in blocks:
+                buffer = np.concatenate([buffer, block])
+                while len(buffer) >= window_samples:
+                    yield buffer[:window_samples]
+                    num_windows += 1
+                    buffer = buffer[window_samples - overlap_samples:]
+            # 剩余的数据：buffer 的前 overlap_samples 个采样点已经分离过，只有超出的部分需要再分离一次
+            if len(buffer) > (overlap_samples if num_windows > 0 else 0):
+                yield buffer
+
+        for stems in self.map_windows(windows()):
+            if tails is not None and overlap_samples > 0:
+                for name, data in stems.items():
+                    data[:overlap_samples] = tails[name] * (1.0 - fade_in) + data[:overlap_samples] * fade_in
+            tails = None
+            # 完整的窗口之后还有下一个窗口（不足一个窗口的只能是最后一个），末尾的重叠部分留到下一块中淡化
+            if len(next(iter(stems.values()))) == window_samples and overlap_samples > 0:
+                tails = {name: data[-overlap_samples:] for name, data in stems.items()}
+                stems = {name: data[:-overlap_samples] for name, data in stems.items()}
+            yield stems
+        # 最后一个窗口之后没有新的数据，重叠部分直接产出
+        if tails is not None:
+            yield tails
+
+    def map_windows(self, windows: Iterable[np.ndarray]) -> Iterator[Dict[str, np.ndarray]]:
+        """ 依次分离各个窗口，按输入顺序产出结果 """
+        for waveform in windows:
+            yield self.separate(waveform)
+
+    def separate_file_chunked(self, audio_path: str, output_dir: str = None, window_seconds: float = 30.0,
+                              overlap_seconds: float = 1.0) -> Iterator[Dict[str, np.ndarray]]:
+        """ 分窗分离音频文件，边解码边分离，每完成一块就产出，峰值内存与音频长度无关
+
+            Args:
+                audio_path (str): 音频路径
+                output_dir (str): 不为 None 时同时将各声部逐块写入 <output_dir>/<音频名>/<声部>.wav
+                window_seconds (float): 窗口长度（秒）
+                overlap_seconds (float): 相邻窗口重叠的长度（秒）
+
+            Yields:
+                stems (dict): 声部名 -> 这一块 (采样点数, 2) 的 float32 分离结果
+        """
+        frame_bytes = 2 * 4
+        # ffmpeg 解码为 float32 双通道，每次读取1秒
+        chunks = ffmpeg_pcm_chunks(audio_path, self.sample_rate, 2, self.sample_rate * frame_bytes, 'f32le')
+        blocks = (np.frombuffer(data[:len(data) - len(data) % frame_bytes], dtype=np.float32).reshape(-1, 2)
+                  for data in chunks)
+        writers = {}
+        try:
+            for stems in self.separate_stream(blocks, int(window_seconds * self.sample_rate),
+                                              int(overlap_seconds * self.sample_rate)):
+                if output_dir is not None:
+                    self.write_stems(writers, stems, audio_path, output_dir)
+                yield stems
+        finally:
+            for writer in writers.values():
+                writer.close()
+
+    def write_stems(self, writers: dict, stems: Dict[str, np.ndarray], audio_path: str, output_dir: str):
+        """ 将一块分离结果追加到 <output_dir>/<音频名>/<声部>.wav（int16 双通道），writers 为 声部名 -> 已打开的文件 """
+        base_name = '.'.join(os.path.basename(audio_path).split('.')[0:-1])
+        stem_dir = os.path.join(output_dir, base_name)
+        for name, data in stems.items():
+            if name not in writers:
+                if not os.path.exists(stem_dir):
+                    os.makedirs(stem_dir)
+                writers[name] = wave.open(os.path.join(stem_dir, name + '.wav'), 'wb')
+                writers[name].setnchannels(2)
+                writers[name].setsampwidth(2)
+                writers[name].setframerate(self.sample_rate)
+            writers[name].writeframes((np.clip(data, -1.0, 1.0) * 32767).astype(np.int16).tobytes())
+
+
+# 分离工作进程中的引擎
+_worker_engine = None
+
+
+def _init_separation_worker(params_descriptor: str, sample_rate: int, threads_per_worker: int):
+    """ 分离工作进程初始化：限制 tensorflow 的线程数，并加载模型 """
+    global _worker_engine
+    if threads_per_worker > 0:
+        # 需在导入 tensorflow 之前设置
+        os.environ['TF_NUM_INTRAOP_THREADS'] = str(threads_per_worker)
+        os.environ['TF_NUM_INTEROP_THREADS'] = '1'
+        os.environ['OMP_NUM_THREADS'] = str(threads_per_worker)
+    _worker_engine = SeparationEngine(params_descriptor, sample_rate)
+    _worker_engine.load()
+
+
+def _separate_in_worker(waveform: np.ndarray) -> Dict[str, np.ndarray]:
+    return _worker_engine.separate(waveform)
+
+
+class ParallelSeparationEngine(SeparationEngine):
+    """ 多进程语音分离引擎
+
+        分窗分离时将各个窗口分发给进程池中的 num_workers 个工作进程（每个进程加载一次模型），
+        按原顺序取回结果后交叉淡化拼接，一个长视频的语音分离也能用满所有cpu核。
+        同时在分离中的窗口最多为 2 * num_workers 个，内存占用与音频长度无关。
+
+        Author: Wang Zifan
+        Date: 2022/05/13
+
+        Attributes:
+            num_workers (int): 工作进程数
+            threads_per_worker (int): 每个工作进程 tensorflow 的计算线程数，为0时不限制
+            params_descriptor (str): spleeter 模型，如 'spleeter:2stems'
+            sample_rate (int): 分离时使用的采样率，spleeter 模型为 44100
+    """
+
+    def __init__(self, num_workers: int, threads_per_worker: int = 0, params_descriptor: str = 'spleeter:2stems',
+                 sample_rate: int = 44100):
+        super(ParallelSeparationEngine, self).__init__(params_descriptor, sample_rate)
+        self.num_workers = num_workers
+        self.threads_per_worker = threads_per_worker
+        self.executor = None
+
+    def load(self):
+        """ 启动进程池，模型在各个工作进程中加载 """
+        if self.executor is not None:
+            return
+        start = time.time()
+        self.executor = ProcessPoolExecutor(max_workers=self.num_workers, initializer=_init_separation_worker,
+                                            initargs=(self.params_descriptor, self.sample_rate,
+                                                      self.threads_per_worker))
+        # 每个工作进程先分离一小段静音，等待模型全部加载完成
+        warm_up = [self.executor.submit(_separate_in_worker, np.zeros((self.sample_rate, 2), dtype=np.float32))
+                   for _ in range(self.num_workers)]
+        for future in warm_up:
+            future.result()
+        self.load_time = time.time() - start
+
+    def close(self):
+        """ 关闭进程池 """
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    def separate(self, waveform: np.ndarray) -> Dict[str, np.ndarray]:
+        with self.lock:
+            self.load()
+        return self.executor.submit(_separate_in_worker, waveform).result()
+
+    def map_windows(self, windows: Iterable[np.ndarray]) -> Iterator[Dict[str, np.ndarray]]:
+        """ 将窗口分发给工作进程并行分离，按输入顺序产出结果 """
+        with self.lock:
+            self.load()
+        futures = collections.deque()
+        for waveform in windows:
+            futures.append(self.executor.submit(_separate_in_worker, waveform))
+            # 限制同时在分离中的窗口数，先完成的结果按顺序产出
+            if len(futures) >= 2 * self.num_workers:
+                yield futures.popleft().result()
+        while len(futures) > 0:
+            yield futures.popleft().result()
+
+    def load_audio(self, audio_path: str) -> np.ndarray:
+        """ 用 ffmpeg 读取音频，本进程不导入 tensorflow """
+        frame_bytes = 2 * 4
+        data = b''.join(ffmpeg_pcm_chunks(audio_path, self.sample_rate, 2, 1 << 20, 'f32le'))
+        return np.frombuffer(data[:len(data) - len(data) % frame_bytes], dtype=np.float32).reshape(-1, 2)
+
+    def save_stems(self, stems: Dict[str, np.ndarray], audio_path: str, output_dir: str) -> Dict[str, str]:
+        writers = {}
+        try:
+            self.write_stems(writers, stems, audio_path, output_dir)
+        finally:
+            for writer in writers.values():
+                writer.close()
+        base_name = '.'.join(os.path.basename(audio_path).split('.')[0:-1])
+        return {name: os.path.join(output_dir, base_name, name + '.wav') for name in stems}
+
+
+# 每个进程的分离引擎，按 (工作进程数, 每个进程的线程数) 区分
+_engines = {}
+_engine_lock = threading.Lock()
+
+
+def get_separation_engine(num_workers: int = 1, threads_per_worker: int = 0) -> SeparationEngine:
+    """ 获取本进程的分离引擎（第一次调用时创建，模型在第一次分离时加载）
+
+        Args:
+            num_workers (int): 大于1时使用多进程分离引擎，分窗分离时各窗口并行
+            threads_per_worker (int): 多进程时每个工作进程 tensorflow 的计算线程数，为0时不限制
+    """
+    key = (num_workers, threads_per_worker) if num_workers > 1 else (1, 0)
+    with _engine_lock:
+        if key not in _engines:
+            _engines[key] = ParallelSeparationEngine(num_workers, threads_per_worker) if num_workers > 1 \
+                else SeparationEngine()
+        return _engines[key]
+
+
+def waveform_pcm_chunks(waveforms, sample_rate: int, rate: int = 16000,
+                        chunk_bytes: int = 32000) -> Iterator[bytes]:
+    """ 将分离出的音频转为单通道、重采样后的 int16 PCM 数据块，供语音切分和识别使用
+
+        流式分离时音频分多块到达，重采样器的状态在块之间延续：每块只输出右侧上下文已经到达的采样点，
+        并保留左侧上下文，输出与整段音频一次重采样相同，块的交界处没有接缝，总长度也不会因逐块取整而偏移。
+
+        Args:
+            waveforms (np.ndarray or Iterable[np.ndarray]): (采样点数, 通道数) 的 float32 音频，或依次到达的多块音频
+            sample_rate (int): waveform 的采样率
+            rate (int): 输出采样率
+            chunk_bytes (int): 每块的字节数
+
+        Yields:
+            data (bytes): int16 PCM 数据块
+    """
+    import torch
+    import torchaudio
+
+    if isinstance(waveforms, np.ndarray):
+        waveforms = [waveforms]
+    resample = torchaudio.transforms.Resample(orig_freq=sample_rate, new_freq=rate) if sample_rate != rate else None
+    if resample is not None:
+        # 约分后每 orig 个输入采样点对应 new 个输出采样点（一个周期），第 b 个周期的输出
+        # 用到输入的 [b * orig - width, b * orig + width + orig)
+        gcd = math.gcd(sample_rate, rate)
+        orig, new, width = sample_rate // gcd, rate // gcd, resample.width
+        context_periods = -(-width // orig)
+    # 还没有输出的输入（含左侧上下文），从第 offset 个周期开始
+    pending = torch.zeros(0)
+    offset = 0
+    # 下一个要输出的周期
+    next_period = 0
+    pcm = b''
+
+    def to_pcm(samples: torch.Tensor) -> bytes:
+        return (samples.clamp(-1.0, 1.0) * 32767).to(torch.int16).numpy().tobytes()
+
+    for waveform in waveforms:
+        mono = torch.from_numpy(np.ascontiguousarray(waveform.mean(axis=1), dtype=np.float32))
+        if resample is None:
+            pcm += to_pcm(mono)
+        else:
+            pending = torch.cat([pending, mono])
+            # 右侧上下文已经到达的周期
+            ready_end = (offset * orig + len(pending) - width - orig) // orig + 1
+            if ready_end > next_period:
+                output = resample(pending.unsqueeze(0)).squeeze(0)
+                pcm += to_pcm(output[(next_period - offset) * new:(ready_end - offset) * new])
+                next_period = ready_end
+                # 只保留下一个周期的左侧上下文
+                new_offset = max(next_period - context_periods, 0)
+                pending = pending[(new_offset - offset) * orig:]
+                offset = new_offset
+        # 凑满的数据块输出，不足一块的留到下一次
+        full = len(pcm) - len(pcm) % chunk_bytes
+        for i in range(0, full, chunk_bytes):
+            yield pcm[i:i + chunk_bytes]
+        pcm = pcm[full:]
+    if resample is not None and len(pending) > 0:
+        # 音频结束，右侧补零，剩余的周期全部输出
+        output = resample(pending.unsqueeze(0)).squeeze(0)
+        pcm += to_pcm(output[(next_period - offset) * new:])
+    for i in range(0, len(pcm), chunk_bytes):
+        yield pcm[i:i + chunk_bytes]
+
+
+def benchmark_separation(audio_path: str, repeats: int = 3, num_workers: int = 1, threads_per_worker: int = 0):
+    """ 比较每次调用 spleeter 命令行和常驻引擎分离同一音频的速度（每分钟音频耗时多少秒）
+
+        Args:
+            audio_path (str): 音频路径
+            repeats (int): 每种方式重复的次数
+            num_workers (int): 大于1时再测试多进程分窗分离的速度
+            threads_per_worker (int): 多进程时每个工作进程的计算线程数
+    """
+    engine = get_separation_engine()
+    waveform = engine.load_audio(audio_path)
+    audio_minutes = waveform.shape[0] / engine.sample_rate / 60
+    with tempfile.TemporaryDirectory() as output_dir:
+        start = time.time()
+        for _ in range(repeats):
+            subprocess.run(['spleeter', 'separate', '-p', engine.params_descriptor, '-o', output_dir, audio_path],
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        cli_time = (time.time() - start) / repeats
+    start = time.time()
+    for _ in range(repeats):
+        engine.separate(waveform)
+    engine_time = (time.time() - start) / repeats
+    print('audio: {:.2f} min, model load: {:.2f} s'.format(audio_minutes, engine.load_time))
+    print('cold cli: {:.2f} s per audio minute'.format(cli_time / audio_minutes))
+    print('warm engine: {:.2f} s per audio minute'.format(engine_time / audio_minutes))
+    if num_workers > 1:
+        parallel_engine = get_separation_engine(num_workers, threads_per_worker)
+        parallel_engine.load()
+        start = time.time()
+        for _ in range(repeats):
+            for _ in parallel_engine.separate_stream([waveform], 30 * engine.sample_rate, engine.sample_rate):
+                pass
+        parallel_time = (time.time() - start) / repeats
+        print('warm engine, {} workers x {} threads, 30 s windows: {:.2f} s per audio minute'.format(
+            num_workers, threads_per_worker, parallel_time / audio_minutes))
+        parallel_engine.close()
+
+
+if __name__ == '__main__':
+    benchmark_separation(sys.argv[1], num_workers=int(sys.argv[2]) if len(sys.argv) > 2 else 1,
+                         threads_per_worker=int(sys.argv[3]) if len(sys.argv) > 3 else 0)
@@ -3,213 +3,331 @@
 # Author: Wang Zifan
 
 """切分和识别音频"""
+import multiprocessing
+import multiprocessing.queues
 import os
+import queue
 import threading
 import time
+import traceback
 import wave
-import webrtcvad
+from typing import Iterable
+
 import sox
 
-from recognize_single_wav import recognize_single_wav
+from audio_stream import ffmpeg_pcm_chunks
+from recognize_single_wav import SpeechRecognizer, pcm_to_waveform
+from vad_segmenter import VadSegmenter
+
+
+def recognize_segments(segment_queue, result_queue, recognizer: SpeechRecognizer, batch_size: int = 1):
+    """ 识别工作者循环：从 segment_queue 取语音段，识别后将 (序号, 文本) 放入 result_queue，取到 None 时退出
+
+        Args:
+            segment_queue: 语音段队列，元素为 (序号, PCM 数据, 采样率, 通道数) 或 None
+            result_queue: 识别结果队列，元素为 (序号, 文本)，识别失败的语音段文本为 None；
+                工作者本身出错（如模型加载失败）时放入 (None, 错误信息)
+            recognizer (SpeechRecognizer): 语音识别器
+            batch_size (int): 一次最多取出并批量识别的语音段数
+    """
+    finished = False
+    while not finished:
+        # 阻塞取一段，再尽量多取几段凑成一批
+        batch = [segment_queue.get()]
+        while batch[-1] is not None and len(batch) < batch_size:
+            try:
+                batch.append(segment_queue.get_nowait())
+            except queue.Empty:
+                break
+        if batch[-1] is None:
+            finished = True
+            batch = batch[:-1]
+        if len(batch) == 0:
+            continue
+        try:
+            if len(batch) == 1:
+                _, pcm, rate, channels = batch[0]
+                texts = [recognizer.recognize_pcm(pcm, rate, channels)]
+            else:
+                # 同一段音频切分出的语音段采样率和通道数都相同
+                _, _, rate, channels = batch[0]
+                waveforms = [pcm_to_waveform(pcm, channels) for _, pcm, _, _ in batch]
+                texts = recognizer.recognize_batch(waveforms, rate, batch_size)
+        except Exception:
+            # 识别失败的语音段也放入结果（文本为 None），保证结果序号连续，主线程不会一直等待，
+            # 同时能与识别结果为空（静音）区分开
+            traceback.print_exc()
+            texts = [None] * len(batch)
+        for (index, _, _, _), text in zip(batch, texts):
+            result_queue.put((index, text))
+
+
+def recognize_segments_process(segment_queue, result_queue, kwargs: dict, batch_size: int = 1):
+    """ 识别工作者进程入口，每个进程持有自己的模型，模型加载失败时将错误信息放入 result_queue 后退出 """
+    try:
+        recognizer = SpeechRecognizer(**kwargs)
+    except Exception:
+        traceback.print_exc()
+        result_queue.put((None, traceback.format_exc()))
+        return
+    recognize_segments(segment_queue, result_queue, recognizer, batch_size)
 
 
 class SplitAndRecognizeAudioMainThread(threading.Thread):
     """ 语音切分和识别主线程
 
+        切分（VAD）和识别并行进行：切分出的语音段放入有界队列，由 num_workers 个识别工作者取出识别，
+        队列满时切分阻塞等待；识别结果按语音段序号重新排序后依次放入 asr_result。
+        等待队列和结果时定时检查工作者是否还在运行，工作者出错或全部退出时结束并记录错误（error），不会一直等待
+
         Author: Wang Zifan
         Date: 2022/05/09
 
         Attributes:
             thread_id (str): 线程id
             wav_path (str): 音频路径
+            dump_segments (bool): 调试用，是否将切分出的每段语音保存为 _NNNN.wav 文件
+            num_workers (int): 识别工作者数量
+            worker_type (str): 识别工作者类型
+                'thread': 线程，所有线程共用一个模型
+                'process': 进程，每个进程加载一个模型
+            queue_size (int): 语音段队列长度，队列满时切分阻塞
+            batch_size (int): 每个工作者一次最多批量识别的语音段数
+            subtitle_writers (list): 字幕写入器（SubtitleWriter），每识别完一句就追加一条字幕
+            audio_decoder (str): 音频重采样方式
+                'sox': 用sox转为16k单通道的临时wav文件后读取
+                'ffmpeg': 用ffmpeg解码重采样，通过管道直接交给切分器，不生成临时文件
+            pcm_chunks (Iterable[bytes]): 已经是16k单通道int16的PCM数据块（如内存中的语音分离结果），
+                给出时直接切分，不再读取 wav_path（wav_path 只用于命名切分出的语音段）
             kwargs (str): 语音识别参数
     """
 
-    def __init__(self, thread_id: str, wav_path: str, **kwargs):
+    def __init__(self, thread_id: str, wav_path: str, dump_segments: bool = False, num_workers: int = 1,
+                 worker_type: str = 'thread', queue_size: int = 16, batch_size: int = 1,
+                 subtitle_writers: list = None, audio_decoder: str = 'sox', pcm_chunks: Iterable[bytes] = None,
+                 **kwargs):
         super(SplitAndRecognizeAudioMainThread, self).__init__()
+        assert worker_type in ['thread', 'process']
+        assert audio_decoder in ['sox', 'ffmpeg']
         self.wav_path = wav_path
+        self.dump_segments = dump_segments
+        self.num_workers = num_workers
+        self.worker_type = worker_type
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.subtitle_writers = subtitle_writers if subtitle_writers is not None else []
+        self.audio_decoder = audio_decoder
+        self.pcm_chunks = pcm_chunks
         self.kwargs = kwargs
         # 存放语音识别结果的列表
         self.asr_result = []
+        # 带时间的语音识别结果，元素为 (开始时间, 结束时间, 文本)，时间单位为秒
+        self.asr_segments = []
+        # 已发出但还没有放入 asr_segments 的语音段的起止时间，序号 -> (开始时间, 结束时间)
+        self.segment_times = {}
+        # 已识别但还不能按顺序放入 asr_result 的结果，序号 -> 文本
+        self.pending_result = {}
+        # 已发出的语音段数
+        self.num_segments = 0
+        # 识别失败的语音段序号，这些语音段在 asr_result 中为空字符串
+        self.failed_segments = []
+        self.segment_queue = None
+        self.result_queue = None
+        self.workers = []
+        # 切分或识别出错时的异常，正常结束时为 None
+        self.error = None
 
     def run(self):
-        self.split_and_recognize_wav(self.wav_path, **self.kwargs)
+        try:
+            self.split_and_recognize_wav(self.wav_path, **self.kwargs)
+        except Exception as e:
+            traceback.print_exc()
+            self.error = e
+            self.stop_workers()
+
+    def stop_workers(self):
+        """ 出错时结束还在运行的识别工作者，不再等待队列中未识别的语音段 """
+        for worker in self.workers:
+            if isinstance(worker, multiprocessing.Process):
+                worker.terminate()
+            else:
+                try:
+                    self.segment_queue.put_nowait(None)
+                except queue.Full:
+                    pass
+        if isinstance(self.segment_queue, multiprocessing.queues.Queue):
+            # 队列中剩余的数据不再写入管道，否则本进程退出时会一直等待
+            self.segment_queue.cancel_join_thread()
+
+    def start_workers(self, **kwargs) -> list:
+        """ 创建队列并启动识别工作者 """
+        if self.worker_type == 'process':
+            self.segment_queue = multiprocessing.Queue(self.queue_size)
+            self.result_queue = multiprocessing.Queue()
+            workers = [multiprocessing.Process(target=recognize_segments_process,
+                                               args=(self.segment_queue, self.result_queue, kwargs,
+                                                     self.batch_size),
+                                               daemon=True)
+                       for _ in range(self.num_workers)]
+        else:
+            self.segment_queue = queue.Queue(self.queue_size)
+            self.result_queue = queue.Queue()
+            # 语音识别器，模型只加载一次，所有线程共用
+            recognizer = SpeechRecognizer(**kwargs)
+            workers = [threading.Thread(target=recognize_segments,
+                                        args=(self.segment_queue, self.result_queue, recognizer, self.batch_size),
+                                        daemon=True)
+                       for _ in range(self.num_workers)]
+        for worker in workers:
+            worker.start()
+        self.workers = workers
+        return workers
+
+    def collect_results(self, block: bool = False):
+        """ 取出已完成的识别结果，按序号依次放入 asr_result
+
+            Args:
+                block (bool): 是否阻塞等待，直到所有已发出的语音段都识别完成
+        """
+        while len(self.asr_result) + len(self.pending_result) < self.num_segments:
+            try:
+                index, text = self.result_queue.get(block=block, timeout=1)
+            except queue.Empty:
+                if not block:
+                    break
+                self.check_workers()
+                continue
+            if index is None:
+                raise RuntimeError('语音识别工作者出错：' + text)
+            self.pending_result[index] = text
+            while len(self.asr_result) in self.pending_result:
+                index = len(self.asr_result)
+                text = self.pending_result.pop(index)
+                start, end = self.segment_times.pop(index)
+                if text is None:
+                    # 识别失败，保留位置但不写入字幕
+                    self.failed_segments.append(index)
+                    text = ''
+                else:
+                    for writer in self.subtitle_writers:
+                        writer.write(start, end, text)
+                    print(text)
+                self.asr_result.append(text)
+                self.asr_segments.append((start, end, text))
+
+    def check_workers(self):
+        """ 等待队列或结果时调用，识别工作者全部退出而还有语音段未识别完成时抛出异常 """
+        if any(worker.is_alive() for worker in self.workers):
+            return
+        # 工作者退出前放入的结果可能刚刚到达
+        self.collect_results(block=False)
+        if len(self.asr_result) + len(self.pending_result) < self.num_segments:
+            raise RuntimeError('语音识别工作者已全部退出，还有' +
+                               str(self.num_segments - len(self.asr_result) - len(self.pending_result)) +
+                               '段语音未识别')
+
+    def put_segment(self, item):
+        """ 放入语音段队列，队列满时等待，等待期间取出已完成的结果并检查工作者是否还在运行 """
+        while True:
+            try:
+                self.segment_queue.put(item, timeout=1)
+                return
+            except queue.Full:
+                self.collect_results()
+                self.check_workers()
 
     def split_and_recognize_wav(self, wav_path: str, **kwargs):
+        workers = self.start_workers(**kwargs)
         # 音频名称（不带后缀）
         base_name = '.'.join(os.path.basename(wav_path).split('.')[0:-1])
         # 音频文件类型
         audio_format = os.path.basename(wav_path).split('.')[-1]
         # 被识别的音频所在目录
         dir_path = os.path.dirname(wav_path)
-        # 用sox对原音频进行采样率、通道数的转变（系统需安装sox并配置环境变量）
-        tfm = sox.Transformer()
-        tfm.rate(16000)
-        tfm.channels(1)
-        # 转变后的音频存放路径
-        wav_path_changed = os.path.join(dir_path, base_name + "_temp." + audio_format)
-        # 转变音频
-        tfm.build(wav_path, wav_path_changed)
-
-        # 读取更改后的音频文件
-        rf = wave.open(wav_path_changed, "rb")
-        # 获取音频参数
-        # 通道数，vad只支持单通道
-        channels = rf.getnchannels()
-        # 每个通道的采样率，vad只支持8k、16k、32k和48k
-        rate = rf.getframerate()
-        # 采样大小（每次采样数据的字节数），vad只支持2
-        samp_width = rf.getsampwidth()
-        # vad采样大小只支持2
-        assert samp_width == 2
-
-        # 定义帧长，vad只支持10、20和30ms
-        frame_duration_ms = 20
-        # 读取数据块大小（每一帧每个通道上的采样次数）（除以通道数和乘以采样大小分之2来进行勉强的纠正）
-        chunk_size = int(rate * frame_duration_ms / 1000 / channels * 2 / samp_width)
-        # 判断人声的敏感程度（一般为1~3,3为最敏感）
-        vad = webrtcvad.Vad(3)
-
-        buffer_data = b''
-        temp = []
-        file_num = 1
-        # 上一段是否为人声
-        pre_is_speech = False
-        # 当前已读的帧数
-        num_frames_i = 0
-        while True:
-            # 读取一帧的数据
-            data = rf.readframes(chunk_size)
-            num_frames_i += 1
-            len_data = len(data)
-            # 如果这一帧是最后一帧
-            if len_data < chunk_size * channels * samp_width:
-                buffer_data += data
-                # 如果上一段有人声，则将数据写入文件
-                if pre_is_speech:
-                    temp_wav_path = os.path.join(dir_path,
-                                                 base_name + '_' + str(file_num).zfill(4) + '.' + audio_format)
-                    wf = wave.open(temp_wav_path, "wb")
-                    wf.setnchannels(channels)
-                    wf.setsampwidth(samp_width)
-                    wf.setframerate(rate)
-                    wf.writeframes(buffer_data)
-                    wf.close()
-                    # 识别
-                    recognize_txt = recognize_single_wav(temp_wav_path, **kwargs)
-                    self.asr_result.append(recognize_txt)
-                    # 删除这句话的音频文件
-                    os.remove(temp_wav_path)
-                    print(recognize_txt)
-                buffer_data = b''
-                temp = []
-                # 结束循环
-                break
-            # 否则
-            else:
-                is_speech = vad.is_speech(data, rate)
-            # 将这一帧的数据和判断结果放入缓存
-            buffer_data += data
-            temp += [is_speech]
-
-            # buffer_data里面包含数据的帧数
-            numframes_buffer_data = int(len(buffer_data) / chunk_size / 2)
-            # cache_size帧里面有大于等于threshold帧是人声，就认为这一段(cache_size帧)是人声
-            # 根据buffer_data里面包含数据的帧数动态调整切分窗口
-            # 小于3秒，什么都不做。如果连续1秒没人声，则删除这1秒
-            if numframes_buffer_data <= 150:
-                cache_size = 0
-                threshold = 0
-                # 每30帧判断一次，判断当前buffer_data里面的数据是否为人声
-                if numframes_buffer_data % 30 == 0:
-                    # 不是人声，则清空缓存
-                    if sum(temp) < numframes_buffer_data / 10:
-                        pre_is_speech = False
-                        buffer_data = b''
-                        temp = []
-                    # 是人声。本阶段最后一次判断时，清空temp,以便后续判断
-                    else:
-                        pre_is_speech = True
-                        if numframes_buffer_data == 150:
-                            temp = []
-            # 3到5秒，正常切分
-            elif numframes_buffer_data < 250:
-                cache_size = 10
-                threshold = 2
-            # 5到7秒，按较小的窗口切分
-            elif numframes_buffer_data < 350:
-                cache_size = 5
-                threshold = 2
-            # 7到9秒，按更小的窗口切分
-            elif numframes_buffer_data < 450:
-                cache_size = 3
-                threshold = 2
-            # 9到16秒，逐一判断
-            elif numframes_buffer_data < 800:
-                cache_size = 1
-                threshold = 1
-            # 16秒，达到最大长度，强制切分，将buffer_data里面的数据写入文件并语音识别，然后清空缓存，回归初始状态
-            else:
-                cache_size = 0
-                threshold = 0
-                pre_is_speech = False
-                temp_wav_path = os.path.join(dir_path, base_name + '_' + str(file_num).zfill(4) + '.' + audio_format)
-                wf = wave.open(temp_wav_path, "wb")
-                file_num += 1
-                wf.setnchannels(channels)
-                wf.setsampwidth(samp_width)
-                wf.setframerate(rate)
-                wf.writeframes(buffer_data)
-                wf.close()
-                # 识别
-                recognize_txt = recognize_single_wav(temp_wav_path, **kwargs)
-                self.asr_result.append(recognize_txt)
-                print(recognize_txt)
-                # 删除这句话的音频文件
-                os.remove(temp_wav_path)
-                buffer_data = b''
-                temp = []
-
-            # 如果缓存满了
-            if len(temp) >= cache_size > 0:
-                num_is_speech = sum(temp)
-                # cache_size帧里面有大于等于threshold帧是人声，就认为这一段(cache_size帧)是人声
-                if num_is_speech >= threshold:
-                    # 如果是人声，清空判断结果缓存
-                    pre_is_speech = True
-                    temp = []
-                # 如果这一段不是人声且上一段是人声，就将缓存中的所有数据写入文件并清空缓存
-                elif pre_is_speech == True:
-                    pre_is_speech = False
-                    temp_wav_path = os.path.join(dir_path,
-                                                 base_name + '_' + str(file_num).zfill(4) + '.' + audio_format)
-                    wf = wave.open(temp_wav_path, "wb")
-                    file_num += 1
-                    wf.setnchannels(channels)
-                    wf.setsampwidth(samp_width)
-                    wf.setframerate(rate)
-                    wf.writeframes(buffer_data)
-                    wf.close()
-                    # 识别
-                    recognize_txt = recognize_single_wav(temp_wav_path, **kwargs)
-                    self.asr_result.append(recognize_txt)
-                    print(recognize_txt)
-                    # 删除这句话的音频文件
-                    os.remove(temp_wav_path)
-                    buffer_data = b''
-                    temp = []
-                # 如果这一段不是人声且上一段也不是人声
-                else:
-                    # 如果后(threshold-1)帧为人声，则认为这一段是人声
-                    if 0 < num_is_speech == sum(temp[cache_size - threshold + 1:cache_size]):
-                        pre_is_speech = True
-                        temp = []
-                    # 否则清空缓存
-                    else:
-                        buffer_data = b''
-                        temp = []
-        rf.close()
-        os.remove(wav_path_changed)
+        if self.pcm_chunks is not None:
+            self.split_chunks(self.pcm_chunks, 16000, 1, 2, dir_path, base_name, audio_format)
+        elif self.audio_decoder == 'ffmpeg':
+            # 用ffmpeg解码并转为16k单通道，通过管道每次读取1秒的数据交给切分器
+            rate = 16000
+            channels = 1
+            samp_width = 2
+            chunks = ffmpeg_pcm_chunks(wav_path, rate, channels, rate * channels * samp_width)
+            self.split_chunks(chunks, rate, channels, samp_width, dir_path, base_name, audio_format)
+        else:
+            # 用sox对原音频进行采样率、通道数的转变（系统需安装sox并配置环境变量）
+            tfm = sox.Transformer()
+            tfm.rate(16000)
+            tfm.channels(1)
+            # 转变后的音频存放路径
+            wav_path_changed = os.path.join(dir_path, base_name + "_temp." + audio_format)
+            # 转变音频
+            tfm.build(wav_path, wav_path_changed)
+
+            # 读取更改后的音频文件
+            rf = wave.open(wav_path_changed, "rb")
+            # 获取音频参数
+            # 通道数，vad只支持单通道
+            channels = rf.getnchannels()
+            # 每个通道的采样率，vad只支持8k、16k、32k和48k
+            rate = rf.getframerate()
+            # 采样大小（每次采样数据的字节数），vad只支持2
+            samp_width = rf.getsampwidth()
+            # 每次读取1秒的数据交给切分器
+            chunks = iter(lambda: rf.readframes(rate), b'')
+            self.split_chunks(chunks, rate, channels, samp_width, dir_path, base_name, audio_format)
+            rf.close()
+            os.remove(wav_path_changed)
+        # 通知工作者结束，并等待剩余的语音段识别完成
+        for _ in workers:
+            self.put_segment(None)
+        self.collect_results(block=True)
+        for worker in workers:
+            worker.join()
+
+    def split_chunks(self, chunks, rate: int, channels: int, samp_width: int, dir_path: str, base_name: str,
+                     audio_format: str):
+        """ 对 PCM 数据流进行切分，切分出的语音段放入识别队列
+
+            Args:
+                chunks (Iterable[bytes]): PCM 数据块
+                rate (int): 采样率
+                channels (int): 通道数
+                samp_width (int): 采样大小
+                dir_path (str): 调试模式下语音段的保存目录
+                base_name (str): 调试模式下语音段文件名的前缀
+                audio_format (str): 调试模式下语音段的文件类型
+        """
+        segmenter = VadSegmenter(rate, channels, samp_width)
+        for start_sample, end_sample, pcm in segmenter.segment(chunks):
+            segment_path = os.path.join(dir_path,
+                                        base_name + '_' + str(self.num_segments + 1).zfill(4) + '.' + audio_format)
+            self.segment_times[self.num_segments] = (start_sample / rate, end_sample / rate)
+            # 识别（音频数据直接在内存中交给识别器）
+            self.emit_segment(pcm, segment_path, channels, samp_width, rate)
+
+    def emit_segment(self, pcm: bytes, segment_path: str, channels: int, samp_width: int, rate: int):
+        """ 将一段语音放入识别队列，PCM 数据不落盘直接交给识别工作者
+
+            Args:
+                pcm (bytes): 这一段语音的 int16 PCM 数据
+                segment_path (str): 调试模式下这一段语音的保存路径
+                channels (int): 通道数
+                samp_width (int): 采样大小
+                rate (int): 采样率
+        """
+        # 调试模式下保存这一段语音
+        if self.dump_segments:
+            wf = wave.open(segment_path, "wb")
+            wf.setnchannels(channels)
+            wf.setsampwidth(samp_width)
+            wf.setframerate(rate)
+            wf.writeframes(pcm)
+            wf.close()
+        # 队列满时阻塞，切分等待识别
+        self.put_segment((self.num_segments, pcm, rate, channels))
+        self.num_segments += 1
+        # 顺便取出已完成的识别结果
+        self.collect_results()
 
 # kwargs = {
 #     'model_path': '../exp/final.pt',
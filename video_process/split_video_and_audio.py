@@ -3,32 +3,137 @@
 # Author: Wang Zifan
 
 """分离视频和音频"""
+import collections
 import os
 import threading
 import time
 
-import chardet
 from moviepy.editor import VideoFileClip
 
+from log_tailer import LogTailer
+from media_probe import MediaInfo, probe_media
+from progress import ProgressBus, ProgressReporter, ffmpeg_progress_seconds, run_with_output
+
+# 各输出容器可以直接复制（不重新编码）的视频编码
+COPYABLE_VIDEO_CODECS = {
+    'mp4': {'h264', 'hevc', 'mpeg4', 'av1', 'vp9', 'mpeg1video', 'mpeg2video', 'mjpeg'},
+    'mov': {'h264', 'hevc', 'mpeg4', 'prores', 'mjpeg', 'mpeg1video', 'mpeg2video'},
+    'mkv': None,  # mkv 可以容纳任何编码
+}
+# ffmpeg 因容器不支持视频编码而无法复制时的输出
+COPY_UNSUPPORTED_MESSAGES = ['not currently supported in container', 'Could not find tag for codec']
+
 
 class SplitVideoAudioThread(threading.Thread):
-    def __init__(self, thread_id: str, video_path: str, video_output_path: str, audio_output_path: str):
+    """ 音视频分离线程
+
+        Attributes:
+            thread_id (str): 线程id
+            video_path (str): 输入的视频路径
+            video_output_path (str): 输出的不带声音的视频路径
+            audio_output_path (str): 输出的音频路径
+            stream_copy (bool): 是否用 ffmpeg 直接复制视频流（不重新编码），一次调用同时提取音频；
+                根据视频编码和输出容器判断能否复制，不能复制时重新编码视频，
+                复制时 ffmpeg 报告容器不支持该编码才改为重新编码，其它失败不重试。此时通过管道逐行读取 ffmpeg 的进度，
+                自己更新进度并发布 'demux' 进度事件，不写日志文件，也不需要监听线程。
+                为 False 时使用 moviepy 重新编码，由 SplitVideoAudioMonitorThread 监听日志文件
+            media_info (MediaInfo): 输入视频的信息，为 None 时用 ffprobe 获取
+            progress_bus (ProgressBus): 进度事件总线，为 None 时不发布
+    """
+
+    def __init__(self, thread_id: str, video_path: str, video_output_path: str, audio_output_path: str,
+                 stream_copy: bool = True, media_info: MediaInfo = None, progress_bus: ProgressBus = None):
         super(SplitVideoAudioThread, self).__init__()
         self.thread_id = thread_id
         self.video_path = video_path
         self.video_output_path = video_output_path
         self.audio_output_path = audio_output_path
+        self.stream_copy = stream_copy
+        # moviepy 的日志文件
         self.log_path_video = video_output_path + '.log'
         self.log_path_audio = audio_output_path + '.log'
+        self.progress_bus = progress_bus
         self.audio_extract_process = ""
         self.video_extract_process = ""
-        video = VideoFileClip(video_path)
+        # 失败原因，成功时为 None
+        self.error = None
+        self.media_info = media_info if media_info is not None else probe_media(video_path)
         # 音视频总时长
-        self.duration = float(video.duration)
-        video.close()
+        self.duration = self.media_info.duration
 
     def run(self):
-        self.split_video_and_audio(self.video_path, self.video_output_path, self.audio_output_path)
+        if self.stream_copy:
+            self.demux_video_and_audio(self.video_path, self.video_output_path, self.audio_output_path)
+        else:
+            self.split_video_and_audio(self.video_path, self.video_output_path, self.audio_output_path)
+
+    def demux_video_and_audio(self, video_path: str, video_output_path: str, audio_output_path: str):
+        """ 用 ffmpeg 分离视频和音频，视频流直接复制不重新编码
+
+           Author: Wang Zifan
+           Date: 2022/04/30
+
+           Attributes:
+               video_path (str): 输入的视频路径
+               video_output_path (str): 输出的不带声音的视频路径
+               audio_output_path (str): 输出的音频路径
+       """
+        reporter = ProgressReporter('demux', self.progress_bus)
+        # 最后几行输出，失败时打印
+        last_lines = collections.deque(maxlen=20)
+
+        def on_line(line: str):
+            last_lines.append(line)
+            seconds = ffmpeg_progress_seconds(line)
+            if seconds is not None and self.duration > 0:
+                percent = min(100 * seconds / self.duration, 100)
+                self.audio_extract_process = "正在进行音频提取：" + format(percent, ".2f") + '% '
+                self.video_extract_process = "正在进行视频提取：" + format(percent, ".2f") + '% '
+                reporter.report(percent, self.video_extract_process)
+
+        # 只输出输入中存在的流
+        has_video = self.media_info.has_video
+        has_audio = self.media_info.has_audio
+        audio_output = ['-vn', '-acodec', 'pcm_s16le', '-ar', '44100', audio_output_path] if has_audio else []
+        video_codecs = [['-c:v', 'copy'], ['-c:v', 'libx264']] if self.video_copyable(video_output_path) \
+            else [['-c:v', 'libx264']]
+        if not has_video:
+            video_codecs = [None]
+        returncode = -1
+        if has_video or has_audio:
+            for video_codec in video_codecs:
+                last_lines.clear()
+                video_output = ['-an'] + video_codec + [video_output_path] if video_codec is not None else []
+                # -progress 将进度以 key=value 的形式逐行输出到管道
+                command = ['ffmpeg', '-nostdin', '-y', '-v', 'error', '-progress', 'pipe:1', '-nostats',
+                           '-i', video_path] + video_output + audio_output
+                returncode = run_with_output(command, on_line)
+                # 只有容器不支持复制该视频编码时才重新编码，其它错误（音频、磁盘空间等）重新编码也不能解决
+                if returncode == 0 or not any(message in line for line in last_lines
+                                              for message in COPY_UNSUPPORTED_MESSAGES):
+                    break
+        if returncode != 0:
+            # -progress 的 key=value 行不是错误信息
+            self.error = '\n'.join(line for line in last_lines if '=' not in line or ' ' in line) or \
+                'ffmpeg返回' + str(returncode)
+            print(self.error)
+        elif not has_video or not has_audio:
+            self.error = video_path + (" 没有视频流" if not has_video else " 没有音频流")
+        self.audio_extract_process = "音频提取完成" if returncode == 0 and has_audio else "音频提取失败"
+        self.video_extract_process = "视频提取完成" if returncode == 0 and has_video else "视频提取失败"
+        if self.error is None:
+            reporter.report(100, "音视频分离完成", 'done')
+        else:
+            reporter.report(None, "音视频分离失败", 'failed')
+
+    def video_copyable(self, video_output_path: str) -> bool:
+        """ 视频流能否直接复制到输出容器中 """
+        container = os.path.splitext(video_output_path)[1].lstrip('.').lower()
+        if container not in COPYABLE_VIDEO_CODECS:
+            # 不认识的容器先尝试复制
+            return True
+        codecs = COPYABLE_VIDEO_CODECS[container]
+        return codecs is None or self.media_info.video_codec in codecs
 
     def split_video_and_audio(self, video_path: str, video_output_path: str, audio_output_path: str):
         """ 分离视频和音频
@@ -52,124 +157,63 @@ class SplitVideoAudioThread(threading.Thread):
 
 
 class SplitVideoAudioMonitorThread(threading.Thread):
-    def __init__(self, thread_id: str, split_thread: SplitVideoAudioThread):
+    def __init__(self, thread_id: str, split_thread: SplitVideoAudioThread, encoding: str = None):
         super(SplitVideoAudioMonitorThread, self).__init__()
         self.split_thread = split_thread
+        # 增量读取日志，每次只解析新增的行；音视频共用一个日志时共用一个读取器
+        self.audio_tailer = LogTailer(split_thread.log_path_audio, encoding, keyword='time=')
+        self.video_tailer = self.audio_tailer if split_thread.log_path_video == split_thread.log_path_audio \
+            else LogTailer(split_thread.log_path_video, encoding, keyword='time=')
+
+    @staticmethod
+    def progress_seconds(line: str):
+        """ 从包含'time=hh:mm:ss.xx'的行中取出已经完成的秒数 """
+        for s in line.split(' '):
+            if 'time=' in s:
+                time_str_list = s.split('=')[1].split(':')
+                try:
+                    return 3600 * float(time_str_list[0]) + 60 * float(time_str_list[1]) + float(time_str_list[2])
+                except (IndexError, ValueError):
+                    return None
+        return None
+
+    def extract_process(self, tailer: LogTailer, name: str, finished: bool) -> str:
+        """ 根据日志得到音频或视频的提取进度
+
+            Args:
+                tailer (LogTailer): 日志读取器
+                name (str): '音频' 或 '视频'
+                finished (bool): 提取是否已经结束
+        """
+        if not tailer.exists():
+            return name + "提取失败" if finished else ""
+        tailer.poll(final=finished)
+        if finished or tailer.line_count == 0 or 'time=' not in tailer.last_line:
+            if tailer.match_count > 0:
+                return name + "提取完成"
+            return name + "提取失败" if finished else ""
+        time_num_s = self.progress_seconds(tailer.last_line)
+        if time_num_s is None:
+            return ""
+        return "正在进行" + name + "提取：" + format(100 * time_num_s / self.split_thread.duration, ".2f") + '% '
 
     def run(self):
         while True:
             # 线程正在运行
             if self.split_thread.is_alive():
-                # 音频提取进度判断
-                if os.path.isfile(self.split_thread.log_path_audio):
-                    # 获取文件编码格式
-                    with open(self.split_thread.log_path_audio, 'rb') as f:
-                        text = f.read()
-                        code = chardet.detect(text)['encoding']
-                    with open(self.split_thread.log_path_audio, 'r', encoding=code) as f:
-                        # 将每一行存入列表，去除每一行首尾的回车和空格，空行不放入列表
-                        line_list = [line.strip() for line in f.readlines() if line.strip() != '']
-                        # 如果文件不为空
-                        if len(line_list) > 0:
-                            last_line = line_list[-1]
-                            if 'time=' in last_line:
-                                last_line_list = last_line.split(' ')
-                                for s in last_line_list:
-                                    if 'time=' in s:
-                                        time_str = s.split('=')[1]
-                                        time_str_list = time_str.split(':')
-                                        # 已经完成的秒数
-                                        time_num_s = 3600 * float(time_str_list[0]) + 60 * float(
-                                            time_str_list[1]) + float(time_str_list[2])
-                                        self.split_thread.audio_extract_process = "正在进行音频提取：" + format(
-                                            100 * time_num_s / self.split_thread.duration, ".2f") + '% '
-                                        break
-                            elif 'time=' in "".join(line_list):
-                                self.split_thread.audio_extract_process = "音频提取完成"
-                # 视频提取已经开始了，音频提取应该结束了，异常判断
-                if self.split_thread.video_extract_process != "":
-                    if not os.path.isfile(self.split_thread.log_path_audio):
-                        self.split_thread.audio_extract_process = "音频提取失败"
-                    else:
-                        # 获取文件编码格式
-                        with open(self.split_thread.log_path_audio, 'rb') as f:
-                            text = f.read()
-                            code = chardet.detect(text)['encoding']
-                        with open(self.split_thread.log_path_audio, 'r', encoding=code) as f:
-                            # 将每一行存入列表，去除每一行首尾的回车和空格，空行不放入列表
-                            line_list = [line.strip() for line in f.readlines() if line.strip() != '']
-                            # 文件为空
-                            if len(line_list) == 0:
-                                self.split_thread.audio_extract_process = "音频提取失败"
-                            elif 'time=' in "".join(line_list):
-                                self.split_thread.audio_extract_process = "音频提取完成"
-                            else:
-                                self.split_thread.audio_extract_process = "音频提取失败"
+                # 音频提取进度判断，视频提取已经开始了，音频提取应该结束了
+                audio_finished = self.split_thread.video_extract_process != ""
+                audio_extract_process = self.extract_process(self.audio_tailer, '音频', audio_finished)
+                if audio_extract_process != "":
+                    self.split_thread.audio_extract_process = audio_extract_process
                 # 视频提取进度判断
-                if os.path.isfile(self.split_thread.log_path_video):
-                    # 获取文件编码格式
-                    with open(self.split_thread.log_path_video, 'rb') as f:
-                        text = f.read()
-                        code = chardet.detect(text)['encoding']
-                    with open(self.split_thread.log_path_video, 'r', encoding=code) as f:
-                        # 将每一行存入列表，去除每一行首尾的回车和空格，空行不放入列表
-                        line_list = [line.strip() for line in f.readlines() if line.strip() != '']
-                        # 如果文件不为空
-                        if len(line_list) > 0:
-                            last_line = line_list[-1]
-                            if 'time=' in last_line:
-                                last_line_list = last_line.split(' ')
-                                for s in last_line_list:
-                                    if 'time=' in s:
-                                        video_time_str = s.split('=')[1]
-                                        video_time_str_list = video_time_str.split(':')
-                                        # 已经完成的秒数
-                                        video_time_num_s = 3600 * float(video_time_str_list[0]) + 60 * float(
-                                            video_time_str_list[1]) + float(video_time_str_list[2])
-                                        self.split_thread.video_extract_process = "正在进行视频提取：" + format(
-                                            100 * video_time_num_s / self.split_thread.duration, ".2f") + '% '
-                                        break
-                            elif 'time=' in "".join(line_list):
-                                self.split_thread.video_extract_process = "视频提取完成"
+                video_extract_process = self.extract_process(self.video_tailer, '视频', False)
+                if video_extract_process != "":
+                    self.split_thread.video_extract_process = video_extract_process
             # 线程停止运行
             else:
-                # 音频提取进度判断
-                if not os.path.isfile(self.split_thread.log_path_audio):
-                    self.split_thread.audio_extract_process = "音频提取失败"
-                else:
-                    # 获取文件编码格式
-                    with open(self.split_thread.log_path_audio, 'rb') as f:
-                        text = f.read()
-                        code = chardet.detect(text)['encoding']
-                    with open(self.split_thread.log_path_audio, 'r', encoding=code) as f:
-                        # 将每一行存入列表，去除每一行首尾的回车和空格，空行不放入列表
-                        line_list = [line.strip() for line in f.readlines() if line.strip() != '']
-                        # 文件为空
-                        if len(line_list) == 0:
-                            self.split_thread.audio_extract_process = "音频提取失败"
-                        elif 'time=' in "".join(line_list):
-                            self.split_thread.audio_extract_process = "音频提取完成"
-                        else:
-                            self.split_thread.audio_extract_process = "音频提取失败"
-                # 视频提取进度判断
-                if not os.path.isfile(self.split_thread.log_path_video):
-                    self.split_thread.video_extract_process = "视频提取失败"
-                else:
-                    # 获取文件编码格式
-                    with open(self.split_thread.log_path_video, 'rb') as f:
-                        text = f.read()
-                        code = chardet.detect(text)['encoding']
-                    with open(self.split_thread.log_path_video, 'r', encoding=code) as f:
-                        # 将每一行存入列表，去除每一行首尾的回车和空格，空行不放入列表
-                        line_list = [line.strip() for line in f.readlines() if line.strip() != '']
-                        # 文件为空
-                        if len(line_list) == 0:
-                            self.split_thread.video_extract_process = "视频提取失败"
-                        elif 'time=' in "".join(line_list):
-                            self.split_thread.video_extract_process = "视频提取完成"
-                        else:
-                            self.split_thread.video_extract_process = "视频提取失败"
-
+                self.split_thread.audio_extract_process = self.extract_process(self.audio_tailer, '音频', True)
+                self.split_thread.video_extract_process = self.extract_process(self.video_tailer, '视频', True)
                 # 退出前删除文件
                 if os.path.isfile(self.split_thread.log_path_audio):
                     os.remove(self.split_thread.log_path_audio)
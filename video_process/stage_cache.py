@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Author: Wang Zifan
+
+"""按内容寻址的处理步骤缓存"""
+import functools
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import threading
+import time
+import uuid
+from typing import Dict, Optional
+
+from progress import hidden_startupinfo
+
+
+@functools.lru_cache(maxsize=256)
+def _file_digest(path: str, mtime_ns: int, size: int) -> str:
+    # mtime_ns 和 size 只作为缓存的键，文件改变后重新计算
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(1 << 20)
+            if not data:
+                break
+            sha256.update(data)
+    return sha256.hexdigest()
+
+
+def file_digest(path: str) -> str:
+    """ 文件内容的 sha256，同一文件（路径、修改时间和大小都不变）只计算一次 """
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    return _file_digest(path, stat.st_mtime_ns, stat.st_size)
+
+
+@functools.lru_cache(maxsize=None)
+def tool_version(tool: str) -> str:
+    """ 获取外部工具的版本信息（ffmpeg -version 或 spleeter --version 的第一行），获取失败时返回 'unknown' """
+    flag = '-version' if tool == 'ffmpeg' else '--version'
+    try:
+        result = subprocess.run([tool, flag], stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT, startupinfo=hidden_startupinfo())
+    except OSError:
+        return 'unknown'
+    lines = result.stdout.decode('utf-8', errors='replace').strip().splitlines()
+    return lines[0] if lines else 'unknown'
+
+
+class StageCache:
+    """ 处理步骤的输出缓存
+
+        每个步骤的输出以 (输入文件摘要或上一步骤的键, 步骤名, 步骤参数, 工具版本) 的哈希为键，
+        存放在 cache_dir/<键>/ 下。写入时先写到临时文件夹再重命名，中途失败不会留下不完整的缓存。
+        总大小超过 max_size 时按最近使用时间删除最久未用的缓存。
+
+        Author: Wang Zifan
+        Date: 2022/05/11
+
+        Attributes:
+            cache_dir (str): 缓存目录
+            max_size (int): 缓存总大小上限（字节）
+    """
+
+    def __init__(self, cache_dir: str, max_size: int = 20 * 1024 ** 3):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_size = max_size
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(stage: str, input_key: str, params: dict = None, tool: str = '') -> str:
+        """ 计算缓存键
+
+            Args:
+                stage (str): 步骤名
+                input_key (str): 输入文件摘要，或上一步骤的缓存键
+                params (dict): 步骤参数，需能转为 json
+                tool (str): 工具版本
+        """
+        text = json.dumps([stage, input_key, params if params is not None else {}, tool], sort_keys=True,
+                          ensure_ascii=False)
+        return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+    def entry_dir(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key)
+
+    def lookup(self, key: str) -> Optional[Dict[str, str]]:
+        """ 查找缓存，命中时返回 输出名 -> 缓存文件路径，并更新最近使用时间，未命中返回 None """
+        manifest_path = os.path.join(self.entry_dir(key), 'manifest.json')
+        try:
+            with open(manifest_path, 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+            os.utime(manifest_path)
+        except OSError:
+            with self.lock:
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits += 1
+        return {name: os.path.join(self.entry_dir(key), file_name) for name, file_name in manifest['files'].items()}
+
+    def store(self, key: str, files: Dict[str, str], meta: dict = None):
+        """ 存入一个步骤的输出
+
+            Args:
+                key (str): 缓存键
+                files (dict): 输出名 -> 输出文件路径
+                meta (dict): 附加信息，如识别结果，会写入 manifest.json
+        """
+        if os.path.isdir(self.entry_dir(key)):
+            return
+        temp_dir = os.path.join(self.cache_dir, '.tmp_' + uuid.uuid4().hex)
+        os.makedirs(temp_dir)
+        try:
+            manifest = {'files': {}, 'meta': meta if meta is not None else {}, 'time': time.time()}
+            for i, (name, path) in enumerate(files.items()):
+                # 缓存中保存独立的副本，输出文件之后被覆盖或删除都不影响缓存
+                file_name = '{}_{}'.format(i, os.path.basename(path))
+                shutil.copyfile(path, os.path.join(temp_dir, file_name))
+                manifest['files'][name] = file_name
+            with open(os.path.join(temp_dir, 'manifest.json'), 'w', encoding='utf-8') as f:
+                json.dump(manifest, f, ensure_ascii=False)
+            os.rename(temp_dir, self.entry_dir(key))
+        except OSError:
+            # 其它线程已经存入同一个键，或写入失败
+            shutil.rmtree(temp_dir, ignore_errors=True)
+        self.evict()
+
+    def meta(self, key: str) -> dict:
+        """ 读取缓存的附加信息 """
+        with open(os.path.join(self.entry_dir(key), 'manifest.json'), 'r', encoding='utf-8') as f:
+            return json.load(f)['meta']
+
+    def restore(self, key: str, outputs: Dict[str, str]) -> bool:
+        """ 将缓存的文件复制到输出路径，缓存不存在时返回 False
+
+            Args:
+                key (str): 缓存键
+                outputs (dict): 输出名 -> 目标路径
+        """
+        cached_files = self.lookup(key)
+        if cached_files is None:
+            return False
+        try:
+            for name, path in outputs.items():
+                if not os.path.exists(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                shutil.copyfile(cached_files[name], path)
+        except (OSError, KeyError):
+            # 缓存在读取时被其它进程删除，或缓存的输出与需要的不一致
+            return False
+        return True
+
+    def size(self) -> int:
+        """ 缓存总大小（字节） """
+        return sum(size for _, size, _ in self.entries())
+
+    def entries(self) -> list:
+        """ 所有缓存，元素为 (键, 大小, 最近使用时间) """
+        entries = []
+        for key in os.listdir(self.cache_dir):
+            manifest_path = os.path.join(self.entry_dir(key), 'manifest.json')
+            if key.startswith('.') or not os.path.isfile(manifest_path):
+                continue
+            try:
+                entry_size = sum(os.path.getsize(os.path.join(self.entry_dir(key), name))
+                                 for name in os.listdir(self.entry_dir(key)))
+                entries.append((key, entry_size, os.path.getmtime(manifest_path)))
+            except OSError:
+                # 统计时被其它进程删除
+                continue
+        return entries
+
+    def evict(self):
+        """ 总大小超过上限时，按最近使用时间从旧到新删除缓存 """
+        with self.lock:
+            entries = sorted(self.entries(), key=lambda entry: entry[2])
+            total_size = sum(entry[1] for entry in entries)
+            for key, entry_size, _ in entries:
+                if total_size <= self.max_size:
+                    break
+                shutil.rmtree(self.entry_dir(key), ignore_errors=True)
+                total_size -= entry_size
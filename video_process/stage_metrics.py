@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Author: Wang Zifan
+
+"""处理步骤的耗时和资源统计"""
+import json
+import os
+import sys
+import threading
+import time
+from typing import Dict, List, Optional
+
+try:
+    import resource
+except ImportError:
+    # windows 下没有 resource 模块
+    resource = None
+
+
+def _windows_peak_rss() -> Optional[int]:
+    """ windows 下本进程的峰值工作集（字节），获取失败时返回 None """
+    try:
+        import ctypes
+        from ctypes import wintypes
+
+        class ProcessMemoryCounters(ctypes.Structure):
+            _fields_ = [('cb', wintypes.DWORD), ('PageFaultCount', wintypes.DWORD),
+                        ('PeakWorkingSetSize', ctypes.c_size_t), ('WorkingSetSize', ctypes.c_size_t),
+                        ('QuotaPeakPagedPoolUsage', ctypes.c_size_t), ('QuotaPagedPoolUsage', ctypes.c_size_t),
+                        ('QuotaPeakNonPagedPoolUsage', ctypes.c_size_t), ('QuotaNonPagedPoolUsage', ctypes.c_size_t),
+                        ('PagefileUsage', ctypes.c_size_t), ('PeakPagefileUsage', ctypes.c_size_t)]
+
+        counters = ProcessMemoryCounters()
+        counters.cb = ctypes.sizeof(counters)
+        process = ctypes.windll.kernel32.GetCurrentProcess()
+        if not ctypes.windll.psapi.GetProcessMemoryInfo(process, ctypes.byref(counters), counters.cb):
+            return None
+        return int(counters.PeakWorkingSetSize)
+    except (ImportError, AttributeError, OSError):
+        return None
+
+
+def resource_usage() -> dict:
+    """ 当前的资源使用情况
+
+        Returns:
+            usage (dict):
+                cpu_seconds: 本进程（所有线程）已用的cpu时间
+                child_cpu_seconds: 已结束的子进程（ffmpeg、spleeter 等）已用的cpu时间，无法获取时为 None
+                peak_rss_bytes: 本进程的峰值常驻内存
+                child_peak_rss_bytes: 已结束的子进程中最大的峰值常驻内存，无法获取时为 None
+    """
+    usage = {'cpu_seconds': time.process_time(), 'child_cpu_seconds': None, 'peak_rss_bytes': None,
+             'child_peak_rss_bytes': None}
+    if resource is not None:
+        # linux 下 ru_maxrss 的单位是 KB，macos 下是字节
+        unit = 1 if sys.platform == 'darwin' else 1024
+        self_usage = resource.getrusage(resource.RUSAGE_SELF)
+        children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        usage['child_cpu_seconds'] = children_usage.ru_utime + children_usage.ru_stime
+        usage['peak_rss_bytes'] = self_usage.ru_maxrss * unit
+        usage['child_peak_rss_bytes'] = children_usage.ru_maxrss * unit
+    else:
+        usage['peak_rss_bytes'] = _windows_peak_rss()
+    return usage
+
+
+def files_size(paths: List[str]) -> int:
+    """ 文件总大小，不存在的文件不计 """
+    return sum(os.path.getsize(path) for path in paths if path is not None and os.path.isfile(path))
+
+
+class StageMetrics:
+    """ 一个视频各处理步骤的统计
+
+        每个步骤记录墙钟时间、cpu时间（本进程和子进程）、峰值常驻内存、读写的字节数和处理的音频时长，
+        由音频时长和墙钟时间得到实时率。cpu时间和峰值内存是进程级的：按步骤调度时同一进程中
+        同时进行的其它步骤也计算在内；峰值内存是到该步骤结束为止的最大值，比上一步骤大说明该步骤提高了峰值。
+
+        Author: Wang Zifan
+        Date: 2022/05/16
+
+        Attributes:
+            video_path (str): 视频路径
+    """
+
+    def __init__(self, video_path: str):
+        self.video_path = video_path
+        self.lock = threading.Lock()
+        # 步骤名 -> 统计信息，按步骤开始的顺序
+        self.stages = {}
+        self.start_usages = {}
+
+    def start(self, stage: str):
+        """ 步骤开始 """
+        with self.lock:
+            self.start_usages[stage] = (time.time(), resource_usage())
+
+    def finish(self, stage: str, state: str, audio_seconds: float = 0.0, read_bytes: int = 0,
+               written_bytes: int = 0, cached: bool = False):
+        """ 步骤结束
+
+            Args:
+                stage (str): 步骤名
+                state (str): '完成' 或 '失败'
+                audio_seconds (float): 处理的音频时长（秒）
+                read_bytes (int): 读取的文件字节数
+                written_bytes (int): 写入的文件字节数
+                cached (bool): 是否直接使用了缓存
+        """
+        end_time = time.time()
+        end_usage = resource_usage()
+        with self.lock:
+            start_time, start_usage = self.start_usages.pop(stage)
+            wall_seconds = end_time - start_time
+
+            def delta(name):
+                if start_usage[name] is None or end_usage[name] is None:
+                    return None
+                return end_usage[name] - start_usage[name]
+
+            self.stages[stage] = {
+                'state': state,
+                'cached': cached,
+                'start_time': start_time,
+                'wall_seconds': wall_seconds,
+                'cpu_seconds': delta('cpu_seconds'),
+                'child_cpu_seconds': delta('child_cpu_seconds'),
+                'peak_rss_bytes': end_usage['peak_rss_bytes'],
+                'child_peak_rss_bytes': end_usage['child_peak_rss_bytes'],
+                'read_bytes': read_bytes,
+                'written_bytes': written_bytes,
+                'audio_seconds': audio_seconds,
+                # 处理1秒音频所用的秒数，小于1说明快于实时
+                'real_time_factor': wall_seconds / audio_seconds if audio_seconds > 0 else None
+            }
+
+    def report(self) -> dict:
+        """ 可转为 json 的统计报告 """
+        with self.lock:
+            stages = {name: dict(record) for name, record in self.stages.items()}
+        wall_seconds = sum(record['wall_seconds'] for record in stages.values())
+        return {'video_path': self.video_path, 'wall_seconds': wall_seconds, 'stages': stages}
+
+    def write_json(self, path: str):
+        """ 将统计报告写入 json 文件 """
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.report(), f, ensure_ascii=False, indent=2)
+
+
+# Prometheus 文本格式中的指标：(报告中的字段, 指标名, 说明)
+PROMETHEUS_METRICS = [
+    ('wall_seconds', 'video_stage_wall_seconds', 'Wall time of the stage in seconds'),
+    ('cpu_seconds', 'video_stage_cpu_seconds', 'CPU time of the process during the stage in seconds'),
+    ('child_cpu_seconds', 'video_stage_child_cpu_seconds', 'CPU time of child processes during the stage in seconds'),
+    ('peak_rss_bytes', 'video_stage_peak_rss_bytes', 'Peak resident set size of the process at the end of the stage'),
+    ('child_peak_rss_bytes', 'video_stage_child_peak_rss_bytes', 'Largest peak resident set size of child processes'),
+    ('read_bytes', 'video_stage_read_bytes', 'Bytes of files read by the stage'),
+    ('written_bytes', 'video_stage_written_bytes', 'Bytes of files written by the stage'),
+    ('audio_seconds', 'video_stage_audio_seconds', 'Seconds of audio processed by the stage'),
+    ('real_time_factor', 'video_stage_real_time_factor', 'Wall seconds per second of audio')
+]
+
+
+def _label_value(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def prometheus_text(reports: List[Dict]) -> str:
+    """ 将多个视频的统计报告转为 Prometheus 文本格式
+
+        Args:
+            reports (list): StageMetrics.report() 的列表
+    """
+    lines = []
+    for field, metric, help_text in PROMETHEUS_METRICS:
+        lines.append('# HELP {} {}'.format(metric, help_text))
+        lines.append('# TYPE {} gauge'.format(metric))
+        for report in reports:
+            for stage, record in report['stages'].items():
+                if record.get(field) is None:
+                    continue
+                lines.append('{}{{video="{}",stage="{}",state="{}",cached="{}"}} {}'.format(
+                    metric, _label_value(os.path.basename(report['video_path'])), _label_value(stage),
+                    _label_value(record['state']), str(record['cached']).lower(), float(record[field])))
+    return '\n'.join(lines) + '\n'
+
+
+def write_prometheus(path: str, reports: List[Dict]):
+    """ 将统计写入 Prometheus 文本文件（可由 node_exporter 的 textfile collector 读取），先写临时文件再替换 """
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        f.write(prometheus_text(reports))
+    os.replace(temp_path, path)
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Author: Wang Zifan
+
+"""按处理步骤调度多个任务，不同任务的不同步骤可以同时进行"""
+import queue
+import threading
+import time
+import traceback
+from typing import Callable, Dict, List
+
+
+class Stage:
+    """ 处理步骤（调度图中的一个节点）
+
+        Attributes:
+            name (str): 步骤名
+            func (Callable): 处理函数，参数为任务对象，出错时抛出异常
+            max_workers (int): 该步骤最多同时处理的任务数
+            deps (list): 依赖的步骤名，这些步骤都完成后才开始该步骤
+            always_run (bool): 依赖的步骤失败时是否仍然执行（如清理文件）
+    """
+
+    def __init__(self, name: str, func: Callable, max_workers: int = 1, deps: List[str] = None,
+                 always_run: bool = False):
+        self.name = name
+        self.func = func
+        self.max_workers = max_workers
+        self.deps = list(deps) if deps is not None else []
+        self.always_run = always_run
+
+
+class StageScheduler:
+    """ 步骤调度器
+
+        每个步骤有自己的任务队列和 max_workers 个工作线程，一个任务的某个步骤完成后，
+        依赖它的步骤在依赖全部完成时进入各自的队列。这样任务N在语音分离时，
+        任务N+1可以在音视频分离、任务N-1可以在语音识别，cpu密集和io密集的步骤同时进行。
+
+        Author: Wang Zifan
+        Date: 2022/05/10
+
+        Attributes:
+            stages (list): 处理步骤，需按依赖顺序排列（被依赖的步骤在前）
+    """
+
+    def __init__(self, stages: List[Stage]):
+        self.stages = {}
+        for stage in stages:
+            for dep in stage.deps:
+                assert dep in self.stages, '步骤 {} 依赖的 {} 不存在或排在其后'.format(stage.name, dep)
+            self.stages[stage.name] = stage
+        # 依赖某个步骤的步骤名
+        self.dependents = {name: [] for name in self.stages}
+        for stage in stages:
+            for dep in stage.deps:
+                self.dependents[dep].append(stage.name)
+        self.queues = {name: queue.Queue() for name in self.stages}
+        self.lock = threading.Lock()
+        # 每个任务各步骤的状态：'等待'、'排队'、'进行中'、'完成'、'失败'、'跳过'
+        self.job_states = []
+        # 每个任务的错误信息
+        self.job_errors = []
+        self.jobs = []
+        # 每个任务第一个步骤开始和最后一个步骤结束的时间
+        self.job_start_times = []
+        self.job_end_times = []
+        # 未结束的任务数
+        self.num_unfinished = 0
+        self.all_done = threading.Condition(self.lock)
+        self.workers = []
+
+    def start(self):
+        """ 启动所有步骤的工作线程 """
+        for stage in self.stages.values():
+            for _ in range(stage.max_workers):
+                worker = threading.Thread(target=self.worker_loop, args=(stage,), daemon=True)
+                worker.start()
+                self.workers.append(worker)
+
+    def submit(self, job) -> int:
+        """ 提交一个任务，返回任务序号 """
+        with self.lock:
+            job_index = len(self.jobs)
+            self.jobs.append(job)
+            self.job_states.append({name: '等待' for name in self.stages})
+            self.job_errors.append('')
+            self.job_start_times.append(None)
+            self.job_end_times.append(None)
+            self.num_unfinished += 1
+            ready = [name for name, stage in self.stages.items() if len(stage.deps) == 0]
+            for name in ready:
+                self.job_states[job_index][name] = '排队'
+        for name in ready:
+            self.queues[name].put(job_index)
+        return job_index
+
+    def wait(self):
+        """ 等待所有已提交的任务结束，然后结束工作线程 """
+        with self.all_done:
+            while self.num_unfinished > 0:
+                self.all_done.wait()
+        for stage in self.stages.values():
+            for _ in range(stage.max_workers):
+                self.queues[stage.name].put(None)
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+
+    def worker_loop(self, stage: Stage):
+        while True:
+            job_index = self.queues[stage.name].get()
+            if job_index is None:
+                break
+            with self.lock:
+                skip = any(self.job_states[job_index][dep] != '完成' for dep in stage.deps) and not stage.always_run
+                self.job_states[job_index][stage.name] = '跳过' if skip else '进行中'
+                if self.job_start_times[job_index] is None:
+                    self.job_start_times[job_index] = time.time()
+            if not skip:
+                try:
+                    stage.func(self.jobs[job_index])
+                    state = '完成'
+                except Exception:
+                    state = '失败'
+                    traceback.print_exc()
+                    with self.lock:
+                        self.job_errors[job_index] += '[{}] {}'.format(stage.name, traceback.format_exc())
+                with self.lock:
+                    self.job_states[job_index][stage.name] = state
+            self.finish_stage(job_index, stage.name)
+
+    def finish_stage(self, job_index: int, name: str):
+        """ 某个步骤结束（完成、失败或跳过）后，将依赖全部结束的后续步骤放入队列 """
+        ready = []
+        with self.lock:
+            states = self.job_states[job_index]
+            for dependent in self.dependents[name]:
+                # 有多个依赖时只放入队列一次
+                if states[dependent] == '等待' and \
+                        all(states[dep] in ['完成', '失败', '跳过'] for dep in self.stages[dependent].deps):
+                    states[dependent] = '排队'
+                    ready.append(dependent)
+            if all(state in ['完成', '失败', '跳过'] for state in states.values()):
+                self.job_end_times[job_index] = time.time()
+                self.num_unfinished -= 1
+                self.all_done.notify_all()
+        for dependent in ready:
+            self.queues[dependent].put(job_index)
+
+    def job_succeeded(self, job_index: int) -> bool:
+        """ 任务的所有步骤是否都已完成 """
+        with self.lock:
+            return all(state == '完成' for state in self.job_states[job_index].values())
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        """ 各步骤处于各状态的任务数 """
+        with self.lock:
+            result = {name: {} for name in self.stages}
+            for states in self.job_states:
+                for name, state in states.items():
+                    result[name][state] = result[name].get(state, 0) + 1
+            return result
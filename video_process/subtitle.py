@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Author: Wang Zifan
+
+"""字幕（SRT/WebVTT）输出"""
+
+
+def format_timestamp(seconds: float, decimal_marker: str = ',') -> str:
+    """ 将秒数转为 时:分:秒,毫秒 格式，SRT 用逗号、WebVTT 用点号分隔毫秒 """
+    milliseconds = int(round(seconds * 1000))
+    hours, milliseconds = divmod(milliseconds, 3600000)
+    minutes, milliseconds = divmod(milliseconds, 60000)
+    seconds, milliseconds = divmod(milliseconds, 1000)
+    return '{:02d}:{:02d}:{:02d}{}{:03d}'.format(hours, minutes, seconds, decimal_marker, milliseconds)
+
+
+class SubtitleWriter:
+    """ 字幕写入器，每识别完一句就追加一条字幕，不必等整个音频识别结束
+
+        Author: Wang Zifan
+        Date: 2022/05/09
+
+        Attributes:
+            path (str): 字幕文件路径
+            subtitle_format (str): 'srt' 或 'vtt'
+    """
+
+    def __init__(self, path: str, subtitle_format: str = 'srt'):
+        assert subtitle_format in ['srt', 'vtt']
+        self.path = path
+        self.subtitle_format = subtitle_format
+        # 已写入的字幕条数
+        self.num_cues = 0
+        self.file = open(path, 'w', encoding='utf-8')
+        if subtitle_format == 'vtt':
+            self.file.write('WEBVTT\n\n')
+        self.file.flush()
+
+    def write(self, start: float, end: float, text: str):
+        """ 追加一条字幕
+
+            Args:
+                start (float): 开始时间（秒）
+                end (float): 结束时间（秒）
+                text (str): 字幕文本，为空时不写入
+        """
+        if text == '':
+            return
+        self.num_cues += 1
+        if self.subtitle_format == 'srt':
+            self.file.write('{}\n{} --> {}\n{}\n\n'.format(self.num_cues, format_timestamp(start, ','),
+                                                         format_timestamp(end, ','), text))
+        else:
+            self.file.write('{} --> {}\n{}\n\n'.format(format_timestamp(start, '.'), format_timestamp(end, '.'),
+                                                     text))
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
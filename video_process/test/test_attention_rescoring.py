@@ -0,0 +1,160 @@
+# Author: Wang Zifan
+#  Apache 2.0  (http://www.apache.org/licenses/LICENSE-2.0)
+"""Compare the gather based attention rescoring with per token loops."""
+
+import random
+
+import pytest
+import torch
+
+from wenet.transformer.asr_model import init_asr_model
+
+VOCAB_SIZE = 12
+
+
+def build_model(bidirectional: bool, input_layer: str = 'conv2d'):
+    torch.manual_seed(0)
+    configs = {
+        'cmvn_file': None,
+        'input_dim': 20,
+        'output_dim': VOCAB_SIZE,
+        'encoder': 'conformer',
+        'decoder': 'bitransformer' if bidirectional else 'transformer',
+        'encoder_conf': dict(output_size=32, attention_heads=2,
+                             linear_units=64, num_blocks=1,
+                             input_layer=input_layer),
+        'decoder_conf': dict(attention_heads=2, linear_units=64,
+                             num_blocks=2,
+                             **({'r_num_blocks': 1} if bidirectional
+                                else {})),
+        'model_conf': dict(ctc_weight=0.3,
+                           reverse_weight=0.3 if bidirectional else 0.0),
+    }
+    model = init_asr_model(configs)
+    model.eval()
+    return model
+
+
+def loop_score(logp, hyp, eos):
+    """Score of one hyp from its decoder log probs, (len(hyp) + 1, vocab)"""
+    score = 0.0
+    for j, w in enumerate(hyp):
+        score += logp[j][w].item()
+    return score + logp[len(hyp)][eos].item()
+
+
+def loop_rescoring(model, hyps_list, encoder_out, encoder_mask, ctc_weight,
+                   reverse_weight):
+    """Decode every hyp on its own and score it with python loops, on the
+    encoder output of the batch
+    """
+    best_hyps = []
+    for i, utt_hyps in enumerate(hyps_list):
+        length = int(encoder_mask[i, 0].sum())
+        memory = encoder_out[i:i + 1, :length]
+        memory_mask = encoder_mask[i:i + 1, :, :length]
+        best_score, best_hyp = -float('inf'), []
+        for hyp, ctc_score in utt_hyps:
+            ys_in = torch.tensor([[model.sos] + list(hyp)])
+            r_ys_in = torch.tensor([[model.sos] + list(hyp)[::-1]])
+            ys_lens = torch.tensor([len(hyp) + 1])
+            decoder_out, r_decoder_out, _ = model.decoder(
+                memory, memory_mask, ys_in, ys_lens, r_ys_in,
+                reverse_weight)
+            score = loop_score(decoder_out[0].log_softmax(-1), hyp,
+                               model.eos)
+            if reverse_weight > 0:
+                r_score = loop_score(r_decoder_out[0].log_softmax(-1),
+                                     hyp[::-1], model.eos)
+                score = score * (1 - reverse_weight) + \
+                    r_score * reverse_weight
+            score += ctc_score * ctc_weight
+            if score > best_score:
+                best_score, best_hyp = score, list(hyp)
+        best_hyps.append(best_hyp)
+    return best_hyps
+
+
+@pytest.mark.parametrize('seed', range(10))
+def test_sum_target_logp_matches_loop(seed):
+    model = build_model(False)
+    generator = torch.Generator().manual_seed(seed)
+    num_hyps = int(torch.randint(1, 8, (1, ), generator=generator))
+    lens = torch.randint(0, 9, (num_hyps, ), generator=generator)
+    max_len = int(lens.max()) + 1
+    logp = torch.randn(num_hyps, max_len, VOCAB_SIZE,
+                       generator=generator).log_softmax(-1)
+    ys_out = torch.full((num_hyps, max_len), model.ignore_id)
+    hyps = []
+    for i, length in enumerate(lens.tolist()):
+        hyp = torch.randint(1, VOCAB_SIZE - 1, (length, ),
+                            generator=generator).tolist()
+        ys_out[i, :length + 1] = torch.tensor(hyp + [model.eos])
+        hyps.append(hyp)
+    expected = [loop_score(logp[i], hyp, model.eos)
+                for i, hyp in enumerate(hyps)]
+    actual = model._sum_target_logp(logp, ys_out).tolist()
+    assert actual == pytest.approx(expected, abs=1e-5)
+
+
+@pytest.mark.parametrize('bidirectional', [False, True])
+@pytest.mark.parametrize('seed', range(5))
+def test_batch_rescoring_matches_loop(bidirectional, seed):
+    model = build_model(bidirectional)
+    rng = random.Random(seed)
+    torch.manual_seed(seed)
+    batch_size = 4
+    speech_lengths = torch.tensor([rng.randint(20, 60)
+                                   for _ in range(batch_size)])
+    speech = torch.randn(batch_size, int(speech_lengths.max()), 20)
+    with torch.no_grad():
+        encoder_out, encoder_mask = model._forward_encoder_batch(
+            speech, speech_lengths)
+        hyps_list = []
+        for i in range(batch_size):
+            # utterances have different nbest sizes, the last one is empty
+            num_hyps = 0 if i == batch_size - 1 else rng.randint(1, 6)
+            utt_hyps = [(tuple(rng.randint(1, VOCAB_SIZE - 2)
+                               for _ in range(rng.randint(0, 6))),
+                         -rng.random() * 5) for _ in range(num_hyps)]
+            if num_hyps > 1:
+                # a duplicated hyp must get the same score in another row
+                utt_hyps.insert(rng.randrange(num_hyps), utt_hyps[-1])
+            hyps_list.append(utt_hyps)
+        reverse_weight = 0.3 if bidirectional else 0.0
+        expected = loop_rescoring(model, hyps_list, encoder_out,
+                                  encoder_mask, 0.5, reverse_weight)
+        actual = model._batch_attention_rescoring(hyps_list, encoder_out,
+                                                  encoder_mask, 0.5,
+                                                  reverse_weight)
+    assert actual == expected
+
+
+@pytest.mark.parametrize('input_layer', ['conv2d', 'conv2d6', 'conv2d8'])
+@pytest.mark.parametrize('bidirectional', [False, True])
+@pytest.mark.parametrize('seed', range(3))
+def test_padded_batch_matches_per_utterance(input_layer, bidirectional,
+                                            seed):
+    # padding must not leak into the encoder output or the searched frames
+    model = build_model(bidirectional, input_layer)
+    generator = torch.Generator().manual_seed(seed)
+    batch_size = 4
+    speech_lengths = torch.randint(20, 90, (batch_size, ),
+                                   generator=generator)
+    speech = torch.randn(batch_size, int(speech_lengths.max()), 20,
+                         generator=generator)
+    reverse_weight = 0.3 if bidirectional else 0.0
+    with torch.no_grad():
+        ctc_batch = model.ctc_prefix_beam_search_batch(
+            speech, speech_lengths, 4)
+        rescoring_batch = model.attention_rescoring_batch(
+            speech, speech_lengths, 4, ctc_weight=0.5,
+            reverse_weight=reverse_weight)
+        for i in range(batch_size):
+            utt = speech[i:i + 1, :speech_lengths[i]]
+            utt_lengths = speech_lengths[i:i + 1]
+            assert list(model.ctc_prefix_beam_search(
+                utt, utt_lengths, 4)) == ctc_batch[i]
+            assert model.attention_rescoring(
+                utt, utt_lengths, 4, ctc_weight=0.5,
+                reverse_weight=reverse_weight) == rescoring_batch[i]
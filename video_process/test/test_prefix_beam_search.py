@@ -0,0 +1,53 @@
+# Author: Wang Zifan
+#  Apache 2.0  (http://www.apache.org/licenses/LICENSE-2.0)
+"""Compare the vectorized CTC prefix beam search with the loop version."""
+
+import pytest
+import torch
+
+from wenet.utils.prefix_beam_search import (prefix_beam_search,
+                                            prefix_beam_search_loop)
+
+
+def assert_same_nbest(ctc_probs, beam_size):
+    expected = prefix_beam_search_loop(ctc_probs, beam_size)
+    actual = prefix_beam_search(ctc_probs, beam_size)
+    assert [prefix for prefix, _ in actual] == \
+        [prefix for prefix, _ in expected]
+    assert [score for _, score in actual] == \
+        pytest.approx([score for _, score in expected], abs=1e-6)
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_random_probs(seed):
+    generator = torch.Generator().manual_seed(seed)
+    maxlen = int(torch.randint(1, 40, (1, ), generator=generator))
+    vocab_size = int(torch.randint(2, 12, (1, ), generator=generator))
+    beam_size = int(torch.randint(1, vocab_size + 1, (1, ),
+                                  generator=generator))
+    logits = torch.randn(maxlen, vocab_size, generator=generator) * 3
+    assert_same_nbest(logits.log_softmax(dim=-1), beam_size)
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_tied_probs(seed):
+    # few distinct logits, so tokens of a frame and hypotheses tie
+    generator = torch.Generator().manual_seed(seed)
+    maxlen = int(torch.randint(1, 30, (1, ), generator=generator))
+    vocab_size = int(torch.randint(2, 8, (1, ), generator=generator))
+    beam_size = int(torch.randint(1, vocab_size + 1, (1, ),
+                                  generator=generator))
+    logits = torch.randint(0, 2, (maxlen, vocab_size),
+                           generator=generator).float()
+    assert_same_nbest(logits.log_softmax(dim=-1), beam_size)
+
+
+def test_uniform_probs():
+    ctc_probs = torch.full((12, 5), 0.2).log()
+    assert_same_nbest(ctc_probs, 5)
+
+
+def test_empty_input():
+    ctc_probs = torch.zeros(0, 4)
+    assert prefix_beam_search(ctc_probs, 3) == \
+        prefix_beam_search_loop(ctc_probs, 3)
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Author: Wang Zifan
+
+"""批量识别与逐段识别的结果相同，与语音段被分到哪一批无关"""
+import pickle
+
+import numpy as np
+import pytest
+import torch
+import yaml
+
+from recognize_single_wav import SpeechRecognizer
+from wenet.transformer.asr_model import init_asr_model
+
+VOCAB_SIZE = 12
+
+
+@pytest.fixture(scope='module')
+def model_files(tmp_path_factory):
+    """ 随机初始化的小模型及其配置、词典 """
+    model_dir = tmp_path_factory.mktemp('model')
+    configs = {
+        'cmvn_file': None,
+        'is_json_cmvn': True,
+        'input_dim': 80,
+        'output_dim': VOCAB_SIZE,
+        'encoder': 'conformer',
+        'decoder': 'bitransformer',
+        'encoder_conf': dict(output_size=32, attention_heads=2, linear_units=64, num_blocks=2,
+                             input_layer='conv2d'),
+        'decoder_conf': dict(attention_heads=2, linear_units=64, num_blocks=1, r_num_blocks=1),
+        'model_conf': dict(ctc_weight=0.3, reverse_weight=0.3),
+        'collate_conf': {'feature_extraction_conf': dict(mel_bins=80, frame_length=25, frame_shift=10)},
+    }
+    torch.manual_seed(0)
+    model = init_asr_model(configs)
+    # 放大 ctc 输出层，使随机模型也能输出较多的 token
+    with torch.no_grad():
+        model.ctc.ctc_lo.weight.mul_(8)
+    torch.save(model.state_dict(), str(model_dir / 'final.pt'))
+    with open(model_dir / 'train.yaml', 'w') as f:
+        yaml.dump(configs, f)
+    with open(model_dir / 'char_dict.pkl', 'wb') as f:
+        pickle.dump({i: chr(ord('a') + i) for i in range(VOCAB_SIZE)}, f)
+    return {
+        'model_path': str(model_dir / 'final.pt'),
+        'model_config_path': str(model_dir / 'train.yaml'),
+        'cmvn_file': None,
+        'dict_path': '',
+        'dict_pickle_path': str(model_dir / 'char_dict.pkl'),
+    }
+
+
+@pytest.mark.parametrize('mode', ['attention_rescoring', 'ctc_prefix_beam_search', 'ctc_greedy_search',
+                                  'attention'])
+def test_recognize_batch_matches_recognize_pcm(model_files, mode):
+    recognizer = SpeechRecognizer(mode=mode, beam_size=4, reverse_weight=0.3 if mode == 'attention_rescoring'
+                                  else 0.0, **model_files)
+    rng = np.random.default_rng(0)
+    # 长度各不相同的语音段，补齐后一起解码
+    pcms = [(rng.standard_normal(int(rng.integers(4000, 20000))) * 3000).astype(np.int16).tobytes()
+            for _ in range(7)]
+    expected = [recognizer.recognize_pcm(pcm, 16000) for pcm in pcms]
+    assert any(text != '' for text in expected)
+    for batch_size in [1, 3, 8]:
+        segments = [torch.from_numpy(np.frombuffer(pcm, dtype=np.int16).astype(np.float32)).unsqueeze(0)
+                    for pcm in pcms]
+        assert recognizer.recognize_batch(segments, 16000, batch_size=batch_size) == expected
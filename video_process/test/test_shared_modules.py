@@ -0,0 +1,29 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Author: Wang Zifan
+
+"""get_video 中复制自 video_process 的模块，复制的类和函数与原文件相同"""
+import ast
+import os
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def top_level_definitions(path: str) -> dict:
+    """ 模块中顶层的类和函数：名称 -> 源代码 """
+    with open(path, encoding='utf-8') as f:
+        source = f.read()
+    return {node.name: ast.get_source_segment(source, node) for node in ast.parse(source).body
+            if isinstance(node, (ast.ClassDef, ast.FunctionDef))}
+
+
+@pytest.mark.parametrize('name', ['log_tailer.py', 'progress.py'])
+def test_copied_definitions_unchanged(name):
+    copy = top_level_definitions(os.path.join(ROOT, 'get_video', name))
+    original = top_level_definitions(os.path.join(ROOT, 'video_process', name))
+    assert len(copy) > 0
+    for definition, source in copy.items():
+        assert source == original.get(definition), \
+            definition + ' 与 video_process/' + name + ' 中的不一致，修改时需同步修改两处'
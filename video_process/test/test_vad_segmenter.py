@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Author: Wang Zifan
+
+"""流式切分与基线逐帧读取 wav 的切分结果相同"""
+import wave
+
+import numpy as np
+import pytest
+
+webrtcvad = pytest.importorskip('webrtcvad')
+
+from vad_segmenter import VadSegmenter  # noqa: E402
+
+
+def segment_loop(wav_path: str) -> list:
+    """ 基线（dbc1192）split_and_recognize_wav 中的切分循环，原样保留，
+        只把写文件并识别换成记录这一段的 PCM 数据，返回各段的 PCM 数据
+    """
+    segments = []
+    # 读取更改后的音频文件
+    rf = wave.open(wav_path, "rb")
+    # 获取音频参数
+    # 通道数，vad只支持单通道
+    channels = rf.getnchannels()
+    # 每个通道的采样率，vad只支持8k、16k、32k和48k
+    rate = rf.getframerate()
+    # 采样大小（每次采样数据的字节数），vad只支持2
+    samp_width = rf.getsampwidth()
+    # vad采样大小只支持2
+    assert samp_width == 2
+
+    # 定义帧长，vad只支持10、20和30ms
+    frame_duration_ms = 20
+    # 读取数据块大小（每一帧每个通道上的采样次数）（除以通道数和乘以采样大小分之2来进行勉强的纠正）
+    chunk_size = int(rate * frame_duration_ms / 1000 / channels * 2 / samp_width)
+    # 判断人声的敏感程度（一般为1~3,3为最敏感）
+    vad = webrtcvad.Vad(3)
+
+    buffer_data = b''
+    temp = []
+    # 上一段是否为人声
+    pre_is_speech = False
+    # 当前已读的帧数
+    num_frames_i = 0
+    while True:
+        # 读取一帧的数据
+        data = rf.readframes(chunk_size)
+        num_frames_i += 1
+        len_data = len(data)
+        # 如果这一帧是最后一帧
+        if len_data < chunk_size * channels * samp_width:
+            buffer_data += data
+            # 如果上一段有人声，则将数据写入文件
+            if pre_is_speech:
+                segments.append(buffer_data)
+            buffer_data = b''
+            temp = []
+            # 结束循环
+            break
+        # 否则
+        else:
+            is_speech = vad.is_speech(data, rate)
+        # 将这一帧的数据和判断结果放入缓存
+        buffer_data += data
+        temp += [is_speech]
+
+        # buffer_data里面包含数据的帧数
+        numframes_buffer_data = int(len(buffer_data) / chunk_size / 2)
+        # cache_size帧里面有大于等于threshold帧是人声，就认为这一段(cache_size帧)是人声
+        # 根据buffer_data里面包含数据的帧数动态调整切分窗口
+        # 小于3秒，什么都不做。如果连续1秒没人声，则删除这1秒
+        if numframes_buffer_data <= 150:
+            cache_size = 0
+            threshold = 0
+            # 每30帧判断一次，判断当前buffer_data里面的数据是否为人声
+            if numframes_buffer_data % 30 == 0:
+                # 不是人声，则清空缓存
+                if sum(temp) < numframes_buffer_data / 10:
+                    pre_is_speech = False
+                    buffer_data = b''
+                    temp = []
+                # 是人声。本阶段最后一次判断时，清空temp,以便后续判断
+                else:
+                    pre_is_speech = True
+                    if numframes_buffer_data == 150:
+                        temp = []
+        # 3到5秒，正常切分
+        elif numframes_buffer_data < 250:
+            cache_size = 10
+            threshold = 2
+        # 5到7秒，按较小的窗口切分
+        elif numframes_buffer_data < 350:
+            cache_size = 5
+            threshold = 2
+        # 7到9秒，按更小的窗口切分
+        elif numframes_buffer_data < 450:
+            cache_size = 3
+            threshold = 2
+        # 9到16秒，逐一判断
+        elif numframes_buffer_data < 800:
+            cache_size = 1
+            threshold = 1
+        # 16秒，达到最大长度，强制切分，将buffer_data里面的数据写入文件并语音识别，然后清空缓存，回归初始状态
+        else:
+            cache_size = 0
+            threshold = 0
+            pre_is_speech = False
+            segments.append(buffer_data)
+            buffer_data = b''
+            temp = []
+
+        # 如果缓存满了
+        if len(temp) >= cache_size > 0:
+            num_is_speech = sum(temp)
+            # cache_size帧里面有大于等于threshold帧是人声，就认为这一段(cache_size帧)是人声
+            if num_is_speech >= threshold:
+                # 如果是人声，清空判断结果缓存
+                pre_is_speech = True
+                temp = []
+            # 如果这一段不是人声且上一段是人声，就将缓存中的所有数据写入文件并清空缓存
+            elif pre_is_speech == True:
+                pre_is_speech = False
+                segments.append(buffer_data)
+                buffer_data = b''
+                temp = []
+            # 如果这一段不是人声且上一段也不是人声
+            else:
+                # 如果后(threshold-1)帧为人声，则认为这一段是人声
+                if 0 < num_is_speech == sum(temp[cache_size - threshold + 1:cache_size]):
+                    pre_is_speech = True
+                    temp = []
+                # 否则清空缓存
+                else:
+                    buffer_data = b''
+                    temp = []
+    rf.close()
+    return segments
+
+
+def synthetic_audio(rng, rate: int = 16000) -> bytes:
+    """ 随机长度的类人声（谐波加噪声）与静音交替 """
+    parts = []
+    for _ in range(rng.integers(5, 25)):
+        duration = rng.uniform(0.02, 20.0) if rng.random() < 0.5 else rng.uniform(0.02, 3.0)
+        n = int(duration * rate)
+        if rng.random() < 0.55:
+            t = np.arange(n) / rate
+            f0 = rng.uniform(100, 250)
+            signal = sum(np.sin(2 * np.pi * f0 * k * t) / k for k in range(1, 8))
+            signal *= 0.5 + 0.5 * np.sin(2 * np.pi * rng.uniform(2, 6) * t)
+            signal = signal * 6000 + rng.normal(0, 300, n)
+        else:
+            signal = rng.normal(0, rng.choice([5, 50]), n)
+        parts.append(signal)
+    audio = np.clip(np.concatenate(parts), -32768, 32767).astype(np.int16)
+    # 一半的情况下长度恰好为整数帧
+    if rng.random() < 0.5:
+        audio = audio[:len(audio) - len(audio) % 320]
+    return audio.tobytes()
+
+
+@pytest.mark.parametrize('seed', range(8))
+def test_same_segments_as_loop(seed, tmp_path):
+    rng = np.random.default_rng(seed)
+    data = synthetic_audio(rng)
+    wav_path = str(tmp_path / 'audio.wav')
+    wf = wave.open(wav_path, "wb")
+    wf.setnchannels(1)
+    wf.setsampwidth(2)
+    wf.setframerate(16000)
+    wf.writeframes(data)
+    wf.close()
+    block_bytes = int(rng.integers(1, 50000))
+    chunks = (data[i:i + block_bytes] for i in range(0, len(data), block_bytes))
+    segments = list(VadSegmenter(16000, 1, 2).segment(chunks))
+    assert [pcm for _, _, pcm in segments] == segment_loop(wav_path)
+    # 起止采样点与数据一致
+    for start, end, pcm in segments:
+        assert data[start * 2:end * 2] == pcm
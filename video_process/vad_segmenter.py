@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Author: Wang Zifan
+
+"""基于 VAD 的流式语音切分"""
+import sys
+import time
+import wave
+from typing import Iterable, Iterator, Optional, Tuple
+
+import numpy as np
+import webrtcvad
+
+
+class VadSegmenter:
+    """ 流式语音切分器
+
+        逐块输入 PCM 数据，切分出语音段后以 (start_sample, end_sample, pcm) 的形式产出。
+        内部只保存当前这一段的数据（最长16秒），内存占用与输入总长度无关，
+        可以处理文件、ffmpeg 管道或实时流。
+
+        切分策略：缓存不足3秒时每30帧判断一次，1秒内人声帧少于1/10则丢弃；
+        3~5秒、5~7秒、7~9秒、9~16秒分别以 10、5、3、1 帧为窗口，窗口内人声帧数
+        达到 threshold 认为是人声，否则在此处切分；达到16秒时强制切分。
+
+        Author: Wang Zifan
+        Date: 2022/05/09
+
+        Attributes:
+            rate (int): 采样率，vad只支持8k、16k、32k和48k
+            channels (int): 通道数，vad只支持单通道
+            samp_width (int): 采样大小（每次采样数据的字节数），vad只支持2
+            frame_duration_ms (int): 帧长，vad只支持10、20和30ms
+            aggressiveness (int): 判断人声的敏感程度（一般为1~3,3为最敏感）
+            max_frames (int): 一段语音的最大帧数，超过则强制切分
+    """
+
+    def __init__(self, rate: int = 16000, channels: int = 1, samp_width: int = 2, frame_duration_ms: int = 20,
+                 aggressiveness: int = 3, max_frames: int = 800):
+        # vad采样大小只支持2
+        assert samp_width == 2
+        self.rate = rate
+        self.channels = channels
+        self.samp_width = samp_width
+        self.max_frames = max_frames
+        # 读取数据块大小（每一帧每个通道上的采样次数）（除以通道数和乘以采样大小分之2来进行勉强的纠正）
+        self.chunk_size = int(rate * frame_duration_ms / 1000 / channels * 2 / samp_width)
+        # 每一帧的字节数
+        self.frame_bytes = self.chunk_size * channels * samp_width
+        self.vad = webrtcvad.Vad(aggressiveness)
+        # 预分配的PCM缓存，buffer_len为已使用的字节数，追加一帧的开销是常数
+        self.buffer_data = bytearray((max_frames + 1) * self.frame_bytes)
+        self.buffer_len = 0
+        # 缓存中第一个采样点在整个流中的位置
+        self.buffer_start = 0
+        # 人声判断结果缓存（最多150帧），num_flags为已使用的长度，num_speech为其中人声的帧数
+        self.temp = np.zeros(150, dtype=bool)
+        self.num_flags = 0
+        self.num_speech = 0
+        # 上一段是否为人声
+        self.pre_is_speech = False
+        # 已输入的采样点数
+        self.num_samples = 0
+        # 不足一帧的输入，等待下一块数据补齐
+        self.pending = bytearray()
+        # 已处理的帧数
+        self.num_frames = 0
+
+    def feed(self, data: bytes) -> Iterator[Tuple[int, int, bytes]]:
+        """ 输入任意长度的 PCM 数据，产出其中切分完成的语音段
+
+            Args:
+                data (bytes): int16 PCM 数据
+
+            Yields:
+                (start_sample, end_sample, pcm): 语音段的起止采样点和数据
+        """
+        if len(self.pending) > 0:
+            self.pending += data
+            data = bytes(self.pending)
+            self.pending = bytearray()
+        view = memoryview(data)
+        offset = 0
+        while len(data) - offset >= self.frame_bytes:
+            segment = self.push_frame(view[offset:offset + self.frame_bytes])
+            offset += self.frame_bytes
+            if segment is not None:
+                yield segment
+        self.pending += view[offset:]
+
+    def flush(self) -> Iterator[Tuple[int, int, bytes]]:
+        """ 输入结束，产出最后一段语音（如果上一段有人声），并回到初始状态 """
+        data = bytes(self.pending)
+        self.pending = bytearray()
+        self.append(data)
+        if self.pre_is_speech:
+            yield self.pop_segment()
+        self.pre_is_speech = False
+        self.reset()
+
+    def segment(self, chunks: Iterable[bytes]) -> Iterator[Tuple[int, int, bytes]]:
+        """ 对整个数据流切分
+
+            Args:
+                chunks (Iterable[bytes]): PCM 数据块，如文件或管道的逐块读取结果
+
+            Yields:
+                (start_sample, end_sample, pcm): 语音段的起止采样点和数据
+        """
+        for data in chunks:
+            yield from self.feed(data)
+        yield from self.flush()
+
+    def append(self, data: bytes):
+        """ 将数据追加到缓存 """
+        len_data = len(data)
+        self.buffer_data[self.buffer_len:self.buffer_len + len_data] = data
+        self.buffer_len += len_data
+        self.num_samples += len_data // (self.channels * self.samp_width)
+
+    def reset(self, keep_data: bool = False):
+        """ 清空判断结果缓存，keep_data 为 False 时同时清空数据缓存 """
+        self.num_flags = 0
+        self.num_speech = 0
+        if not keep_data:
+            self.buffer_len = 0
+            self.buffer_start = self.num_samples
+
+    def pop_segment(self) -> Tuple[int, int, bytes]:
+        """ 取出缓存中的数据作为一段语音，并清空缓存 """
+        pcm = bytes(memoryview(self.buffer_data)[:self.buffer_len])
+        segment = (self.buffer_start, self.num_samples, pcm)
+        self.reset()
+        return segment
+
+    def push_frame(self, data: bytes) -> Optional[Tuple[int, int, bytes]]:
+        """ 处理完整的一帧数据
+
+            Args:
+                data (bytes): 一帧 PCM 数据
+
+            Returns:
+                切分完成时返回 (start_sample, end_sample, pcm)，否则返回 None
+        """
+        segment = None
+        self.num_frames += 1
+        is_speech = self.vad.is_speech(data, self.rate)
+        # 将这一帧的数据和判断结果放入缓存
+        self.append(data)
+        self.temp[self.num_flags] = is_speech
+        self.num_flags += 1
+        self.num_speech += is_speech
+
+        # buffer_data里面包含数据的帧数
+        numframes_buffer_data = int(self.buffer_len / self.chunk_size / 2)
+        # cache_size帧里面有大于等于threshold帧是人声，就认为这一段(cache_size帧)是人声
+        # 根据buffer_data里面包含数据的帧数动态调整切分窗口
+        # 小于3秒，什么都不做。如果连续1秒没人声，则删除这1秒
+        if numframes_buffer_data <= 150:
+            cache_size = 0
+            threshold = 0
+            # 每30帧判断一次，判断当前buffer_data里面的数据是否为人声
+            if numframes_buffer_data % 30 == 0:
+                # 不是人声，则清空缓存
+                if self.num_speech < numframes_buffer_data / 10:
+                    self.pre_is_speech = False
+                    self.reset()
+                # 是人声。本阶段最后一次判断时，清空temp,以便后续判断
+                else:
+                    self.pre_is_speech = True
+                    if numframes_buffer_data == 150:
+                        self.reset(keep_data=True)
+        # 3到5秒，正常切分
+        elif numframes_buffer_data < 250:
+            cache_size = 10
+            threshold = 2
+        # 5到7秒，按较小的窗口切分
+        elif numframes_buffer_data < 350:
+            cache_size = 5
+            threshold = 2
+        # 7到9秒，按更小的窗口切分
+        elif numframes_buffer_data < 450:
+            cache_size = 3
+            threshold = 2
+        # 9到16秒，逐一判断
+        elif numframes_buffer_data < self.max_frames:
+            cache_size = 1
+            threshold = 1
+        # 16秒，达到最大长度，强制切分，然后清空缓存，回归初始状态
+        else:
+            cache_size = 0
+            threshold = 0
+            self.pre_is_speech = False
+            segment = self.pop_segment()
+
+        # 如果缓存满了
+        if self.num_flags >= cache_size > 0:
+            num_is_speech = self.num_speech
+            # cache_size帧里面有大于等于threshold帧是人声，就认为这一段(cache_size帧)是人声
+            if num_is_speech >= threshold:
+                # 如果是人声，清空判断结果缓存
+                self.pre_is_speech = True
+                self.reset(keep_data=True)
+            # 如果这一段不是人声且上一段是人声，就切分出缓存中的所有数据并清空缓存
+            elif self.pre_is_speech:
+                self.pre_is_speech = False
+                segment = self.pop_segment()
+            # 如果这一段不是人声且上一段也不是人声
+            else:
+                # 如果后(threshold-1)帧为人声，则认为这一段是人声
+                if 0 < num_is_speech == np.count_nonzero(self.temp[cache_size - threshold + 1:cache_size]):
+                    self.pre_is_speech = True
+                    self.reset(keep_data=True)
+                # 否则清空缓存
+                else:
+                    self.reset()
+        return segment
+
+
+def benchmark_vad_segmenter(wav_path: str, block_frames: int = 50) -> float:
+    """ 测试切分速度，返回每秒处理的帧数
+
+        Args:
+            wav_path (str): 16k 单通道 wav 文件路径
+            block_frames (int): 每次输入的帧数
+    """
+    rf = wave.open(wav_path, "rb")
+    segmenter = VadSegmenter(rf.getframerate(), rf.getnchannels(), rf.getsampwidth())
+    data = rf.readframes(rf.getnframes())
+    rf.close()
+    block_bytes = block_frames * segmenter.frame_bytes
+    chunks = (data[i:i + block_bytes] for i in range(0, len(data), block_bytes))
+    start = time.time()
+    num_segments = sum(1 for _ in segmenter.segment(chunks))
+    elapsed = time.time() - start
+    frames_per_second = segmenter.num_frames / elapsed
+    print('frames: {}, segments: {}, {:.0f} frames/s'.format(segmenter.num_frames, num_segments,
+                                                             frames_per_second))
+    return frames_per_second
+
+
+if __name__ == '__main__':
+    benchmark_vad_segmenter(sys.argv[1])
@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Author: Wang Zifan
+
+"""批量视频分离和语音识别"""
+import argparse
+import os
+import threading
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import chardet
+
+from stage_cache import StageCache
+from stage_metrics import write_prometheus
+from stage_scheduler import Stage, StageScheduler
+
+# 视频文件后缀
+VIDEO_FORMATS = ['mp4', 'flv', 'mkv', 'avi', 'mov', 'wmv', 'webm', 'ts', 'm4v']
+
+
+def list_videos(input_path: str) -> list:
+    """ 获取待处理的视频列表
+
+        Args:
+            input_path (str): 视频目录，或每行一个视频路径的清单文件
+
+        Returns:
+            video_paths (list): 视频的绝对路径列表
+    """
+    if os.path.isdir(input_path):
+        return [os.path.join(os.path.abspath(input_path), name) for name in sorted(os.listdir(input_path))
+                if name.split('.')[-1].lower() in VIDEO_FORMATS]
+    # 获取文件编码格式
+    with open(input_path, 'rb') as f:
+        text = f.read()
+        code = chardet.detect(text)['encoding']
+    with open(input_path, 'r', encoding=code) as f:
+        # 将每一行存入列表，去除每一行首尾的回车和空格，空行不放入列表
+        line_list = [line.strip() for line in f.readlines() if line.strip() != '']
+    # 清单中的相对路径相对于清单文件所在目录
+    manifest_dir = os.path.dirname(os.path.abspath(input_path))
+    return [os.path.join(manifest_dir, line) for line in line_list]
+
+
+def init_worker(num_threads: int):
+    """ 工作进程初始化，限制每个进程的计算线程数，避免多个进程争抢cpu """
+    os.environ['OMP_NUM_THREADS'] = str(num_threads)
+    import torch
+    torch.set_num_threads(num_threads)
+
+
+def process_video(video_path: str, export_dir: str, cache_dir: str = None, cache_size: int = None,
+                  separator: str = 'engine', separation_window: float = 0.0, separation_workers: int = 1,
+                  separation_threads: int = 0) -> dict:
+    """ 在工作进程中处理一个视频，返回处理信息
+
+        Args:
+            video_path (str): 视频路径
+            export_dir (str): 该视频的输出目录
+            cache_dir (str): 步骤缓存目录，为 None 时不使用缓存
+            cache_size (int): 步骤缓存总大小上限（字节）
+            separator (str): 语音分离方式，'cli' 或 'engine'（每个工作进程的分离模型只加载一次）
+            separation_window (float): 大于0时按该长度（秒）分窗流式分离
+            separation_workers (int): 分离进程数，大于1时各窗口在进程池中并行分离
+            separation_threads (int): 每个分离进程的计算线程数，为0时不限制
+
+        Returns:
+            info (dict): video_path, state, duration（视频时长，秒）, elapsed（处理耗时，秒）,
+                num_sentences（识别出的句数）, error（失败原因）, metrics（各步骤的耗时和资源统计）
+    """
+    from media_probe import probe_media
+    from video_process import VideoProcessMainThread
+
+    start = time.time()
+    info = {'video_path': video_path, 'state': '处理完成', 'duration': 0.0, 'elapsed': 0.0, 'num_sentences': 0,
+            'error': '', 'metrics': None}
+    main_thread = None
+    try:
+        info['duration'] = probe_media(video_path).duration
+        stage_cache = StageCache(cache_dir, cache_size) if cache_dir is not None else None
+        main_thread = VideoProcessMainThread('1', video_path, export_dir, stage_cache, separator, separation_window,
+                                             separation_workers=separation_workers,
+                                             separation_threads=separation_threads)
+        # 在当前进程中直接运行，不再另开线程
+        main_thread.run()
+        info['num_sentences'] = len(main_thread.asr_result)
+    except Exception:
+        info['state'] = '处理失败'
+        info['error'] = traceback.format_exc()
+    if main_thread is not None:
+        info['metrics'] = main_thread.metrics.report()
+    info['elapsed'] = time.time() - start
+    return info
+
+
+def default_stage_workers() -> dict:
+    """ 各步骤默认的并发数：io密集的格式转化、音视频分离按cpu核数，
+        自身就会用满多核的语音分离和语音识别各1个 """
+    cpu_count = os.cpu_count() or 1
+    return {'convert': max(1, cpu_count // 4), 'demux': max(1, cpu_count // 4), 'separate': 1, 'asr': 1,
+            'clean': 1}
+
+
+class VideoBatchProcessMainThread(threading.Thread):
+    """ 批量视频分离和语音识别主线程
+
+        scheduler 为 'process' 时用进程池同时处理多个视频，每个进程完整处理一个视频；
+        为 'stage' 时在本进程中按步骤调度，每个步骤有自己的并发数，不同视频的不同步骤同时进行
+
+        Author: Wang Zifan
+        Date: 2022/05/10
+
+        Attributes:
+            thread_id (str): 线程id
+            input_path (str): 视频目录，或每行一个视频路径的清单文件
+            export_dir (str): 目标目录，每个视频输出到其下与视频同名的子目录
+            max_workers (int): 同时处理的视频数，默认按cpu核数确定
+            threads_per_worker (int): 每个进程的计算线程数
+            scheduler (str): 'process' 或 'stage'
+            stage_workers (dict): scheduler 为 'stage' 时各步骤的并发数，键为 'convert'、'demux'、
+                'separate'、'asr'、'clean'，未给出的使用默认值
+            cache_dir (str): 步骤缓存目录，为 None 时不使用缓存；重新运行时已完成的步骤直接使用缓存
+            cache_size (int): 步骤缓存总大小上限（字节）
+            separator (str): 语音分离方式，'cli' 或 'engine'
+            separation_window (float): separator 为 'engine' 时，大于0则按该长度（秒）分窗流式分离
+            separation_workers (int): separator 为 'engine' 时的分离进程数，大于1时各窗口在进程池中并行分离
+            separation_threads (int): 每个分离进程的计算线程数，为0时不限制
+            metrics_file (str): 全部结束后将各视频各步骤的耗时和资源统计以 Prometheus 文本格式写入该文件，
+                为 None 时不写（每个视频的 json 统计报告总是写在其输出目录下）
+    """
+
+    def __init__(self, thread_id: str, input_path: str, export_dir: str, max_workers: int = None,
+                 threads_per_worker: int = 2, scheduler: str = 'process', stage_workers: dict = None,
+                 cache_dir: str = None, cache_size: int = 20 * 1024 ** 3, separator: str = 'engine',
+                 separation_window: float = 0.0, separation_workers: int = 1, separation_threads: int = 0,
+                 metrics_file: str = None):
+        super(VideoBatchProcessMainThread, self).__init__()
+        self.thread_id = thread_id
+        self.input_path = input_path
+        self.export_dir = os.path.abspath(export_dir)
+        cpu_count = os.cpu_count() or 1
+        self.threads_per_worker = threads_per_worker
+        self.max_workers = max_workers if max_workers is not None else max(1, cpu_count // threads_per_worker)
+        assert scheduler in ['process', 'stage']
+        self.scheduler = scheduler
+        self.stage_workers = default_stage_workers()
+        if stage_workers is not None:
+            self.stage_workers.update(stage_workers)
+        self.cache_dir = os.path.abspath(cache_dir) if cache_dir is not None else None
+        self.cache_size = cache_size
+        self.separator = separator
+        self.separation_window = separation_window
+        self.separation_workers = separation_workers
+        self.separation_threads = separation_threads
+        self.metrics_file = metrics_file
+        # 每个视频的处理信息，与视频列表顺序相同
+        self.video_infos = []
+        # 每个视频的处理状态，用于显示
+        self.list_process_info = []
+        # 汇总信息
+        self.summary = ""
+
+    def run(self):
+        video_paths = list_videos(self.input_path)
+        self.video_infos = [None] * len(video_paths)
+        self.list_process_info = [os.path.basename(path) + "：等待处理" for path in video_paths]
+        start = time.time()
+        if self.scheduler == 'process':
+            self.run_process_pool(video_paths)
+        else:
+            self.run_stage_scheduler(video_paths)
+        elapsed = time.time() - start
+        total_duration = sum(info['duration'] for info in self.video_infos)
+        num_done = sum(1 for info in self.video_infos if info['state'] == '处理完成')
+        self.summary = "共{}个视频，成功{}个，视频总时长{:.1f}秒，总耗时{:.1f}秒，处理速度{:.2f}倍实时，{:.1f}个视频/小时".format(
+            len(self.video_infos), num_done, total_duration, elapsed,
+            total_duration / elapsed if elapsed > 0 else 0.0,
+            3600 * len(self.video_infos) / elapsed if elapsed > 0 else 0.0)
+        print(self.summary)
+        if self.metrics_file is not None:
+            write_prometheus(self.metrics_file, [info['metrics'] for info in self.video_infos
+                                                 if info['metrics'] is not None])
+
+    def video_export_dir(self, video_path: str) -> str:
+        """ 每个视频使用单独的输出目录，避免中间文件互相覆盖 """
+        base_name = '.'.join(os.path.basename(video_path).split('.')[0:-1]) or os.path.basename(video_path)
+        return os.path.join(self.export_dir, base_name)
+
+    def run_process_pool(self, video_paths: list):
+        with ProcessPoolExecutor(max_workers=self.max_workers, initializer=init_worker,
+                                 initargs=(self.threads_per_worker,)) as executor:
+            futures = {}
+            for i, video_path in enumerate(video_paths):
+                futures[executor.submit(process_video, video_path, self.video_export_dir(video_path),
+                                        self.cache_dir, self.cache_size, self.separator,
+                                        self.separation_window, self.separation_workers,
+                                        self.separation_threads)] = i
+            for future in as_completed(futures):
+                i = futures[future]
+                self.video_infos[i] = future.result()
+                self.list_process_info[i] = self.format_info(self.video_infos[i])
+                print(self.list_process_info[i])
+
+    def run_stage_scheduler(self, video_paths: list):
+        from video_process import VideoProcessMainThread
+
+        def stage_func(name):
+            # 通过 run_stage 执行，同时统计耗时和资源
+            return lambda job: job.run_stage(name)
+
+        # 格式转化 → 音视频分离 → 语音分离 → 语音识别 → 清理文件，前面的步骤失败时仍然清理
+        stages = [
+            Stage('convert', stage_func('convert'), self.stage_workers['convert']),
+            Stage('demux', stage_func('demux'), self.stage_workers['demux'], ['convert']),
+            Stage('separate', stage_func('separate'), self.stage_workers['separate'], ['demux']),
+            Stage('asr', stage_func('asr'), self.stage_workers['asr'], ['separate']),
+            Stage('clean', stage_func('clean'), self.stage_workers['clean'], ['asr'], always_run=True)
+        ]
+        scheduler = StageScheduler(stages)
+        scheduler.start()
+        stage_cache = StageCache(self.cache_dir, self.cache_size) if self.cache_dir is not None else None
+        for i, video_path in enumerate(video_paths):
+            job = VideoProcessMainThread(str(i + 1), video_path, self.video_export_dir(video_path), stage_cache,
+                                         self.separator, self.separation_window,
+                                         separation_workers=self.separation_workers,
+                                         separation_threads=self.separation_threads)
+            scheduler.submit(job)
+        scheduler.wait()
+        for i, job in enumerate(scheduler.jobs):
+            self.video_infos[i] = {
+                'video_path': job.video_path,
+                'state': '处理完成' if scheduler.job_succeeded(i) else '处理失败',
+                'duration': job.media_info.duration if job.media_info is not None else 0.0,
+                'elapsed': scheduler.job_end_times[i] - scheduler.job_start_times[i],
+                'num_sentences': len(job.asr_result),
+                'error': scheduler.job_errors[i],
+                'metrics': job.metrics.report()
+            }
+            self.list_process_info[i] = self.format_info(self.video_infos[i])
+            print(self.list_process_info[i])
+
+    def format_info(self, info: dict) -> str:
+        """ 单个视频的处理信息 """
+        name = os.path.basename(info['video_path'])
+        if info['state'] != '处理完成':
+            return name + "：" + info['state']
+        speed = info['duration'] / info['elapsed'] if info['elapsed'] > 0 else 0.0
+        return "{}：{}，视频时长{:.1f}秒，耗时{:.1f}秒，{:.2f}倍实时，识别{}句".format(
+            name, info['state'], info['duration'], info['elapsed'], speed, info['num_sentences'])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='批量视频分离和语音识别')
+    parser.add_argument('--input', required=True, help='视频目录，或每行一个视频路径的清单文件')
+    parser.add_argument('--export_dir', required=True, help='目标目录')
+    parser.add_argument('--max_workers', type=int, default=None, help='同时处理的视频数，默认按cpu核数确定')
+    parser.add_argument('--threads_per_worker', type=int, default=2, help='每个进程的计算线程数')
+    parser.add_argument('--scheduler', default='process', choices=['process', 'stage'],
+                        help='process：每个进程完整处理一个视频；stage：按步骤调度，不同视频的不同步骤同时进行')
+    for stage_name in ['convert', 'demux', 'separate', 'asr', 'clean']:
+        parser.add_argument('--{}_workers'.format(stage_name), type=int, default=None,
+                            help='scheduler 为 stage 时 {} 步骤的并发数'.format(stage_name))
+    parser.add_argument('--resume', action='store_true',
+                        help='使用步骤缓存，重新运行时跳过已完成的步骤（缓存目录默认为 export_dir/.stage_cache）')
+    parser.add_argument('--cache_dir', default=None, help='步骤缓存目录，给出时使用缓存')
+    parser.add_argument('--cache_size_gb', type=float, default=20, help='步骤缓存总大小上限（GB）')
+    parser.add_argument('--separator', default='engine', choices=['cli', 'engine'],
+                        help='语音分离方式，cli：每个视频调用一次 spleeter 命令行；engine：每个进程常驻一个分离模型')
+    parser.add_argument('--separation_window', type=float, default=0.0,
+                        help='separator 为 engine 时，大于0则按该长度（秒）分窗流式分离，边分离边识别')
+    parser.add_argument('--separation_workers', type=int, default=1,
+                        help='separator 为 engine 时的分离进程数，大于1时各窗口并行分离（需同时给出 --separation_window）')
+    parser.add_argument('--separation_threads', type=int, default=0, help='每个分离进程的计算线程数，为0时不限制')
+    parser.add_argument('--metrics_file', default=None,
+                        help='将各视频各步骤的耗时和资源统计以 Prometheus 文本格式写入该文件')
+    args = parser.parse_args()
+    cache_dir = args.cache_dir
+    if cache_dir is None and args.resume:
+        cache_dir = os.path.join(args.export_dir, '.stage_cache')
+    stage_workers = {name: getattr(args, name + '_workers') for name in ['convert', 'demux', 'separate', 'asr', 'clean']
+                     if getattr(args, name + '_workers') is not None}
+    batch_thread = VideoBatchProcessMainThread('1', args.input, args.export_dir, args.max_workers,
+                                               args.threads_per_worker, args.scheduler, stage_workers, cache_dir,
+                                               int(args.cache_size_gb * 1024 ** 3), args.separator,
+                                               args.separation_window, args.separation_workers,
+                                               args.separation_threads, args.metrics_file)
+    batch_thread.run()
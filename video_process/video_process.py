@@ -3,14 +3,36 @@
 # Author: Wang Zifan
 
 """说明"""
+import hashlib
 import os
+import queue
+import subprocess
 import threading
-import shutil
 import time
+import traceback
 
-from split_video_and_audio import SplitVideoAudioThread, SplitVideoAudioMonitorThread
-from audio_split import SplitAudioThread, SplitAudioMonitorThread
+from media_probe import probe_media
+from progress import ProgressBus, ProgressEvent, ProgressReporter, hidden_startupinfo
+from stage_cache import StageCache, file_digest, tool_version
+from stage_metrics import StageMetrics, files_size
+from split_video_and_audio import SplitVideoAudioThread
+from audio_split import SplitAudioThread
+from separation_engine import get_separation_engine, waveform_pcm_chunks
 from split_and_recognize_wav import SplitAndRecognizeAudioMainThread
+from subtitle import SubtitleWriter
+
+# 语音识别解码相关的源文件，其摘要作为识别步骤缓存键的一部分，解码代码改变后重新识别
+ASR_DECODER_SOURCES = ('recognize_single_wav.py', 'split_and_recognize_wav.py', 'vad_segmenter.py',
+                       'wenet/transformer/asr_model.py', 'wenet/transformer/convolution.py',
+                       'wenet/transformer/subsampling.py', 'wenet/utils/mask.py',
+                       'wenet/utils/prefix_beam_search.py')
+
+
+def asr_decoder_digest() -> str:
+    """ 解码相关源文件的摘要，作为语音识别解码器的版本 """
+    source_dir = os.path.dirname(os.path.abspath(__file__))
+    digests = [file_digest(os.path.join(source_dir, path)) for path in ASR_DECODER_SOURCES]
+    return hashlib.sha256(''.join(digests).encode('ascii')).hexdigest()
 
 
 class VideoProcessMainThread(threading.Thread):
@@ -23,9 +45,26 @@ class VideoProcessMainThread(threading.Thread):
             thread_id (str): 线程id
             video_path (str): 视频路径
             export_dir (str): 目标目录
+            stage_cache (StageCache): 步骤缓存，不为 None 时已完成过的步骤直接使用缓存的输出
+            separator (str): 语音分离方式
+                'cli': 每个视频调用一次 spleeter 命令行
+                'engine': 使用本进程常驻的分离引擎，模型只加载一次，人声直接在内存中交给语音识别
+            separation_window (float): separator 为 'engine' 时，大于0则按该长度（秒）分窗流式分离，
+                分离在语音识别步骤中进行，每分离完一块人声就交给切分和识别，峰值内存与视频长度无关
+            separation_overlap (float): 流式分离时相邻窗口重叠的长度（秒），重叠部分交叉淡化拼接
+            separation_workers (int): separator 为 'engine' 时的分离进程数，大于1时各窗口在进程池中并行分离
+            separation_threads (int): 每个分离进程的计算线程数，为0时不限制
+            metrics_path (str): 各步骤耗时和资源统计的 json 报告路径，为 None 时为 export_dir 下的
+                <视频名>_metrics.json，每个步骤结束时更新
     """
 
-    def __init__(self, thread_id: str, video_path: str, export_dir: str):
+    # 步骤名和对应的方法名，按执行顺序
+    STAGES = [('convert', 'convert_format'), ('demux', 'split_video_audio'), ('separate', 'split_audio'),
+              ('asr', 'recognize'), ('clean', 'clean')]
+
+    def __init__(self, thread_id: str, video_path: str, export_dir: str, stage_cache: StageCache = None,
+                 separator: str = 'cli', separation_window: float = 0.0, separation_overlap: float = 1.0,
+                 separation_workers: int = 1, separation_threads: int = 0, metrics_path: str = None):
         super(VideoProcessMainThread, self).__init__()
         self.thread_id = thread_id
         self.video_path = os.path.abspath(video_path)
@@ -34,69 +73,255 @@ class VideoProcessMainThread(threading.Thread):
             os.makedirs(self.export_dir)
         # 分离进度
         self.split_process = []
+        # 进度事件总线，子进程的输出通过管道逐行解析后以 ProgressEvent 发布，可用 subscribe 订阅
+        self.progress_bus = ProgressBus()
         # 语音识别结果
         self.asr_result = []
+        # 带时间的语音识别结果，元素为 (开始时间, 结束时间, 文本)
+        self.asr_segments = []
+        # 以下为各步骤之间传递的信息，由前面的步骤设置
+        # 视频信息
+        self.media_info = None
+        # 统一转化成的视频格式
+        self.video_format = 'mp4'
+        # 转为 mp4 格式后的视频路径，原视频已是 mp4 时为原视频路径
+        self.new_video_path = None
+        # new_video_path 是否为转化生成的文件（清理时只删除生成的文件，不删除原视频）
+        self.video_converted = False
+        # 不含后缀的视频名
+        self.base_name = None
+        # 从视频分离出来的音频路径
+        self.split_audio_path = None
+        # 语音分离输出的文件夹
+        self.split_audio_output_dir = os.path.join(self.export_dir, "splited_audio")
+        self.stage_cache = stage_cache
+        assert separator in ['cli', 'engine']
+        self.separator = separator
+        # 分离引擎输出的内存中的人声及其采样率，使用命令行或缓存时为 None
+        self.vocals = None
+        self.vocals_sample_rate = None
+        self.separation_window = separation_window if separator == 'engine' else 0.0
+        self.separation_overlap = separation_overlap
+        self.separation_workers = separation_workers
+        self.separation_threads = separation_threads
+        # 流式分离时，等待语音识别步骤启动的分离线程，及其缓存键、输出文件和进度所在的行
+        self.split_audio_thread = None
+        self.separate_key = None
+        self.separate_outputs = None
+        self.separate_progress_index = None
+        # 上一个步骤的缓存键，第一个步骤以视频文件的摘要作为输入
+        self.stage_key = None
+        # 当前步骤是否直接使用了缓存
+        self.stage_cached = False
+        # 去除音频的视频路径和语音识别读取的人声路径（流式或内存中的人声不读取文件）
+        self.video_without_audio_path = None
+        self.asr_input_path = None
+        # 语音分离是否在语音识别步骤中流式进行
+        self.separated_in_asr = False
+        # 各步骤的耗时和资源统计
+        self.metrics = StageMetrics(self.video_path)
+        self.metrics_path = metrics_path
 
     def run(self):
-        # 1.视频格式转化
+        try:
+            for stage, _ in self.STAGES[:-1]:
+                self.run_stage(stage)
+        except BaseException:
+            # 前面的步骤失败时仍然清理文件（与按步骤调度时相同），清理失败只打印其错误，
+            # 抛出的仍是前面步骤的异常
+            try:
+                self.run_stage(self.STAGES[-1][0])
+            except Exception:
+                traceback.print_exc()
+            raise
+        self.run_stage(self.STAGES[-1][0])
+
+    def run_stage(self, stage: str):
+        """ 执行一个步骤并统计其耗时和资源，出错时记录后重新抛出
+
+            各步骤在工具失败或输出文件不全时抛出 RuntimeError，不只是更新 split_process
+        """
+        method = dict(self.STAGES)[stage]
+        self.stage_cached = False
+        self.metrics.start(stage)
+        state = '失败'
+        try:
+            getattr(self, method)()
+            state = '完成'
+        finally:
+            read_paths, written_paths = self.stage_files(stage)
+            audio_seconds = self.media_info.duration if self.media_info is not None and stage != 'clean' else 0.0
+            self.metrics.finish(stage, state, audio_seconds, files_size(read_paths), files_size(written_paths),
+                                self.stage_cached)
+            self.write_metrics()
+
+    def stage_files(self, stage: str):
+        """ 步骤读取和写入的文件，返回 (读取的文件列表, 写入的文件列表) """
+        if stage == 'convert':
+            return [self.video_path], [self.new_video_path] if self.video_converted else []
+        elif stage == 'demux':
+            return [self.new_video_path], [self.video_without_audio_path, self.split_audio_path]
+        elif stage == 'separate':
+            # 流式分离在语音识别步骤中进行
+            if self.separate_outputs is None or self.split_audio_thread is not None:
+                return [], []
+            return [self.split_audio_path], list(self.separate_outputs.values())
+        elif stage == 'asr':
+            written_paths = [os.path.join(self.export_dir, self.base_name + '_asr_result.' + suffix)
+                             for suffix in ['txt', 'srt', 'vtt']] if self.base_name is not None else []
+            if self.separated_in_asr:
+                return [self.split_audio_path], written_paths + list(self.separate_outputs.values())
+            return [self.asr_input_path], written_paths
+        return [], []
+
+    def write_metrics(self):
+        """ 将统计报告写入 json 文件 """
+        metrics_path = self.metrics_path
+        if metrics_path is None:
+            base_name = self.base_name or '.'.join(os.path.basename(self.video_path).split('.')[0:-1])
+            metrics_path = os.path.join(self.export_dir, base_name + '_metrics.json')
+        self.metrics.write_json(metrics_path)
+
+    def convert_format(self):
+        """ 1.视频格式转化 """
+        # 获取视频信息（只调用一次 ffprobe，后续各步骤共用）
+        self.media_info = probe_media(self.video_path)
+        if self.stage_cache is not None:
+            self.stage_key = file_digest(self.video_path)
 
         video_name_split = os.path.basename(self.video_path).split('.')
         origin_format = video_name_split[-1]
-        video_format = 'mp4'
-        if origin_format == video_format:
-            shutil.copy(self.video_path, self.export_dir)
+        if origin_format == self.video_format:
+            # 后续步骤只读取视频，直接使用原视频，不复制
             video_name = os.path.basename(self.video_path)
-            new_video_path = os.path.join(self.export_dir, video_name)
+            self.new_video_path = self.video_path
         else:
             if len(video_name_split) == 1:
                 video_name = video_name_split[-1] + '.mp4'
             else:
-                video_name = '.'.join(video_name_split[0:-1]) + '.' + video_format
-            new_video_path = os.path.join(self.export_dir, video_name)
+                video_name = '.'.join(video_name_split[0:-1]) + '.' + self.video_format
+            self.new_video_path = os.path.join(self.export_dir, video_name)
+            self.video_converted = True
             self.split_process.append("<视频格式转化>")
             self.split_process.append("正在进行视频格式转化")
-            os.system("ffmpeg -i " + self.video_path + " -c copy -y " + new_video_path)
-            self.split_process[-1] = "视频格式转化完成"
+            key = self.next_stage_key('convert', {'format': self.video_format}, 'ffmpeg')
+            if self.restore_stage(key, {'video': self.new_video_path}):
+                self.split_process[-1] = "视频格式转化完成（使用缓存）"
+            else:
+                result = subprocess.run(['ffmpeg', '-nostdin', '-v', 'error', '-i', self.video_path, '-c', 'copy',
+                                         '-y', self.new_video_path],
+                                        stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                                        startupinfo=hidden_startupinfo())
+                if result.returncode != 0 or not os.path.isfile(self.new_video_path):
+                    self.split_process[-1] = "视频格式转化失败"
+                    raise RuntimeError('视频格式转化失败：' + result.stderr.decode('utf-8', errors='replace'))
+                self.store_stage(key, {'video': self.new_video_path})
+                self.split_process[-1] = "视频格式转化完成"
+        self.base_name = '.'.join(video_name.split('.')[0:-1])
 
-        # 2.音视频分离
-        base_name = '.'.join(video_name.split('.')[0:-1])
+    def split_video_audio(self):
+        """ 2.音视频分离 """
         audio_format = 'wav'
-        video_without_audio_name = base_name + '_without_audio.' + video_format
+        video_without_audio_name = self.base_name + '_without_audio.' + self.video_format
         video_without_audio_path = os.path.join(self.export_dir, video_without_audio_name)
-        split_audio_name = base_name + '.' + audio_format
-        split_audio_path = os.path.join(self.export_dir, split_audio_name)
+        self.video_without_audio_path = video_without_audio_path
+        split_audio_name = self.base_name + '.' + audio_format
+        self.split_audio_path = os.path.join(self.export_dir, split_audio_name)
         self.split_process.append("<音视频分离>")
         self.split_process.append("")
         self.split_process.append("")
-        split_video_audio_thread = SplitVideoAudioThread('1', new_video_path, video_without_audio_path,
-                                                         split_audio_path)
-        split_video_audio_monitor_thread = SplitVideoAudioMonitorThread('1', split_video_audio_thread)
-        split_video_audio_thread.start()
-        split_video_audio_monitor_thread.start()
-        while True:
-            self.split_process[-2] = split_video_audio_thread.audio_extract_process
-            self.split_process[-1] = split_video_audio_thread.video_extract_process
-            if not split_video_audio_monitor_thread.is_alive():
-                break
-            time.sleep(0.1)
+        key = self.next_stage_key('demux', {'stream_copy': True, 'audio_codec': 'pcm_s16le', 'rate': 44100},
+                                  'ffmpeg')
+        outputs = {'video': video_without_audio_path, 'audio': self.split_audio_path}
+        if self.restore_stage(key, outputs):
+            self.split_process[-2] = "音频提取完成（使用缓存）"
+            self.split_process[-1] = "视频提取完成（使用缓存）"
+            return
+        split_video_audio_thread = SplitVideoAudioThread('1', self.new_video_path, video_without_audio_path,
+                                                         self.split_audio_path, media_info=self.media_info,
+                                                         progress_bus=self.progress_bus)
 
-        # 3.语音分离
+        # 每收到一个进度事件更新一次进度，不再轮询
+        def on_progress(event: ProgressEvent):
+            if event.stage == 'demux':
+                self.split_process[-2] = split_video_audio_thread.audio_extract_process
+                self.split_process[-1] = split_video_audio_thread.video_extract_process
+
+        self.progress_bus.subscribe(on_progress)
+        try:
+            split_video_audio_thread.start()
+            split_video_audio_thread.join()
+        finally:
+            self.progress_bus.unsubscribe(on_progress)
+        self.split_process[-2] = split_video_audio_thread.audio_extract_process
+        self.split_process[-1] = split_video_audio_thread.video_extract_process
+        if self.split_process[-2:] != ["音频提取完成", "视频提取完成"] or \
+                not all(os.path.isfile(path) for path in outputs.values()):
+            raise RuntimeError('音视频分离失败：' + (split_video_audio_thread.error or '输出文件不全'))
+        self.store_stage(key, outputs)
+
+    def split_audio(self):
+        """ 3.语音分离 """
         self.split_process.append("<语音分离>")
+        stem_dir = os.path.join(self.split_audio_output_dir, self.base_name)
+        params = {'model': 'spleeter:2stems'}
+        if self.separation_window > 0:
+            # 分窗分离的结果与整体分离略有不同
+            params.update(window=self.separation_window, overlap=self.separation_overlap)
+        self.separate_key = self.next_stage_key('separate', params, 'spleeter')
+        self.separate_outputs = {'vocals': os.path.join(stem_dir, 'vocals.wav'),
+                                 'accompaniment': os.path.join(stem_dir, 'accompaniment.wav')}
+        if self.restore_stage(self.separate_key, self.separate_outputs):
+            self.split_process.append("语音分离完成（使用缓存）")
+            return
         if os.path.exists("./pretrained_models"):
             self.split_process.append("正在进行语音分离")
         self.split_process.append("")
-        split_audio_output_dir = os.path.join(self.export_dir, "splited_audio")
-        split_audio_thread = SplitAudioThread('1', split_audio_path, split_audio_output_dir)
-        split_audio_monitor_thread = SplitAudioMonitorThread('1', split_audio_thread)
-        split_audio_thread.start()
-        split_audio_monitor_thread.start()
-        while True:
-            self.split_process[-1] = split_audio_thread.split_process
-            if not split_audio_monitor_thread.is_alive():
-                break
-            time.sleep(0.1)
+        self.separate_progress_index = len(self.split_process) - 1
+        engine = get_separation_engine(self.separation_workers, self.separation_threads) \
+            if self.separator == 'engine' else None
+        split_audio_thread = SplitAudioThread('1', self.split_audio_path, self.split_audio_output_dir, engine,
+                                              self.separation_window, self.separation_overlap,
+                                              progress_bus=self.progress_bus)
+        if split_audio_thread.streaming:
+            # 流式分离在语音识别步骤中启动，边分离边识别
+            self.split_audio_thread = split_audio_thread
+            self.split_process[-1] = "等待与语音识别同时进行"
+            return
+        if engine is not None:
+            # 分离引擎直接更新进度
+            split_audio_thread.start()
+            while split_audio_thread.is_alive():
+                self.split_process[-1] = split_audio_thread.split_process
+                time.sleep(0.1)
+            self.finish_split_audio(split_audio_thread)
+            return
+
+        # 命令行的输出通过管道逐行解析后以进度事件发布
+        def on_progress(event: ProgressEvent):
+            if event.stage == 'separate':
+                self.split_process[self.separate_progress_index] = split_audio_thread.split_process
+
+        self.progress_bus.subscribe(on_progress)
+        try:
+            split_audio_thread.start()
+            self.finish_split_audio(split_audio_thread)
+        finally:
+            self.progress_bus.unsubscribe(on_progress)
 
-        # 4.语音切分和识别
+    def finish_split_audio(self, split_audio_thread: SplitAudioThread):
+        """ 等待分离线程结束，更新进度，分离成功时存入缓存，失败时抛出异常 """
+        split_audio_thread.join()
+        self.split_process[self.separate_progress_index] = split_audio_thread.split_process
+        self.vocals = split_audio_thread.vocals
+        self.vocals_sample_rate = split_audio_thread.sample_rate
+        if not split_audio_thread.split_process.endswith("语音分离完成") or \
+                not all(os.path.isfile(path) for path in self.separate_outputs.values()):
+            raise RuntimeError('语音分离失败：' + (split_audio_thread.error or '输出文件不全'))
+        self.store_stage(self.separate_key, self.separate_outputs)
+
+    def recognize(self):
+        """ 4.语音切分和识别 """
         # 语音识别参数
         kwargs = {
             'model_path': './model_for_asr/final.pt',
@@ -116,32 +341,118 @@ class VideoProcessMainThread(threading.Thread):
         }
         # 被切分和识别的音频路径
         self.split_process.append("<语音识别>")
-        audio_path_for_asr = os.path.join(os.path.join(split_audio_output_dir, base_name), 'vocals.wav')
-        result_txt_path = os.path.join(self.export_dir, base_name + '_asr_result.txt')
-        asr_thread = SplitAndRecognizeAudioMainThread('1', audio_path_for_asr, **kwargs)
+        audio_path_for_asr = os.path.join(os.path.join(self.split_audio_output_dir, self.base_name), 'vocals.wav')
+        result_txt_path = os.path.join(self.export_dir, self.base_name + '_asr_result.txt')
+        srt_path = os.path.join(self.export_dir, self.base_name + '_asr_result.srt')
+        vtt_path = os.path.join(self.export_dir, self.base_name + '_asr_result.vtt')
+        outputs = {'txt': result_txt_path, 'srt': srt_path, 'vtt': vtt_path}
+        params = dict(kwargs)
+        if self.stage_cache is not None:
+            # 模型文件的摘要也作为参数，换模型后重新识别
+            params['model_digest'] = file_digest(kwargs['model_path'])
+            # 解码代码的版本也作为参数，解码方式改变后重新识别
+            params['decoder_version'] = asr_decoder_digest()
+        key = self.next_stage_key('asr', params)
+        if self.restore_stage(key, outputs):
+            self.asr_segments = [tuple(segment) for segment in self.stage_cache.meta(key)['asr_segments']]
+            self.asr_result = [segment[2] for segment in self.asr_segments]
+            self.split_process.append("语音识别完成（使用缓存）")
+            return
+        # 字幕随识别进度逐句写入
+        subtitle_writers = [SubtitleWriter(srt_path, 'srt'), SubtitleWriter(vtt_path, 'vtt')]
+        # 人声在内存中时直接重采样后切分；否则用ffmpeg管道直接解码重采样，不生成临时wav文件
+        pcm_chunks = None
+        split_audio_thread = self.split_audio_thread
+        if split_audio_thread is not None:
+            # 流式分离：每分离完一块人声就重采样后交给切分和识别
+            self.separated_in_asr = True
+            split_audio_thread.start()
+            pcm_chunks = waveform_pcm_chunks(split_audio_thread.vocal_chunks(), split_audio_thread.sample_rate,
+                                             kwargs['resample_rate'])
+        elif self.vocals is not None:
+            pcm_chunks = waveform_pcm_chunks(self.vocals, self.vocals_sample_rate, kwargs['resample_rate'])
+        else:
+            self.asr_input_path = audio_path_for_asr
+        asr_thread = SplitAndRecognizeAudioMainThread('1', audio_path_for_asr, subtitle_writers=subtitle_writers,
+                                                      audio_decoder='ffmpeg', pcm_chunks=pcm_chunks, **kwargs)
         asr_thread.start()
         self.split_process.append("正在进行语音识别")
+        reporter = ProgressReporter('asr', self.progress_bus)
         while True:
+            if split_audio_thread is not None:
+                self.split_process[self.separate_progress_index] = split_audio_thread.split_process
             self.asr_result = asr_thread.asr_result
+            self.asr_segments = asr_thread.asr_segments
+            # 根据已识别语音段的结束时间估计识别进度
+            if len(self.asr_segments) > 0 and self.media_info.duration > 0:
+                percent = min(100 * self.asr_segments[-1][1] / self.media_info.duration, 100)
+                progress = "正在进行语音识别：" + format(percent, ".2f") + '% '
+                if progress != self.split_process[-1]:
+                    self.split_process[-1] = progress
+                    reporter.report(percent, progress)
             if not asr_thread.is_alive():
                 break
             time.sleep(0.1)
+        for writer in subtitle_writers:
+            writer.close()
+        if split_audio_thread is not None:
+            self.split_audio_thread = None
+            if asr_thread.error is not None:
+                # 识别线程出错后不再取人声块，取空队列让分离线程能够结束
+                while split_audio_thread.is_alive():
+                    try:
+                        split_audio_thread.vocal_queue.get(timeout=0.1)
+                    except queue.Empty:
+                        pass
+            # 分离失败时识别结果不完整，抛出异常，不存入缓存
+            self.finish_split_audio(split_audio_thread)
+        if asr_thread.error is not None:
+            self.split_process.append("语音识别失败")
+            reporter.report(None, "语音识别失败", 'failed')
+            raise asr_thread.error
         # 存储语音识别结果
         with open(result_txt_path, 'w', encoding='utf-8') as f:
             f.write('\n'.join(self.asr_result))
-        self.split_process.append("语音识别完成")
+        if asr_thread.failed_segments:
+            # 有语音段识别失败时结果不完整，不存入缓存，下次重新识别
+            asr_status = "语音识别完成（" + str(len(asr_thread.failed_segments)) + "段识别失败）"
+        else:
+            self.store_stage(key, outputs, {'asr_segments': self.asr_segments})
+            asr_status = "语音识别完成"
+        self.split_process.append(asr_status)
+        reporter.report(100, asr_status, 'done')
+        # 释放内存中的人声
+        self.vocals = None
 
-        # 5.清理文件
+    def clean(self):
+        """ 5.清理文件 """
         # 删除语音分离输出的文件夹及其下所有文件
-        if os.path.isdir(split_audio_output_dir):
-            self.clean_dir(split_audio_output_dir)
-            os.rmdir(split_audio_output_dir)
-        # 删除复制进来的原音频文件
-        if os.path.isfile(new_video_path):
-            os.remove(new_video_path)
+        if os.path.isdir(self.split_audio_output_dir):
+            self.clean_dir(self.split_audio_output_dir)
+            os.rmdir(self.split_audio_output_dir)
+        # 删除格式转化生成的视频文件
+        if self.video_converted and os.path.isfile(self.new_video_path):
+            os.remove(self.new_video_path)
         # 删除从视频分离出来的音频文件
-        # if os.path.isfile(split_audio_path):
-        #     os.remove(split_audio_path)
+        # if os.path.isfile(self.split_audio_path):
+        #     os.remove(self.split_audio_path)
+
+    def next_stage_key(self, stage: str, params: dict, tool: str = ''):
+        """ 由上一个步骤的缓存键、步骤参数和工具版本计算该步骤的缓存键，不使用缓存时返回 None """
+        if self.stage_cache is None:
+            return None
+        self.stage_key = StageCache.key(stage, self.stage_key, params, tool_version(tool) if tool else '')
+        return self.stage_key
+
+    def restore_stage(self, key, outputs: dict) -> bool:
+        """ 从缓存恢复步骤的输出，成功时返回 True """
+        self.stage_cached = key is not None and self.stage_cache.restore(key, outputs)
+        return self.stage_cached
+
+    def store_stage(self, key, outputs: dict, meta: dict = None):
+        """ 步骤完成后存入缓存（输出文件不全时不存入） """
+        if key is not None and all(os.path.isfile(path) for path in outputs.values()):
+            self.stage_cache.store(key, outputs, meta)
 
     def clean_dir(self, dir_path):
         # 原文链接：https: // blog.csdn.net / wwwcaifeng / article / details / 119836725
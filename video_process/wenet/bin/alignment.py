@@ -26,8 +26,7 @@ from torch.utils.data import DataLoader
 from textgrid import TextGrid, IntervalTier
 
 from wenet.dataset.dataset import AudioDataset, CollateFunc
-from wenet.transformer.asr_model import init_asr_model
-from wenet.utils.checkpoint import load_checkpoint
+from wenet.utils.model_cache import global_model_cache
 from wenet.utils.ctc_util import forced_align
 from wenet.utils.common import get_subsample
 
@@ -163,15 +162,11 @@ if __name__ == '__main__':
                                  batch_size=1,
                                  num_workers=0)
 
-    # Init asr model from configs
-    model = init_asr_model(configs)
-
-    load_checkpoint(model, args.checkpoint)
     use_cuda = args.gpu >= 0 and torch.cuda.is_available()
     device = torch.device('cuda' if use_cuda else 'cpu')
-    model = model.to(device)
-
-    model.eval()
+    # Init asr model from configs, loaded once and kept in eval mode
+    model, _ = global_model_cache.get(args.checkpoint, args.config,
+                                      device=device)
     with torch.no_grad(), open(args.result_file, 'w',
                                encoding='utf-8') as fout:
         for batch_idx, batch in enumerate(ali_data_loader):
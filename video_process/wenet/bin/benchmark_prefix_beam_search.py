@@ -0,0 +1,82 @@
+# Author: Wang Zifan
+#  Apache 2.0  (http://www.apache.org/licenses/LICENSE-2.0)
+"""Benchmark the vectorized ctc prefix beam search against the loop one.
+
+The ctc posteriors are synthetic: random logits scaled by --peak, with
+--blank_bias added to the blank logit, which makes them peaky like the
+output of a trained model. Both implementations decode the same
+posteriors, their nbest lists are checked to be the same, and the decode
+time per second of audio is printed.
+"""
+
+import argparse
+import time
+
+import torch
+
+from wenet.utils.prefix_beam_search import (prefix_beam_search,
+                                            prefix_beam_search_loop)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='benchmark ctc prefix beam search')
+    parser.add_argument('--vocab_size',
+                        type=int,
+                        default=5000,
+                        help='vocabulary size')
+    parser.add_argument('--seconds',
+                        type=float,
+                        default=10.0,
+                        help='seconds of audio per utterance')
+    parser.add_argument('--frame_shift',
+                        type=float,
+                        default=0.04,
+                        help='seconds per encoder frame after subsampling')
+    parser.add_argument('--beam_size',
+                        type=int,
+                        default=10,
+                        help='beam size for search')
+    parser.add_argument('--num_utts',
+                        type=int,
+                        default=10,
+                        help='number of utterances')
+    parser.add_argument('--peak',
+                        type=float,
+                        default=4.0,
+                        help='scale of the random logits')
+    parser.add_argument('--blank_bias',
+                        type=float,
+                        default=8.0,
+                        help='added to the blank logit')
+    parser.add_argument('--seed', type=int, default=777, help='random seed')
+    args = parser.parse_args()
+
+    torch.manual_seed(args.seed)
+    num_frames = int(args.seconds / args.frame_shift)
+    utts = []
+    for _ in range(args.num_utts):
+        logits = torch.randn(num_frames, args.vocab_size) * args.peak
+        logits[:, 0] += args.blank_bias
+        utts.append(torch.log_softmax(logits, dim=-1))
+    total_seconds = args.seconds * args.num_utts
+
+    results = {}
+    for name, search in [('loop', prefix_beam_search_loop),
+                         ('vectorized', prefix_beam_search)]:
+        start = time.perf_counter()
+        results[name] = [search(ctc_probs, args.beam_size)
+                         for ctc_probs in utts]
+        elapsed = time.perf_counter() - start
+        results[name + '_time'] = elapsed
+        print('{}: {:.2f} ms per second of audio, rtf {:.5f}'.format(
+            name, 1000 * elapsed / total_seconds, elapsed / total_seconds))
+
+    same = all([p for p, _ in a] == [p for p, _ in b]
+               for a, b in zip(results['loop'], results['vectorized']))
+    max_diff = max(abs(sa - sb)
+                   for a, b in zip(results['loop'], results['vectorized'])
+                   for (_, sa), (_, sb) in zip(a, b))
+    print('same nbest: {}, max score difference: {:.3g}'.format(
+        same, max_diff))
+    print('speedup: {:.2f}x'.format(results['loop_time'] /
+                                    results['vectorized_time']))
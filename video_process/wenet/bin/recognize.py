@@ -18,15 +18,13 @@ import argparse
 import copy
 import logging
 import os
-import sys
 
 import torch
 import yaml
 from torch.utils.data import DataLoader
 
 from wenet.dataset.dataset import AudioDataset, CollateFunc
-from wenet.transformer.asr_model import init_asr_model
-from wenet.utils.checkpoint import load_checkpoint
+from wenet.utils.model_cache import global_model_cache
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='recognize with your model')
@@ -87,13 +85,6 @@ if __name__ == '__main__':
                         format='%(asctime)s %(levelname)s %(message)s')
     os.environ['CUDA_VISIBLE_DEVICES'] = str(args.gpu)
 
-    if args.mode in ['ctc_prefix_beam_search', 'attention_rescoring'
-                     ] and args.batch_size > 1:
-        logging.fatal(
-            'decoding mode {} must be running with batch_size == 1'.format(
-                args.mode))
-        sys.exit(1)
-
     with open(args.config, 'r') as fin:
         configs = yaml.load(fin, Loader=yaml.FullLoader)
 
@@ -122,9 +113,6 @@ if __name__ == '__main__':
                                   batch_size=1,
                                   num_workers=0)
 
-    # Init asr model from configs
-    model = init_asr_model(configs)
-
     # Load dict
     char_dict = {}
     with open(args.dict, 'r') as fin:
@@ -134,12 +122,11 @@ if __name__ == '__main__':
             char_dict[int(arr[1])] = arr[0]
     eos = len(char_dict) - 1
 
-    load_checkpoint(model, args.checkpoint)
     use_cuda = args.gpu >= 0 and torch.cuda.is_available()
     device = torch.device('cuda' if use_cuda else 'cpu')
-    model = model.to(device)
-
-    model.eval()
+    # Init asr model from configs, loaded once and kept in eval mode
+    model, _ = global_model_cache.get(args.checkpoint, args.config,
+                                      device=device)
     with torch.no_grad(), open(args.result_file, 'w') as fout:
         for batch_idx, batch in enumerate(test_data_loader):
             keys, feats, target, feats_lengths, target_lengths = batch
@@ -163,22 +150,19 @@ if __name__ == '__main__':
                     decoding_chunk_size=args.decoding_chunk_size,
                     num_decoding_left_chunks=args.num_decoding_left_chunks,
                     simulate_streaming=args.simulate_streaming)
-            # ctc_prefix_beam_search and attention_rescoring only return one
-            # result in List[int], change it to List[List[int]] for compatible
-            # with other batch decoding mode
+            # the encoder runs once on the padded batch, prefix search is done
+            # per utterance and the nbest of the whole batch are rescored in
+            # one decoder forward
             elif args.mode == 'ctc_prefix_beam_search':
-                assert (feats.size(0) == 1)
-                hyp = model.ctc_prefix_beam_search(
+                hyps = model.ctc_prefix_beam_search_batch(
                     feats,
                     feats_lengths,
                     args.beam_size,
                     decoding_chunk_size=args.decoding_chunk_size,
                     num_decoding_left_chunks=args.num_decoding_left_chunks,
                     simulate_streaming=args.simulate_streaming)
-                hyps = [hyp]
             elif args.mode == 'attention_rescoring':
-                assert (feats.size(0) == 1)
-                hyp = model.attention_rescoring(
+                hyps = model.attention_rescoring_batch(
                     feats,
                     feats_lengths,
                     args.beam_size,
@@ -187,7 +171,6 @@ if __name__ == '__main__':
                     ctc_weight=args.ctc_weight,
                     simulate_streaming=args.simulate_streaming,
                     reverse_weight=args.reverse_weight)
-                hyps = [hyp]
             for i, key in enumerate(keys):
                 content = ''
                 for w in hyps[i]:
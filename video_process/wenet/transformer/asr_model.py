@@ -12,7 +12,6 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from collections import defaultdict
 from typing import List, Optional, Tuple
 
 import torch
@@ -27,11 +26,12 @@ from wenet.transformer.encoder import ConformerEncoder
 from wenet.transformer.encoder import TransformerEncoder
 from wenet.transformer.label_smoothing_loss import LabelSmoothingLoss
 from wenet.utils.cmvn import load_cmvn
-from wenet.utils.common import (IGNORE_ID, add_sos_eos, log_add,
+from wenet.utils.common import (IGNORE_ID, add_sos_eos,
                                 remove_duplicates_and_blank, th_accuracy,
                                 reverse_pad_list)
 from wenet.utils.mask import (make_pad_mask, mask_finished_preds,
-                              mask_finished_scores, subsequent_mask)
+                              mask_finished_scores)
+from wenet.utils.prefix_beam_search import prefix_beam_search
 
 
 class ASRModel(torch.nn.Module):
@@ -176,6 +176,37 @@ class ASRModel(torch.nn.Module):
             )  # (B, maxlen, encoder_dim)
         return encoder_out, encoder_mask
 
+    def _forward_encoder_batch(
+        self,
+        speech: torch.Tensor,
+        speech_lengths: torch.Tensor,
+        decoding_chunk_size: int = -1,
+        num_decoding_left_chunks: int = -1,
+        simulate_streaming: bool = False,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """ Same as _forward_encoder, but also supports simulate_streaming
+            for batch_size > 1 by forwarding each utterance chunk by chunk
+            and padding the outputs
+        """
+        if not (simulate_streaming and decoding_chunk_size > 0) or \
+                speech.size(0) == 1:
+            return self._forward_encoder(speech, speech_lengths,
+                                         decoding_chunk_size,
+                                         num_decoding_left_chunks,
+                                         simulate_streaming)
+        outputs = []
+        for i in range(speech.size(0)):
+            encoder_out, _ = self._forward_encoder(
+                speech[i:i + 1, :speech_lengths[i]],
+                speech_lengths[i:i + 1], decoding_chunk_size,
+                num_decoding_left_chunks, simulate_streaming)
+            outputs.append(encoder_out.squeeze(0))
+        encoder_out_lens = torch.tensor([out.size(0) for out in outputs],
+                                        device=speech.device)
+        encoder_out = pad_sequence(outputs, True, 0.0)
+        encoder_mask = ~make_pad_mask(encoder_out_lens).unsqueeze(1)
+        return encoder_out, encoder_mask
+
     def recognize(
         self,
         speech: torch.Tensor,
@@ -214,13 +245,7 @@ class ASRModel(torch.nn.Module):
             num_decoding_left_chunks,
             simulate_streaming)  # (B, maxlen, encoder_dim)
         maxlen = encoder_out.size(1)
-        encoder_dim = encoder_out.size(2)
         running_size = batch_size * beam_size
-        encoder_out = encoder_out.unsqueeze(1).repeat(1, beam_size, 1, 1).view(
-            running_size, maxlen, encoder_dim)  # (B*N, maxlen, encoder_dim)
-        encoder_mask = encoder_mask.unsqueeze(1).repeat(
-            1, beam_size, 1, 1).view(running_size, 1,
-                                     maxlen)  # (B*N, 1, max_len)
 
         hyps = torch.ones([running_size, 1], dtype=torch.long,
                           device=device).fill_(self.sos)  # (B*N, 1)
@@ -229,18 +254,19 @@ class ASRModel(torch.nn.Module):
         scores = scores.to(device).repeat([batch_size]).unsqueeze(1).to(
             device)  # (B*N, 1)
         end_flag = torch.zeros_like(scores, dtype=torch.bool, device=device)
-        cache: Optional[List[torch.Tensor]] = None
+        # self-attention key/value buffers for maxlen tokens, and the
+        # cross-attention key/value of encoder_out projected once per
+        # utterance and shared by its N beams
+        state = self.decoder.init_state(encoder_out, encoder_mask, maxlen,
+                                        beam_size)
         # 2. Decoder forward step by step
         for i in range(1, maxlen + 1):
             # Stop if all batch and all beam produce eos
             if end_flag.sum() == running_size:
                 break
-            # 2.1 Forward decoder step
-            hyps_mask = subsequent_mask(i).unsqueeze(0).repeat(
-                running_size, 1, 1).to(device)  # (B*N, i, i)
+            # 2.1 Forward decoder step, only the newest token is fed,
             # logp: (B*N, vocab)
-            logp, cache = self.decoder.forward_one_step(
-                encoder_out, encoder_mask, hyps, hyps_mask, cache)
+            logp = self.decoder.forward_incremental(hyps[:, -1], state)
             # 2.2 First beam prune: select topk best prob at current time
             top_k_logp, top_k_index = logp.topk(beam_size)  # (B*N, N)
             top_k_logp = mask_finished_scores(top_k_logp, end_flag)
@@ -268,6 +294,7 @@ class ASRModel(torch.nn.Module):
                 hyps, dim=0, index=best_hyps_index)  # (B*N, i)
             hyps = torch.cat((last_best_k_hyps, best_k_pred.view(-1, 1)),
                              dim=1)  # (B*N, i+1)
+            state.reorder(best_hyps_index)
 
             # 2.6 Update end flag
             end_flag = torch.eq(hyps[:, -1], self.eos).view(-1, 1)
@@ -365,52 +392,29 @@ class ASRModel(torch.nn.Module):
             speech, speech_lengths, decoding_chunk_size,
             num_decoding_left_chunks,
             simulate_streaming)  # (B, maxlen, encoder_dim)
-        maxlen = encoder_out.size(1)
         ctc_probs = self.ctc.log_softmax(
             encoder_out)  # (1, maxlen, vocab_size)
         ctc_probs = ctc_probs.squeeze(0)
-        # cur_hyps: (prefix, (blank_ending_score, none_blank_ending_score))
-        cur_hyps = [(tuple(), (0.0, -float('inf')))]
-        # 2. CTC beam search step by step
-        for t in range(0, maxlen):
-            logp = ctc_probs[t]  # (vocab_size,)
-            # key: prefix, value (pb, pnb), default value(-inf, -inf)
-            next_hyps = defaultdict(lambda: (-float('inf'), -float('inf')))
-            # 2.1 First beam prune: select topk best
-            top_k_logp, top_k_index = logp.topk(beam_size)  # (beam_size,)
-            for s in top_k_index:
-                s = s.item()
-                ps = logp[s].item()
-                for prefix, (pb, pnb) in cur_hyps:
-                    last = prefix[-1] if len(prefix) > 0 else None
-                    if s == 0:  # blank
-                        n_pb, n_pnb = next_hyps[prefix]
-                        n_pb = log_add([n_pb, pb + ps, pnb + ps])
-                        next_hyps[prefix] = (n_pb, n_pnb)
-                    elif s == last:
-                        #  Update *ss -> *s;
-                        n_pb, n_pnb = next_hyps[prefix]
-                        n_pnb = log_add([n_pnb, pnb + ps])
-                        next_hyps[prefix] = (n_pb, n_pnb)
-                        # Update *s-s -> *ss, - is for blank
-                        n_prefix = prefix + (s, )
-                        n_pb, n_pnb = next_hyps[n_prefix]
-                        n_pnb = log_add([n_pnb, pb + ps])
-                        next_hyps[n_prefix] = (n_pb, n_pnb)
-                    else:
-                        n_prefix = prefix + (s, )
-                        n_pb, n_pnb = next_hyps[n_prefix]
-                        n_pnb = log_add([n_pnb, pb + ps, pnb + ps])
-                        next_hyps[n_prefix] = (n_pb, n_pnb)
-
-            # 2.2 Second beam prune
-            next_hyps = sorted(next_hyps.items(),
-                               key=lambda x: log_add(list(x[1])),
-                               reverse=True)
-            cur_hyps = next_hyps[:beam_size]
-        hyps = [(y[0], log_add([y[1][0], y[1][1]])) for y in cur_hyps]
+        hyps = self._prefix_beam_search(ctc_probs, beam_size)
         return hyps, encoder_out
 
+    def _prefix_beam_search(
+        self,
+        ctc_probs: torch.Tensor,
+        beam_size: int,
+    ) -> List[Tuple[Tuple[int, ...], float]]:
+        """ CTC prefix beam search over the ctc output of one utterance
+
+        Args:
+            ctc_probs (torch.Tensor): ctc log probs, (max_len, vocab_size),
+                without batch padding
+            beam_size (int): beam size for beam search
+
+        Returns:
+            List[Tuple[Tuple[int, ...], float]]: nbest (prefix, score)
+        """
+        return prefix_beam_search(ctc_probs, beam_size)
+
     def ctc_prefix_beam_search(
         self,
         speech: torch.Tensor,
@@ -443,6 +447,117 @@ class ASRModel(torch.nn.Module):
                                                simulate_streaming)
         return hyps[0][0]
 
+    def _batch_prefix_beam_search(
+        self,
+        encoder_out: torch.Tensor,
+        encoder_mask: torch.Tensor,
+        beam_size: int,
+    ) -> List[List[Tuple[Tuple[int, ...], float]]]:
+        """ CTC prefix beam search over a padded batch of encoder output,
+            each utterance is searched on its own unpadded frames
+
+        Args:
+            encoder_out (torch.Tensor): (batch, max_len, encoder_dim)
+            encoder_mask (torch.Tensor): (batch, 1, max_len)
+            beam_size (int): beam size for beam search
+
+        Returns:
+            List[List[Tuple[Tuple[int, ...], float]]]: nbest (prefix, score)
+                of each utterance
+        """
+        encoder_out_lens = encoder_mask.squeeze(1).sum(1).tolist()
+        ctc_probs = self.ctc.log_softmax(
+            encoder_out)  # (B, maxlen, vocab_size)
+        return [
+            self._prefix_beam_search(ctc_probs[i, :length], beam_size)
+            for i, length in enumerate(encoder_out_lens)
+        ]
+
+    def ctc_prefix_beam_search_batch(
+        self,
+        speech: torch.Tensor,
+        speech_lengths: torch.Tensor,
+        beam_size: int,
+        decoding_chunk_size: int = -1,
+        num_decoding_left_chunks: int = -1,
+        simulate_streaming: bool = False,
+    ) -> List[List[int]]:
+        """ Apply CTC prefix beam search on a batch, the encoder runs once
+            on the padded batch
+
+        Args:
+            speech (torch.Tensor): (batch, max_len, feat_dim)
+            speech_length (torch.Tensor): (batch, )
+            beam_size (int): beam size for beam search
+            decoding_chunk_size (int): decoding chunk for dynamic chunk
+                trained model.
+                <0: for decoding, use full chunk.
+                >0: for decoding, use fixed chunk size as set.
+                0: used for training, it's prohibited here
+            simulate_streaming (bool): whether do encoder forward in a
+                streaming fashion
+
+        Returns:
+            List[List[int]]: best result of each utterance
+        """
+        assert speech.shape[0] == speech_lengths.shape[0]
+        assert decoding_chunk_size != 0
+        encoder_out, encoder_mask = self._forward_encoder_batch(
+            speech, speech_lengths, decoding_chunk_size,
+            num_decoding_left_chunks,
+            simulate_streaming)  # (B, maxlen, encoder_dim)
+        hyps_list = self._batch_prefix_beam_search(encoder_out, encoder_mask,
+                                                   beam_size)
+        return [list(hyps[0][0]) for hyps in hyps_list]
+
+    def attention_rescoring_batch(
+        self,
+        speech: torch.Tensor,
+        speech_lengths: torch.Tensor,
+        beam_size: int,
+        decoding_chunk_size: int = -1,
+        num_decoding_left_chunks: int = -1,
+        ctc_weight: float = 0.0,
+        simulate_streaming: bool = False,
+        reverse_weight: float = 0.0,
+    ) -> List[List[int]]:
+        """ Apply attention rescoring decoding on a batch. The encoder runs
+            once on the padded batch, CTC prefix beam search is applied on
+            each utterance, then the nbest of all utterances are rescored in
+            one attention decoder forward
+
+        Args:
+            speech (torch.Tensor): (batch, max_len, feat_dim)
+            speech_length (torch.Tensor): (batch, )
+            beam_size (int): beam size for beam search
+            decoding_chunk_size (int): decoding chunk for dynamic chunk
+                trained model.
+                <0: for decoding, use full chunk.
+                >0: for decoding, use fixed chunk size as set.
+                0: used for training, it's prohibited here
+            simulate_streaming (bool): whether do encoder forward in a
+                streaming fashion
+            reverse_weight (float): right to left decoder weight
+            ctc_weight (float): ctc score weight
+
+        Returns:
+            List[List[int]]: Attention rescoring result of each utterance
+        """
+        assert speech.shape[0] == speech_lengths.shape[0]
+        assert decoding_chunk_size != 0
+        if reverse_weight > 0.0:
+            # decoder should be a bitransformer decoder if reverse_weight > 0.0
+            assert hasattr(self.decoder, 'right_decoder')
+        encoder_out, encoder_mask = self._forward_encoder_batch(
+            speech, speech_lengths, decoding_chunk_size,
+            num_decoding_left_chunks,
+            simulate_streaming)  # (B, maxlen, encoder_dim)
+        hyps_list = self._batch_prefix_beam_search(encoder_out, encoder_mask,
+                                                   beam_size)
+        return self._batch_attention_rescoring(hyps_list, encoder_out,
+                                               encoder_mask, ctc_weight,
+                                               reverse_weight)
+
     def attention_rescoring(
         self,
         speech: torch.Tensor,
@@ -480,7 +595,6 @@ class ASRModel(torch.nn.Module):
         if reverse_weight > 0.0:
             # decoder should be a bitransformer decoder if reverse_weight > 0.0
             assert hasattr(self.decoder, 'right_decoder')
-        device = speech.device
         batch_size = speech.shape[0]
         # For attention rescoring we only support batch_size=1
         assert batch_size == 1
@@ -490,56 +604,138 @@ class ASRModel(torch.nn.Module):
             num_decoding_left_chunks, simulate_streaming)
 
         assert len(hyps) == beam_size
+        return self._attention_rescoring(hyps, encoder_out, ctc_weight,
+                                         reverse_weight)
+
+    def _attention_rescoring(
+        self,
+        hyps: List[Tuple[Tuple[int, ...], float]],
+        encoder_out: torch.Tensor,
+        ctc_weight: float = 0.0,
+        reverse_weight: float = 0.0,
+    ) -> List[int]:
+        """ Rescore the nbest of one utterance on attention decoder
+
+        Args:
+            hyps (List[Tuple[Tuple[int, ...], float]]): nbest (prefix, score)
+                from ctc prefix beam search
+            encoder_out (torch.Tensor): (1, max_len, encoder_dim), without
+                batch padding
+            ctc_weight (float): ctc score weight
+            reverse_weight (float): right to left decoder weight
+
+        Returns:
+            List[int]: Attention rescoring result
+        """
+        encoder_mask = torch.ones(1,
+                                  1,
+                                  encoder_out.size(1),
+                                  dtype=torch.bool,
+                                  device=encoder_out.device)
+        return self._batch_attention_rescoring([hyps], encoder_out,
+                                               encoder_mask, ctc_weight,
+                                               reverse_weight)[0]
+
+    def _batch_attention_rescoring(
+        self,
+        hyps_list: List[List[Tuple[Tuple[int, ...], float]]],
+        encoder_out: torch.Tensor,
+        encoder_mask: torch.Tensor,
+        ctc_weight: float = 0.0,
+        reverse_weight: float = 0.0,
+    ) -> List[List[int]]:
+        """ Rescore the nbest of a batch of utterances on attention decoder,
+            the nbest of every utterance is padded to N hyps with empty
+            hyps, all hyps are padded to (B*N, max_hyps_len) and go through
+            the decoder in a single forward, where the N hyps of an
+            utterance share its encoder_out
+
+        Args:
+            hyps_list (List[List[Tuple[Tuple[int, ...], float]]]): nbest
+                (prefix, score) of each utterance from ctc prefix beam search
+            encoder_out (torch.Tensor): (batch, max_len, encoder_dim)
+            encoder_mask (torch.Tensor): (batch, 1, max_len)
+            ctc_weight (float): ctc score weight
+            reverse_weight (float): right to left decoder weight
+
+        Returns:
+            List[List[int]]: Attention rescoring result of each utterance
+        """
+        device = encoder_out.device
+        batch_size = len(hyps_list)
+        num_hyps = max([len(utt_hyps) for utt_hyps in hyps_list] + [1])
+        # hyps of utterance i are rows [i*N, (i+1)*N), padding hyps are empty
+        hyps = [
+            utt_hyps[j] if j < len(utt_hyps) else (tuple(), 0.0)
+            for utt_hyps in hyps_list for j in range(num_hyps)
+        ]
+        hyps_valid = torch.tensor(
+            [[j < len(utt_hyps) for j in range(num_hyps)]
+             for utt_hyps in hyps_list],
+            device=device,
+            dtype=torch.bool)  # (B, N)
         hyps_pad = pad_sequence([
             torch.tensor(hyp[0], device=device, dtype=torch.long)
             for hyp in hyps
-        ], True, self.ignore_id)  # (beam_size, max_hyps_len)
+        ], True, self.ignore_id)  # (B*N, max_hyps_len)
         ori_hyps_pad = hyps_pad
         hyps_lens = torch.tensor([len(hyp[0]) for hyp in hyps],
                                  device=device,
-                                 dtype=torch.long)  # (beam_size,)
-        hyps_pad, _ = add_sos_eos(hyps_pad, self.sos, self.eos, self.ignore_id)
+                                 dtype=torch.long)  # (B*N,)
+        # ys_out: tokens followed by <eos>, the targets of the decoder output
+        hyps_pad, ys_out = add_sos_eos(hyps_pad, self.sos, self.eos,
+                                       self.ignore_id)
         hyps_lens = hyps_lens + 1  # Add <sos> at begining
-        encoder_out = encoder_out.repeat(beam_size, 1, 1)
-        encoder_mask = torch.ones(beam_size,
-                                  1,
-                                  encoder_out.size(1),
-                                  dtype=torch.bool,
-                                  device=device)
         # used for right to left decoder
         r_hyps_pad = reverse_pad_list(ori_hyps_pad, hyps_lens, self.ignore_id)
-        r_hyps_pad, _ = add_sos_eos(r_hyps_pad, self.sos, self.eos,
-                                    self.ignore_id)
+        r_hyps_pad, r_ys_out = add_sos_eos(r_hyps_pad, self.sos, self.eos,
+                                           self.ignore_id)
+        # encoder_out (B, max_len, encoder_dim) is broadcast to the N hyps
+        # of each utterance in the decoder
         decoder_out, r_decoder_out, _ = self.decoder(
             encoder_out, encoder_mask, hyps_pad, hyps_lens, r_hyps_pad,
-            reverse_weight)  # (beam_size, max_hyps_len, vocab_size)
+            reverse_weight)  # (B*N, max_hyps_len, vocab_size)
         decoder_out = torch.nn.functional.log_softmax(decoder_out, dim=-1)
-        decoder_out = decoder_out.cpu().numpy()
-        # r_decoder_out will be 0.0, if reverse_weight is 0.0 or decoder is a
-        # conventional transformer decoder.
-        r_decoder_out = torch.nn.functional.log_softmax(r_decoder_out, dim=-1)
-        r_decoder_out = r_decoder_out.cpu().numpy()
         # Only use decoder score for rescoring
-        best_score = -float('inf')
-        best_index = 0
-        for i, hyp in enumerate(hyps):
-            score = 0.0
-            for j, w in enumerate(hyp[0]):
-                score += decoder_out[i][j][w]
-            score += decoder_out[i][len(hyp[0])][self.eos]
-            # add right to left decoder score
-            if reverse_weight > 0:
-                r_score = 0.0
-                for j, w in enumerate(hyp[0]):
-                    r_score += r_decoder_out[i][len(hyp[0]) - j - 1][w]
-                r_score += r_decoder_out[i][len(hyp[0])][self.eos]
-                score = score * (1 - reverse_weight) + r_score * reverse_weight
-            # add ctc score
-            score += hyp[1] * ctc_weight
-            if score > best_score:
-                best_score = score
-                best_index = i
-        return hyps[best_index][0]
+        scores = self._sum_target_logp(decoder_out, ys_out)  # (B*N,)
+        # add right to left decoder score, r_decoder_out will be 0.0, if
+        # reverse_weight is 0.0 or decoder is a conventional transformer
+        # decoder.
+        if reverse_weight > 0:
+            r_decoder_out = torch.nn.functional.log_softmax(r_decoder_out,
+                                                            dim=-1)
+            r_scores = self._sum_target_logp(r_decoder_out, r_ys_out)
+            scores = scores * (1 - reverse_weight) + r_scores * reverse_weight
+        # add ctc score
+        ctc_scores = torch.tensor([hyp[1] for hyp in hyps],
+                                  device=device,
+                                  dtype=scores.dtype)
+        scores = scores + ctc_scores * ctc_weight
+        # pick the best hyp of each utterance, the first one on ties
+        scores = scores.view(batch_size, num_hyps).masked_fill(
+            ~hyps_valid, -float('inf'))  # (B, N)
+        best_index = scores.argmax(dim=-1).tolist()
+        return [
+            list(utt_hyps[best_index[i]][0]) if len(utt_hyps) > 0 else []
+            for i, utt_hyps in enumerate(hyps_list)
+        ]
+
+    def _sum_target_logp(self, logp: torch.Tensor,
+                         ys_out: torch.Tensor) -> torch.Tensor:
+        """ Sum the log prob of the target tokens of each hyp
+
+        Args:
+            logp (torch.Tensor): decoder log probs, (num_hyps, L, vocab_size)
+            ys_out (torch.Tensor): targets padded with ignore_id,
+                (num_hyps, L)
+
+        Returns:
+            torch.Tensor: (num_hyps,)
+        """
+        mask = ys_out != self.ignore_id
+        index = ys_out.masked_fill(~mask, 0).unsqueeze(-1)
+        target_logp = logp.gather(-1, index).squeeze(-1)  # (num_hyps, L)
+        return target_logp.masked_fill(~mask, 0.0).sum(dim=1)
 
     @torch.jit.export
     def subsampling_rate(self) -> int:
@@ -650,8 +846,8 @@ class ASRModel(torch.nn.Module):
         assert encoder_out.size(0) == 1
         num_hyps = hyps.size(0)
         assert hyps_lens.size(0) == num_hyps
-        encoder_out = encoder_out.repeat(num_hyps, 1, 1)
-        encoder_mask = torch.ones(num_hyps,
+        # encoder_out is shared by all hyps in the decoder
+        encoder_mask = torch.ones(1,
                                   1,
                                   encoder_out.size(1),
                                   dtype=torch.bool,
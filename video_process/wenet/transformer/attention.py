@@ -119,16 +119,83 @@ class MultiHeadedAttention(nn.Module):
                 of the encoder, such as Mocha, the passed in mask could be
                 in (#batch, L, T) shape. But there is no such case in current
                 Wenet.
+                5.When the key and value have fewer rows than the query, see
+                `forward_cached`, the mask is in (#batch_kv, 1, T) shape.
 
 
         Returns:
             torch.Tensor: Output tensor (#batch, time1, d_model).
 
         """
+        if key.size(0) != query.size(0):
+            k, v = self.forward_kv(key, value)
+            return self.forward_cached(query, k, v, mask)
         q, k, v = self.forward_qkv(query, key, value)
         scores = torch.matmul(q, k.transpose(-2, -1)) / math.sqrt(self.d_k)
         return self.forward_attention(v, scores, mask)
 
+    def forward_kv(
+        self, key: torch.Tensor, value: torch.Tensor
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Transform key and value only, so that they can be cached and
+        reused by `forward_cached`.
+
+        Args:
+            key (torch.Tensor): Key tensor (#batch, time2, size).
+            value (torch.Tensor): Value tensor (#batch, time2, size).
+
+        Returns:
+            torch.Tensor: Transformed key tensor, size
+                (#batch, n_head, time2, d_k).
+            torch.Tensor: Transformed value tensor, size
+                (#batch, n_head, time2, d_k).
+
+        """
+        n_batch = key.size(0)
+        k = self.linear_k(key).view(n_batch, -1, self.h, self.d_k)
+        v = self.linear_v(value).view(n_batch, -1, self.h, self.d_k)
+        return k.transpose(1, 2), v.transpose(1, 2)
+
+    def forward_cached(self, query: torch.Tensor, k: torch.Tensor,
+                       v: torch.Tensor,
+                       mask: Optional[torch.Tensor]) -> torch.Tensor:
+        """Compute scaled dot product attention with key and value
+        transformed in advance by `forward_kv`.
+
+        The key and value may have fewer rows than the query, e.g. one
+        encoder output for all beams of an utterance. Then #batch must be a
+        multiple of #batch_kv, and each row of the key and value is shared
+        by #batch // #batch_kv consecutive rows of the query. These query
+        rows are folded into time1, so the key and value are broadcast
+        rather than repeated.
+
+        Args:
+            query (torch.Tensor): Query tensor (#batch, time1, size).
+            k (torch.Tensor): Transformed key tensor, size
+                (#batch_kv, n_head, time2, d_k).
+            v (torch.Tensor): Transformed value tensor, size
+                (#batch_kv, n_head, time2, d_k).
+            mask (torch.Tensor): Mask tensor (#batch_kv, 1, time2) or
+                (#batch, time1, time2) if #batch_kv == #batch.
+
+        Returns:
+            torch.Tensor: Output tensor (#batch, time1, d_model).
+
+        """
+        n_batch = query.size(0)
+        q = self.linear_q(query).view(n_batch, -1, self.h, self.d_k)
+        q = q.transpose(1, 2)  # (batch, head, time1, d_k)
+        n_batch_kv = k.size(0)
+        if n_batch_kv != n_batch:
+            assert n_batch % n_batch_kv == 0
+            # (batch_kv, head, batch // batch_kv * time1, d_k)
+            q = q.reshape(n_batch_kv, -1, self.h, q.size(2),
+                          self.d_k).transpose(1, 2).reshape(
+                              n_batch_kv, self.h, -1, self.d_k)
+        scores = torch.matmul(q, k.transpose(-2, -1)) / math.sqrt(self.d_k)
+        x = self.forward_attention(v, scores, mask)
+        return x.view(n_batch, -1, x.size(-1))
+
 
 class RelPositionMultiHeadedAttention(MultiHeadedAttention):
     """Multi-Head Attention layer with relative position encoding.
@@ -118,6 +118,11 @@ class ConvolutionModule(nn.Module):
         # GLU mechanism
         x = self.pointwise_conv1(x)  # (batch, 2*channel, dim)
         x = nn.functional.glu(x, dim=1)  # (batch, channel, dim)
+        # the bias of pointwise_conv1 makes padded frames non-zero again,
+        # mask them so that the symmetric depthwise conv of the last valid
+        # frames sees zeros, as for an unpadded utterance
+        if mask_pad is not None and self.lorder == 0:
+            x.masked_fill_(~mask_pad, 0.0)
 
         # 1D Depthwise Conv
         x = self.depthwise_conv(x)
@@ -14,6 +14,63 @@ from wenet.transformer.positionwise_feed_forward import PositionwiseFeedForward
 from wenet.utils.mask import (subsequent_mask, make_pad_mask)
 
 
+class DecoderState:
+    """Incremental state of TransformerDecoder for autoregressive decoding.
+
+    The self-attention keys and values of the decoded tokens are kept in
+    buffers preallocated up to `max_len` tokens, and each decoding step
+    writes the projections of the newest token only, instead of growing
+    the layer outputs with torch.cat and projecting the whole prefix
+    again. The cross-attention keys and values of the memory are projected
+    once per utterance when the state is built, and broadcast to the
+    beam_size consecutive hypotheses of the utterance.
+
+    Args:
+        self_k: self-attention key buffer of each layer,
+            (batch * beam_size, head, max_len, d_k)
+        self_v: self-attention value buffer of each layer,
+            (batch * beam_size, head, max_len, d_k)
+        src_k: transformed memory key of each layer,
+            (batch, head, maxlen_in, d_k)
+        src_v: transformed memory value of each layer,
+            (batch, head, maxlen_in, d_k)
+        memory_mask: encoded memory mask, (batch, 1, maxlen_in)
+    """
+    def __init__(
+        self,
+        self_k: List[torch.Tensor],
+        self_v: List[torch.Tensor],
+        src_k: List[torch.Tensor],
+        src_v: List[torch.Tensor],
+        memory_mask: torch.Tensor,
+    ):
+        self.self_k = self_k
+        self.self_v = self_v
+        self.src_k = src_k
+        self.src_v = src_v
+        self.memory_mask = memory_mask
+        # number of tokens already decoded
+        self.step = 0
+
+    @property
+    def max_len(self) -> int:
+        return self.self_k[0].size(2) if len(self.self_k) > 0 else 0
+
+    def reorder(self, index: torch.Tensor):
+        """Reorder the hypotheses after beam pruning, row i of the buffers
+        is replaced by row index[i]. Only the filled part of the buffers is
+        copied, and the buffers are reused. The memory is shared by the
+        beams of an utterance and is not reordered, so index[i] must be a
+        beam of the same utterance as i.
+
+        Args:
+            index: (batch * beam_size, ), int64
+        """
+        for k, v in zip(self.self_k, self.self_v):
+            k[:, :, :self.step] = k[:, :, :self.step].index_select(0, index)
+            v[:, :, :self.step] = v[:, :, :self.step].index_select(0, index)
+
+
 class TransformerDecoder(torch.nn.Module):
     """Base class of Transfomer decoder module.
     Args:
@@ -93,8 +150,11 @@ class TransformerDecoder(torch.nn.Module):
     ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
         """Forward decoder.
         Args:
-            memory: encoded memory, float32  (batch, maxlen_in, feat)
-            memory_mask: encoder memory mask, (batch, 1, maxlen_in)
+            memory: encoded memory, float32  (batch, maxlen_in, feat), or
+                (batch // num_hyps, maxlen_in, feat) if each memory is
+                shared by num_hyps consecutive rows of ys_in_pad
+            memory_mask: encoder memory mask, (batch, 1, maxlen_in), or
+                (batch // num_hyps, 1, maxlen_in)
             ys_in_pad: padded input token ids, int64 (batch, maxlen_out)
             ys_in_lens: input lengths of this batch (batch)
             r_ys_in_pad: not used in transformer decoder, in order to unify api
@@ -171,6 +231,67 @@ class TransformerDecoder(torch.nn.Module):
             y = torch.log_softmax(self.output_layer(y), dim=-1)
         return y, new_cache
 
+    def init_state(
+        self,
+        memory: torch.Tensor,
+        memory_mask: torch.Tensor,
+        max_len: int,
+        beam_size: int = 1,
+    ) -> DecoderState:
+        """Build the incremental state for `forward_incremental`.
+            This is only used for decoding.
+        Args:
+            memory: encoded memory, float32  (batch, maxlen_in, feat)
+            memory_mask: encoded memory mask, (batch, 1, maxlen_in)
+            max_len: max number of tokens to decode, including sos
+            beam_size: number of hypotheses of each utterance, the
+                hypotheses of utterance i are rows
+                [i * beam_size, (i + 1) * beam_size) of the state
+        Returns:
+            DecoderState: state with empty self-attention buffers and the
+                cross-attention keys and values of the memory
+        """
+        self_k, self_v, src_k, src_v = [], [], [], []
+        for layer in self.decoders:
+            k, v = layer.src_attn.forward_kv(memory, memory)
+            src_k.append(k)
+            src_v.append(v)
+            self_k.append(k.new_zeros(k.size(0) * beam_size, k.size(1),
+                                      max_len, k.size(3)))
+            self_v.append(v.new_zeros(v.size(0) * beam_size, v.size(1),
+                                      max_len, v.size(3)))
+        return DecoderState(self_k, self_v, src_k, src_v, memory_mask)
+
+    def forward_incremental(
+        self,
+        tgt: torch.Tensor,
+        state: DecoderState,
+    ) -> torch.Tensor:
+        """Forward one step with the incremental state, only the newest
+            token is computed, and the state is advanced by one token.
+            This is only used for decoding.
+        Args:
+            tgt: the newest token ids, int64 (batch * beam_size, )
+            state: incremental state built by `init_state`
+        Returns:
+            y: log probs of the next token, (batch * beam_size, vocab_size)
+        """
+        assert state.step < state.max_len
+        x = self.embed[0](tgt.unsqueeze(1))
+        x, _ = self.embed[1](x, offset=state.step)
+        for i, layer in enumerate(self.decoders):
+            x = layer.forward_incremental(x, state.step, state.self_k[i],
+                                          state.self_v[i], state.src_k[i],
+                                          state.src_v[i], state.memory_mask)
+        state.step += 1
+        if self.normalize_before:
+            y = self.after_norm(x[:, -1])
+        else:
+            y = x[:, -1]
+        if self.use_output_layer:
+            y = torch.log_softmax(self.output_layer(y), dim=-1)
+        return y
+
 
 class BiTransformerDecoder(torch.nn.Module):
     """Base class of Transfomer decoder module.
@@ -236,8 +357,11 @@ class BiTransformerDecoder(torch.nn.Module):
     ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
         """Forward decoder.
         Args:
-            memory: encoded memory, float32  (batch, maxlen_in, feat)
-            memory_mask: encoder memory mask, (batch, 1, maxlen_in)
+            memory: encoded memory, float32  (batch, maxlen_in, feat), or
+                (batch // num_hyps, maxlen_in, feat) if each memory is
+                shared by num_hyps consecutive rows of ys_in_pad
+            memory_mask: encoder memory mask, (batch, 1, maxlen_in), or
+                (batch // num_hyps, 1, maxlen_in)
             ys_in_pad: padded input token ids, int64 (batch, maxlen_out)
             ys_in_lens: input lengths of this batch (batch)
             r_ys_in_pad: padded input token ids, int64 (batch, maxlen_out),
@@ -284,3 +408,40 @@ class BiTransformerDecoder(torch.nn.Module):
         """
         return self.left_decoder.forward_one_step(memory, memory_mask, tgt,
                                                   tgt_mask, cache)
+
+    def init_state(
+        self,
+        memory: torch.Tensor,
+        memory_mask: torch.Tensor,
+        max_len: int,
+        beam_size: int = 1,
+    ) -> DecoderState:
+        """Build the incremental state of the left decoder for
+            `forward_incremental`. This is only used for decoding.
+        Args:
+            memory: encoded memory, float32  (batch, maxlen_in, feat)
+            memory_mask: encoded memory mask, (batch, 1, maxlen_in)
+            max_len: max number of tokens to decode, including sos
+            beam_size: number of hypotheses of each utterance, the
+                hypotheses of utterance i are rows
+                [i * beam_size, (i + 1) * beam_size) of the state
+        Returns:
+            DecoderState: incremental state of the left decoder
+        """
+        return self.left_decoder.init_state(memory, memory_mask, max_len,
+                                            beam_size)
+
+    def forward_incremental(
+        self,
+        tgt: torch.Tensor,
+        state: DecoderState,
+    ) -> torch.Tensor:
+        """Forward one step of the left decoder with the incremental state.
+            This is only used for decoding.
+        Args:
+            tgt: the newest token ids, int64 (batch * beam_size, )
+            state: incremental state built by `init_state`
+        Returns:
+            y: log probs of the next token, (batch * beam_size, vocab_size)
+        """
+        return self.left_decoder.forward_incremental(tgt, state)
@@ -135,3 +135,78 @@ class DecoderLayer(nn.Module):
             x = torch.cat([cache, x], dim=1)
 
         return x, tgt_mask, memory, memory_mask
+
+    def forward_incremental(
+        self,
+        tgt: torch.Tensor,
+        step: int,
+        self_k: torch.Tensor,
+        self_v: torch.Tensor,
+        src_k: torch.Tensor,
+        src_v: torch.Tensor,
+        memory_mask: torch.Tensor,
+    ) -> torch.Tensor:
+        """Compute decoded features of the newest token only, with the
+        self-attention keys and values of the previous tokens and the
+        cross-attention keys and values of the memory taken from buffers.
+
+        Args:
+            tgt (torch.Tensor): Input tensor of the newest token
+                (#batch, 1, size).
+            step (int): Position of the newest token.
+            self_k (torch.Tensor): Self-attention key buffer
+                (#batch, n_head, max_len, d_k), positions before `step`
+                are filled, the key of the newest token is written to
+                position `step`.
+            self_v (torch.Tensor): Self-attention value buffer, the same
+                as `self_k`.
+            src_k (torch.Tensor): Transformed memory key
+                (#batch, n_head, maxlen_in, d_k).
+            src_v (torch.Tensor): Transformed memory value
+                (#batch, n_head, maxlen_in, d_k).
+            memory_mask (torch.Tensor): Encoded memory mask
+                (#batch, 1, maxlen_in).
+
+        Returns:
+            torch.Tensor: Output tensor (#batch, 1, size).
+
+        """
+        residual = tgt
+        if self.normalize_before:
+            tgt = self.norm1(tgt)
+
+        k, v = self.self_attn.forward_kv(tgt, tgt)
+        self_k[:, :, step:step + 1] = k
+        self_v[:, :, step:step + 1] = v
+        # the newest token sees itself and all previous tokens, no mask
+        self_att = self.self_attn.forward_cached(tgt,
+                                                 self_k[:, :, :step + 1],
+                                                 self_v[:, :, :step + 1],
+                                                 None)
+        if self.concat_after:
+            x = residual + self.concat_linear1(
+                torch.cat((tgt, self_att), dim=-1))
+        else:
+            x = residual + self.dropout(self_att)
+        if not self.normalize_before:
+            x = self.norm1(x)
+
+        residual = x
+        if self.normalize_before:
+            x = self.norm2(x)
+        src_att = self.src_attn.forward_cached(x, src_k, src_v, memory_mask)
+        if self.concat_after:
+            x = residual + self.concat_linear2(torch.cat((x, src_att), dim=-1))
+        else:
+            x = residual + self.dropout(src_att)
+        if not self.normalize_before:
+            x = self.norm2(x)
+
+        residual = x
+        if self.normalize_before:
+            x = self.norm3(x)
+        x = residual + self.dropout(self.feed_forward(x))
+        if not self.normalize_before:
+            x = self.norm3(x)
+
+        return x
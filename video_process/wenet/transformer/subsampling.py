@@ -119,7 +119,9 @@ class Conv2dSubsampling4(BaseSubsampling):
         b, c, t, f = x.size()
         x = self.out(x.transpose(1, 2).contiguous().view(b, t, c * f))
         x, pos_emb = self.pos_enc(x, offset)
-        return x, pos_emb, x_mask[:, :, :-2:2][:, :, :-2:2]
+        # an output frame is valid only if the last input frame of its
+        # conv window is valid, so padded utterances get exact lengths
+        return x, pos_emb, x_mask[:, :, 2::2][:, :, 2::2]
 
 
 class Conv2dSubsampling6(BaseSubsampling):
@@ -170,7 +172,9 @@ class Conv2dSubsampling6(BaseSubsampling):
         b, c, t, f = x.size()
         x = self.linear(x.transpose(1, 2).contiguous().view(b, t, c * f))
         x, pos_emb = self.pos_enc(x, offset)
-        return x, pos_emb, x_mask[:, :, :-2:2][:, :, :-4:3]
+        # an output frame is valid only if the last input frame of its
+        # conv window is valid, so padded utterances get exact lengths
+        return x, pos_emb, x_mask[:, :, 2::2][:, :, 4::3]
 
 
 class Conv2dSubsampling8(BaseSubsampling):
@@ -225,4 +229,6 @@ class Conv2dSubsampling8(BaseSubsampling):
         b, c, t, f = x.size()
         x = self.linear(x.transpose(1, 2).contiguous().view(b, t, c * f))
         x, pos_emb = self.pos_enc(x, offset)
-        return x, pos_emb, x_mask[:, :, :-2:2][:, :, :-2:2][:, :, :-2:2]
+        # an output frame is valid only if the last input frame of its
+        # conv window is valid, so padded utterances get exact lengths
+        return x, pos_emb, x_mask[:, :, 2::2][:, :, 2::2][:, :, 2::2]
@@ -0,0 +1,102 @@
+# Author: Wang Zifan
+#  Apache 2.0  (http://www.apache.org/licenses/LICENSE-2.0)
+"""In-process cache of loaded ASR models."""
+
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+import torch
+import yaml
+
+from wenet.transformer.asr_model import init_asr_model
+from wenet.utils.checkpoint import load_checkpoint
+
+
+class ModelCache:
+    """LRU cache of ASR models, each loaded once and kept in eval mode.
+
+    Models are keyed by (checkpoint, config, cmvn_file, device), so the same
+    checkpoint on two devices or with two cmvn files is loaded twice. When
+    more than `max_size` models are loaded, the least recently used one is
+    evicted.
+
+    Args:
+        max_size (int): max number of models kept in memory
+    """
+    def __init__(self, max_size: int = 2):
+        assert max_size > 0
+        self.max_size = max_size
+        self._models = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # total seconds spent in building and loading models
+        self.load_time = 0.0
+
+    def get(
+        self,
+        checkpoint: str,
+        config_path: str,
+        cmvn_file: Optional[str] = None,
+        device: torch.device = torch.device('cpu'),
+    ) -> Tuple[torch.nn.Module, dict]:
+        """Return the model and its configs, loading them on first use.
+
+        Args:
+            checkpoint (str): path of model checkpoint (*.pt)
+            config_path (str): path of model config (yaml file)
+            cmvn_file (str): path of cmvn file, None to use the one in config
+            device (torch.device): device the model is moved to
+
+        Returns:
+            torch.nn.Module: loaded model in eval mode
+            dict: model configs
+        """
+        device = torch.device(device)
+        key = (checkpoint, config_path, cmvn_file, str(device))
+        with self._lock:
+            if key in self._models:
+                self.hits += 1
+                self._models.move_to_end(key)
+                return self._models[key]
+            self.misses += 1
+            start = time.time()
+            with open(config_path, 'r') as fin:
+                configs = yaml.load(fin, Loader=yaml.FullLoader)
+            if cmvn_file is not None:
+                configs['cmvn_file'] = cmvn_file
+            model = init_asr_model(configs)
+            load_checkpoint(model, checkpoint)
+            model = model.to(device)
+            model.eval()
+            self.load_time += time.time() - start
+            self._models[key] = (model, configs)
+            while len(self._models) > self.max_size:
+                old_key, _ = self._models.popitem(last=False)
+                self.evictions += 1
+                logging.info('ModelCache: evict model %s', old_key[0])
+            return model, configs
+
+    def clear(self):
+        """Drop all loaded models."""
+        with self._lock:
+            self._models.clear()
+
+    def stats(self) -> dict:
+        """Return cache counters."""
+        with self._lock:
+            return {
+                'size': len(self._models),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'load_time': self.load_time,
+            }
+
+
+# shared by all recognizers in this process
+global_model_cache = ModelCache()
@@ -0,0 +1,210 @@
+# Author: Wang Zifan
+#  Apache 2.0  (http://www.apache.org/licenses/LICENSE-2.0)
+"""Vectorized CTC prefix beam search."""
+
+from collections import defaultdict
+from typing import List, Tuple
+
+import numpy as np
+import torch
+
+from wenet.utils.common import log_add
+
+# multiplier of the rolling prefix hash, hashes wrap around at 2^64
+_HASH_BASE = np.uint64(1000003)
+
+
+def _log_add3(a: np.ndarray, b: np.ndarray, c: np.ndarray) -> np.ndarray:
+    """Element-wise stable log add of three arrays, the same formula as
+    wenet.utils.common.log_add
+    """
+    a_max = np.maximum(np.maximum(a, b), c)
+    all_inf = a_max == -np.inf
+    a_max = np.where(all_inf, 0.0, a_max)
+    with np.errstate(divide='ignore'):
+        lsp = np.log(np.exp(a - a_max) + np.exp(b - a_max) + np.exp(c - a_max))
+    return np.where(all_inf, -np.inf, a_max + lsp)
+
+
+def prefix_beam_search(
+    ctc_probs: torch.Tensor,
+    beam_size: int,
+) -> List[Tuple[Tuple[int, ...], float]]:
+    """ CTC prefix beam search over the ctc output of one utterance
+
+    Hypotheses are kept in fixed-size arrays (prefix ids, length, last
+    token, pb, pnb and a rolling hash of the prefix). For each frame, all
+    (top-k token, hypothesis) extensions are built at once, extensions that
+    reach the prefix of an existing hypothesis are merged into it, and the
+    scores are accumulated and pruned with array ops. Contributions to the
+    same prefix are added in the same order as `prefix_beam_search_loop`,
+    and ties are broken by first visit, so the nbest prefixes and their
+    order are the same as the loop version, and the scores agree up to
+    floating point rounding.
+
+    Args:
+        ctc_probs (torch.Tensor): ctc log probs, (max_len, vocab_size),
+            without batch padding
+        beam_size (int): beam size for beam search
+
+    Returns:
+        List[Tuple[Tuple[int, ...], float]]: nbest (prefix, score)
+    """
+    maxlen = ctc_probs.size(0)
+    if maxlen == 0:
+        return [(tuple(), log_add([0.0, -float('inf')]))]
+    top_k_logp, top_k_index = ctc_probs.topk(beam_size, dim=-1)
+    top_k_logp = top_k_logp.cpu().double().numpy()  # (maxlen, k)
+    top_k_index = top_k_index.cpu().numpy()  # (maxlen, k)
+    k = top_k_index.shape[1]
+    # current hypotheses, starting from the empty prefix
+    prefixes = np.zeros((1, maxlen), dtype=np.int64)
+    lens = np.zeros(1, dtype=np.int64)
+    last = np.full(1, -1, dtype=np.int64)
+    hashes = np.zeros(1, dtype=np.uint64)
+    pb = np.zeros(1)
+    pnb = np.full(1, -np.inf)
+    positions = np.arange(maxlen)
+    for t in range(maxlen):
+        s = top_k_index[t]  # (k,)
+        ps = top_k_logp[t]  # (k,)
+        num_hyps = len(lens)
+        # 1. Targets of every (token, hypothesis) pair, in loop order
+        s_grid = np.repeat(s, num_hyps)  # (k*H,)
+        ps_grid = np.repeat(ps, num_hyps)
+        h_grid = np.tile(np.arange(num_hyps), k)
+        pb_grid = pb[h_grid] + ps_grid
+        pnb_grid = pnb[h_grid] + ps_grid
+        is_blank = s_grid == 0
+        is_repeat = (s_grid == last[h_grid]) & ~is_blank
+        # extension (h, s) has id H + s_index * H + h, staying on h has id h
+        ext_id = num_hyps + np.arange(k * num_hyps)
+        ext_hash = hashes[h_grid] * _HASH_BASE + (s_grid + 1).astype(
+            np.uint64)
+        # an extension can reach the prefix of an existing hypothesis i,
+        # i.e. prefix(h) + (s, ) == prefix(i), merge them
+        pair_g, pair_i = np.nonzero(ext_hash[:, None] == hashes[None, :])
+        if len(pair_g) > 0:
+            pair_h = h_grid[pair_g]
+            same = (lens[pair_i] == lens[pair_h] + 1) & \
+                (s_grid[pair_g] == last[pair_i]) & ~is_blank[pair_g]
+            same &= np.all((prefixes[pair_i] == prefixes[pair_h]) |
+                           (positions[None, :] >= lens[pair_h][:, None]),
+                           axis=1)
+            ext_id[pair_g[same]] = pair_i[same]
+        # 2. Each pair updates one or two targets, the first update is:
+        #   blank: pb of h <- pb + ps, pnb + ps
+        #   repeat: pnb of h <- pnb + ps
+        #   other: pnb of (h, s) <- pb + ps, pnb + ps
+        # and the second (repeat only) is pnb of (h, s) <- pb + ps
+        neg_inf = np.full(k * num_hyps, -np.inf)
+        first_target = np.where(is_blank | is_repeat, h_grid, ext_id)
+        first_field = np.where(is_blank, 0, 1)
+        first_v1 = np.where(is_repeat, pnb_grid, pb_grid)
+        first_v2 = np.where(is_repeat, neg_inf, pnb_grid)
+        second_index = np.nonzero(is_repeat)[0]
+        # interleave the updates in loop order
+        order = np.concatenate([np.arange(k * num_hyps) * 2,
+                                second_index * 2 + 1])
+        target = np.concatenate([first_target, ext_id[second_index]])
+        field = np.concatenate(
+            [first_field, np.ones(len(second_index), dtype=np.int64)])
+        v1 = np.concatenate([first_v1, pb_grid[second_index]])
+        v2 = np.concatenate([first_v2, neg_inf[second_index]])
+        loop_order = np.argsort(order, kind='stable')
+        target, field = target[loop_order], field[loop_order]
+        v1, v2 = v1[loop_order], v2[loop_order]
+        # 3. Accumulate, updates of the same (target, field) are applied in
+        # loop order, one round per repeated update
+        unique_targets, first_visit, target_index = np.unique(
+            target, return_index=True, return_inverse=True)
+        acc = np.full((len(unique_targets), 2), -np.inf)
+        key = target_index * 2 + field
+        key_order = np.argsort(key, kind='stable')
+        sorted_key = key[key_order]
+        group_start = np.concatenate(
+            [[0], np.nonzero(sorted_key[1:] != sorted_key[:-1])[0] + 1])
+        rank = np.empty(len(key), dtype=np.int64)
+        rank[key_order] = np.arange(len(key)) - np.repeat(
+            group_start, np.diff(np.append(group_start, len(key))))
+        for r in range(rank.max() + 1):
+            sel = rank == r
+            rows, cols = target_index[sel], field[sel]
+            acc[rows, cols] = _log_add3(acc[rows, cols], v1[sel], v2[sel])
+        # 4. Prune: sort by score, ties keep the first visited prefix first
+        scores = _log_add3(acc[:, 0], acc[:, 1], np.full(len(acc), -np.inf))
+        keep = np.lexsort((first_visit, -scores))[:beam_size]
+        kept_targets = unique_targets[keep]
+        is_ext = kept_targets >= num_hyps
+        g = np.where(is_ext, kept_targets - num_hyps, 0)
+        src = np.where(is_ext, h_grid[g], kept_targets)
+        new_prefixes = prefixes[src]
+        ext_rows = np.nonzero(is_ext)[0]
+        new_prefixes[ext_rows, lens[src[ext_rows]]] = s_grid[g[ext_rows]]
+        prefixes = new_prefixes
+        lens = lens[src] + is_ext
+        last = np.where(is_ext, s_grid[g], last[src])
+        hashes = np.where(is_ext, ext_hash[g], hashes[src])
+        pb, pnb = acc[keep, 0], acc[keep, 1]
+        final_scores = scores[keep]
+    return [(tuple(prefixes[i, :lens[i]].tolist()), float(final_scores[i]))
+            for i in range(len(lens))]
+
+
+def prefix_beam_search_loop(
+    ctc_probs: torch.Tensor,
+    beam_size: int,
+) -> List[Tuple[Tuple[int, ...], float]]:
+    """ Reference CTC prefix beam search with python loops over frames,
+        tokens and hypotheses, kept for testing and benchmarking
+
+    Args:
+        ctc_probs (torch.Tensor): ctc log probs, (max_len, vocab_size),
+            without batch padding
+        beam_size (int): beam size for beam search
+
+    Returns:
+        List[Tuple[Tuple[int, ...], float]]: nbest (prefix, score)
+    """
+    maxlen = ctc_probs.size(0)
+    # cur_hyps: (prefix, (blank_ending_score, none_blank_ending_score))
+    cur_hyps = [(tuple(), (0.0, -float('inf')))]
+    # 2. CTC beam search step by step
+    for t in range(0, maxlen):
+        logp = ctc_probs[t]  # (vocab_size,)
+        # key: prefix, value (pb, pnb), default value(-inf, -inf)
+        next_hyps = defaultdict(lambda: (-float('inf'), -float('inf')))
+        # 2.1 First beam prune: select topk best
+        top_k_logp, top_k_index = logp.topk(beam_size)  # (beam_size,)
+        for s in top_k_index:
+            s = s.item()
+            ps = logp[s].item()
+            for prefix, (pb, pnb) in cur_hyps:
+                last = prefix[-1] if len(prefix) > 0 else None
+                if s == 0:  # blank
+                    n_pb, n_pnb = next_hyps[prefix]
+                    n_pb = log_add([n_pb, pb + ps, pnb + ps])
+                    next_hyps[prefix] = (n_pb, n_pnb)
+                elif s == last:
+                    #  Update *ss -> *s;
+                    n_pb, n_pnb = next_hyps[prefix]
+                    n_pnb = log_add([n_pnb, pnb + ps])
+                    next_hyps[prefix] = (n_pb, n_pnb)
+                    # Update *s-s -> *ss, - is for blank
+                    n_prefix = prefix + (s, )
+                    n_pb, n_pnb = next_hyps[n_prefix]
+                    n_pnb = log_add([n_pnb, pb + ps])
+                    next_hyps[n_prefix] = (n_pb, n_pnb)
+                else:
+                    n_prefix = prefix + (s, )
+                    n_pb, n_pnb = next_hyps[n_prefix]
+                    n_pnb = log_add([n_pnb, pb + ps, pnb + ps])
+                    next_hyps[n_prefix] = (n_pb, n_pnb)
+
+        # 2.2 Second beam prune
+        next_hyps = sorted(next_hyps.items(),
+                           key=lambda x: log_add(list(x[1])),
+                           reverse=True)
+        cur_hyps = next_hyps[:beam_size]
+    hyps = [(y[0], log_add([y[1][0], y[1][1]])) for y in cur_hyps]
+    return hyps